@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Benchmark the assembler pipeline.
+
+Generates synthetic programs of varying shape, times every stage of the
+assembler on each, and optionally compares the results against a stored
+baseline so that regressions show up.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from bisect import bisect_left, bisect_right
+from dataclasses import asdict, dataclass
+from json import dump as json_dump
+from json import load as json_load
+from os import path
+from platform import python_version
+from random import Random
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Tuple
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from sma16asm import Assembler, StageStatistics, get_file_lines
+
+# Timings only compare on the machine which made them, so the baseline is not committed
+DEFAULT_BASELINE = path.join(path.dirname(path.abspath(__file__)), "assembler_baseline.json")
+
+# Words available to user sections, larger programs are only parsed
+MAX_WORDS = 2**12 - 16 - 1
+
+REFERENCE_INSTRUCTIONS = ["load", "store", "add", "jump", "jumpz", "sfull"]
+VALUE_INSTRUCTIONS = ["add 0x{:03x}", "and 0x{:03x}", "xor 0x{:03x}", "lshft {}", "rshft {}"]
+CONSTANT_VALUES = ["0x{:03x}", "s\"ab\"", "a'z'", "@{label}"]
+
+
+@dataclass
+class ProgramShape:
+    """The shape of a synthetic program."""
+
+    words: int
+    label_density: float = 0.25
+    sections: int = 4
+    constants: int = 64
+    forward_ratio: float = 0.5
+    reference_ratio: float = 0.5
+    seed: int = 0
+
+
+def generate_program(shape: ProgramShape) -> List[str]:
+    """Generate the lines of a synthetic program.
+
+    The program holds shape.words instructions and constants spread over
+    shape.sections sections. Roughly label_density of the words are labelled,
+    and of the instructions with a reference operand, forward_ratio refer to a
+    label defined later in the source.
+    """
+    random = Random(shape.seed)
+    constants = min(shape.constants, shape.words - 1)
+    kinds = ["const"] * constants + ["instruction"] * (shape.words - constants)
+    random.shuffle(kinds)
+
+    labelled = [index for index in range(shape.words) if index == 0 or random.random() < shape.label_density]
+    labels = {index: "l_{}".format(index) for index in labelled}
+
+    def pick_label(index: int) -> str:
+        earlier = bisect_left(labelled, index)
+        later = bisect_right(labelled, index)
+        if later < len(labelled) and (not earlier or random.random() < shape.forward_ratio):
+            return labels[labelled[random.randrange(later, len(labelled))]]
+        return labels[labelled[random.randrange(earlier)]] if earlier else labels[0]
+
+    lines = ["# Synthetic program, {}".format(asdict(shape)), ".vec.reset @l_0", ".vec.fault @RESET_VECTOR"]
+    section_size = -(-shape.words // max(shape.sections, 1))
+    for index, kind in enumerate(kinds):
+        if index % section_size == 0:
+            lines.append("")
+            lines.append(".sec section_{}".format(index // section_size))
+        prefix = labels[index] + ": " if index in labels else "    "
+        if kind == "const":
+            value = random.choice(CONSTANT_VALUES)
+            lines.append(prefix + ".const " + value.format(random.randrange(0x1000), label=pick_label(index)))
+        elif random.random() < shape.reference_ratio:
+            lines.append(prefix + random.choice(REFERENCE_INSTRUCTIONS) + " @" + pick_label(index))
+        else:
+            lines.append(prefix + random.choice(VALUE_INSTRUCTIONS).format(random.randrange(0x10)))
+    return [line + "\n" for line in lines]
+
+
+OUTPUT_FORMATS = ["bin", "hex", "segment", "c", "text", "image", "debug", "map"]
+
+
+def time_stages(file_path: str, parse_only: bool) -> Dict[str, float]:
+    """Run the assembler on a file, returning the seconds spent in each stage as reported to its stage hook."""
+    statistics: List[StageStatistics] = []
+    assembler = Assembler(stage_hook=statistics.append)
+
+    items, section_addresses = assembler.prepare_lines(get_file_lines(file_path))
+    if not parse_only:
+        image = assembler.assemble_prepared(items, section_addresses)
+        for output_format in OUTPUT_FORMATS:
+            assembler.serialise(image, output_format)
+    return {stage.stage: stage.seconds for stage in statistics}
+
+
+def run_case(shape: ProgramShape, repeats: int, directory: str) -> Dict[str, Any]:
+    """Time a case, keeping the best time for each stage over a number of repeats."""
+    file_path = path.join(directory, "synthetic_{}.a16".format(shape.seed))
+    with open(file_path, "w") as output_handle:
+        output_handle.writelines(generate_program(shape))
+
+    parse_only = shape.words > MAX_WORDS
+    stages: Dict[str, float] = {}
+    for _ in range(repeats):
+        for stage, seconds in time_stages(file_path, parse_only).items():
+            stages[stage] = min(seconds, stages.get(stage, seconds))
+
+    return {"shape": asdict(shape), "parse_only": parse_only, "stages": stages}
+
+
+CASES = {
+    "words_256": ProgramShape(words=256),
+    "words_1024": ProgramShape(words=1024),
+    "words_4000": ProgramShape(words=4000),
+    "labels_none": ProgramShape(words=2048, label_density=0.0),
+    "labels_all": ProgramShape(words=2048, label_density=1.0),
+    "sections_1": ProgramShape(words=2048, sections=1),
+    "sections_256": ProgramShape(words=2048, sections=256),
+    "constants_none": ProgramShape(words=2048, constants=0),
+    "constants_half": ProgramShape(words=2048, constants=1024),
+    "forward_none": ProgramShape(words=2048, forward_ratio=0.0),
+    "forward_all": ProgramShape(words=2048, forward_ratio=1.0),
+    "parse_16k": ProgramShape(words=16384, sections=16),
+    "parse_64k": ProgramShape(words=65536, sections=64),
+}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float,
+            minimum: float) -> List[Tuple[str, str, float, float]]:
+    """Get the stages which are slower than the baseline by more than threshold and minimum seconds."""
+    regressions = []
+    for name, case in results["cases"].items():
+        baseline_case = baseline["cases"].get(name)
+        if baseline_case is None or baseline_case["shape"] != case["shape"]:
+            continue
+        for stage, seconds in case["stages"].items():
+            baseline_seconds = baseline_case["stages"].get(stage)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > minimum:
+                regressions.append((name, stage, baseline_seconds, seconds))
+    return regressions
+
+
+def print_results(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]):
+    """Print a table of stage timings, with the change from the baseline if there is one."""
+    for name, case in results["cases"].items():
+        baseline_stages = (baseline or {}).get("cases", {}).get(name, {}).get("stages", {})
+        print("{} ({} words{})".format(name, case["shape"]["words"], ", parse only" if case["parse_only"] else ""))
+        for stage, seconds in case["stages"].items():
+            change = ""
+            if stage in baseline_stages and baseline_stages[stage] > 0:
+                change = "{:+8.1f}%".format((seconds / baseline_stages[stage] - 1) * 100)
+            print("  {:<26} {:10.3f} ms {}".format(stage, seconds * 1000, change).rstrip())
+        print("  {:<26} {:10.3f} ms".format("total", sum(case["stages"].values()) * 1000))
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("-c",
+                                 "--case",
+                                 action="append",
+                                 choices=sorted(CASES),
+                                 help="case to run, all cases are run by default")
+    argument_parser.add_argument("-r", "--repeats", type=int, default=3, help="number of timed runs, best is kept")
+    argument_parser.add_argument("-o", "--output", default=None, help="write results as JSON to this path")
+    argument_parser.add_argument("-b", "--baseline", default=DEFAULT_BASELINE, help="baseline results to compare with")
+    argument_parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    argument_parser.add_argument("--threshold",
+                                 type=float,
+                                 default=0.2,
+                                 help="fractional slowdown of a stage reported as a regression")
+    argument_parser.add_argument("--minimum",
+                                 type=float,
+                                 default=0.001,
+                                 help="slowdown in seconds below which a stage is never reported as a regression")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    results: Dict[str, Any] = {"python": python_version(), "repeats": parsed_arguments.repeats, "cases": {}}
+    with TemporaryDirectory() as directory:
+        for name in parsed_arguments.case or CASES:
+            results["cases"][name] = run_case(CASES[name], parsed_arguments.repeats, directory)
+
+    baseline = None
+    if not parsed_arguments.save_baseline and path.isfile(parsed_arguments.baseline):
+        with open(parsed_arguments.baseline) as baseline_handle:
+            baseline = json_load(baseline_handle)
+    elif not parsed_arguments.save_baseline:
+        print("no baseline at {}, run with --save-baseline to store one".format(parsed_arguments.baseline))
+
+    print_results(results, baseline)
+
+    for output_path in filter(None, [
+            parsed_arguments.output,
+            parsed_arguments.baseline if parsed_arguments.save_baseline else None,
+    ]):
+        with open(output_path, "w") as output_handle:
+            json_dump(results, output_handle, indent=2)
+
+    if baseline is None:
+        return 0
+
+    regressions = compare(results, baseline, parsed_arguments.threshold, parsed_arguments.minimum)
+    for name, stage, baseline_seconds, seconds in regressions:
+        print("regression: {} {} {:.3f} ms -> {:.3f} ms".format(name, stage, baseline_seconds * 1000, seconds * 1000))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    exit(main())
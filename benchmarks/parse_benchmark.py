@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Benchmark the assembler's line parser.
+
+Parses a synthetic source with the single-pass tokenizer and with the
+previous split and eval based parser, and reports lines per second for each.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+from typing import Callable, Iterable, Iterator, List, Optional
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from sma16asm import (AssemblyError, ParsedDirective, ParsedInstruction, ParsedItem, ParsedLabel, ParsedValue,
+                      parse_line)
+
+SOURCE_LINES = [
+    "# A comment line",
+    "",
+    ".sec program{index}",
+    "label_{index}:",
+    "    load @label_{index}",
+    "    store @SMALL_OUT",
+    "    add 0x{index:03x}",
+    "    and 0b101010",
+    "    jumpz @label_{index}",
+    "loop_{index}: inner_{index}: xor 17",
+    "str_{index}: .const s\"hi\"",
+    "chr_{index}: .const a'\\n'",
+    "    halt",
+]
+
+
+def generate_lines(count: int) -> List[str]:
+    """Generate a synthetic source of count lines."""
+    return [SOURCE_LINES[index % len(SOURCE_LINES)].format(index=index) + "\n" for index in range(count)]
+
+
+# The parser as it was before the single-pass tokenizer, copied unchanged apart from its names
+def _legacy_is_c_name(to_test: str):
+    return all(map(str.isalnum, filter(len, to_test.split("_")))) and not to_test[0].isnumeric()
+
+
+def legacy_parse_line(line: str, line_number: int) -> Iterator[ParsedItem]:
+    """Parse a line."""
+    line = line.strip()
+    if line and not line.startswith("#"):
+        keep_checking_for_labels = True
+        while keep_checking_for_labels and ":" in line:
+            label, *rest = line.split(":")
+            if _legacy_is_c_name(label):
+                line = ":".join(rest).strip()
+                yield ParsedLabel(name=label)
+            else:
+                keep_checking_for_labels = False
+
+        if line.startswith("."):
+            name, *value = line.split(" ")
+            yield ParsedDirective(name=name,
+                                  value=legacy_parse_value(" ".join(value), line_number),
+                                  labels=set(),
+                                  section="any",
+                                  line=line_number)
+        elif line:
+            name, *value = line.split(" ")
+            yield ParsedInstruction(name=name,
+                                    value=legacy_parse_value(" ".join(value), line_number),
+                                    labels=set(),
+                                    section="any",
+                                    line=line_number)
+
+
+def legacy_parse_value(to_parse: str, line_number: int) -> Optional[ParsedValue]:
+    """Parse a value."""
+    to_parse = to_parse.strip()
+
+    if not to_parse:
+        return None
+
+    if to_parse.lower() == "?":
+        return ParsedValue(type="integer", value=0)
+
+    if to_parse.startswith("@"):
+        if not _legacy_is_c_name(to_parse[1:]):
+            raise AssemblyError("reference name invalid {} on line {}".format(to_parse[1:], line_number))
+        return ParsedValue(type="reference", value=to_parse[1:])
+
+    if to_parse.startswith("0x"):
+        return ParsedValue(type="integer", value=int(to_parse, 16))
+
+    if to_parse.startswith("0b"):
+        return ParsedValue(type="integer", value=int(to_parse, 2))
+
+    if to_parse.isdigit():
+        return ParsedValue(type="integer", value=int(to_parse, 10))
+
+    if to_parse.startswith("s\""):
+        try:
+            eval_value = eval(to_parse[1:])
+        except SyntaxError:
+            raise AssemblyError("invalid small string {} on line {}".format(to_parse[1:], line_number))
+        if not isinstance(eval_value, str) or len(eval_value) != 2:
+            raise AssemblyError("invalid small string value {} on line {}".format(to_parse[1:], line_number))
+        return ParsedValue(type="short_string", value=eval_value)
+
+    if to_parse.startswith("a\""):
+        try:
+            eval_value = eval(to_parse[1:])
+        except SyntaxError:
+            raise AssemblyError("invalid ascii string {} on line {}".format(to_parse[1:], line_number))
+        if not isinstance(eval_value, str) or len(eval_value) != 2:
+            raise AssemblyError("invalid ascii string value {} on line {}".format(to_parse[1:], line_number))
+        return ParsedValue(type="ascii_string", value=eval_value)
+
+    if to_parse.startswith("s'"):
+        try:
+            eval_value = eval(to_parse[1:])
+        except SyntaxError:
+            raise AssemblyError("invalid short character {} on line {}".format(to_parse[1:], line_number))
+        if not isinstance(eval_value, str) or len(eval_value) != 1:
+            raise AssemblyError("invalid short character value {} on line {}".format(to_parse[1:], line_number))
+        return ParsedValue(type="short_character", value=eval_value)
+
+    if to_parse.startswith("a'"):
+        try:
+            eval_value = eval(to_parse[1:])
+        except SyntaxError:
+            raise AssemblyError("invalid ascii character {} on line {}".format(to_parse[1:], line_number))
+        if not isinstance(eval_value, str) or len(eval_value) != 1:
+            raise AssemblyError("invalid ascii character value {} on line {}".format(to_parse[1:], line_number))
+        return ParsedValue(type="ascii_character", value=eval_value)
+
+    return ParsedValue(type="raw_value", value=to_parse)
+
+
+def time_parser(parser: Callable[[str, int], Iterable[ParsedItem]], lines: List[str], repeats: int) -> float:
+    """Get the best lines per second of a parser over a number of repeats."""
+    best = 0.0
+    for _ in range(repeats):
+        start = perf_counter()
+        for line_number, line in enumerate(lines, start=1):
+            for _ in parser(line, line_number):
+                pass
+        best = max(best, len(lines) / (perf_counter() - start))
+    return best
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("-l", "--lines", type=int, default=100000, help="number of source lines")
+    argument_parser.add_argument("-r", "--repeats", type=int, default=3, help="number of timed runs, best is kept")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    lines = generate_lines(parsed_arguments.lines)
+
+    legacy_rate = time_parser(legacy_parse_line, lines, parsed_arguments.repeats)
+    rate = time_parser(parse_line, lines, parsed_arguments.repeats)
+
+    print("legacy parser:    {:10.0f} lines per second".format(legacy_rate))
+    print("single-pass scan: {:10.0f} lines per second".format(rate))
+    print("speedup:          {:10.2f}x".format(rate / legacy_rate))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
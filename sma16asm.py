@@ -1,13 +1,35 @@
 #!/usr/bin/env python3
 """SMA16 assembler."""
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from dataclasses import dataclass
+from base64 import b64encode
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from dataclasses import replace as replace_dataclass
 from difflib import get_close_matches
 from enum import IntEnum
-from os import path
+from hashlib import sha256
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import cpu_count, environ, listdir, makedirs, path, remove, replace, stat, utime
+from re import DOTALL, Match
+from re import compile as compile_regex
+from stat import S_ISSOCK
 from struct import pack as struct_pack
-from sys import stderr, stdout
-from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from struct import pack_into as struct_pack_into
+from sys import stderr, stdin, stdout
+from tempfile import NamedTemporaryFile
+from time import perf_counter, sleep
+from tracemalloc import get_traced_memory, is_tracing, reset_peak
+from tracemalloc import start as start_tracing
+from tracemalloc import stop as stop_tracing
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Sized, Tuple, Union
+
+if TYPE_CHECKING:
+    from sma16cfg import ControlFlowAnalysis
+
+
+ASSEMBLER_VERSION = "0.1"
 
 
 class AssemblyError(Exception):
@@ -52,6 +74,7 @@ class ParsedInstruction:
     labels: Set[str]
     section: str
     line: int
+    column: int = 0
 
 
 @dataclass
@@ -63,6 +86,7 @@ class ParsedDirective:
     labels: Set[str]
     section: str
     line: int
+    column: int = 0
 
 
 @dataclass
@@ -70,6 +94,7 @@ class ParsedLabel:
     """A freshly parsed label."""
 
     name: str
+    column: int = 0
 
 
 ParsedItem = Union[ParsedInstruction, ParsedDirective, ParsedLabel]
@@ -108,10 +133,16 @@ RegionTable = Dict[str, Region]
 
 @dataclass
 class AddressValue:
-    """A value stored at an address."""
+    """A value stored at an address.
+
+    The source line and any reference the value was resolved from are kept
+    for debugging output.
+    """
 
     address: int
     value: int
+    line: int = 0
+    reference: Optional[str] = None
 
 
 def did_you_mean(name: str, reference_table: ReferenceTable) -> str:
@@ -129,6 +160,7 @@ class UnresolvedAddressValue:
     address: int
     instruction: Instruction
     data: str
+    line: int = 0
 
     def resolve(self, reference_table: ReferenceTable) -> AddressValue:
         """Resolve the address value given a reference table."""
@@ -136,7 +168,7 @@ class UnresolvedAddressValue:
             raise AssemblyError("reference to undefined location {}{}".format(self.data,
                                                                               did_you_mean(self.data, reference_table)))
         value = (reference_table[self.data] & 0x0fff) | ((self.instruction.value << 12) & 0xf000)
-        return AddressValue(address=self.address, value=value)
+        return AddressValue(address=self.address, value=value, line=self.line, reference=self.data)
 
 
 @dataclass
@@ -145,6 +177,7 @@ class UnresolvedAddressConstant:
 
     address: int
     value: str
+    line: int = 0
 
     def resolve(self, reference_table: ReferenceTable) -> AddressValue:
         """Resolve the address value given a reference table."""
@@ -152,7 +185,10 @@ class UnresolvedAddressConstant:
             raise AssemblyError("reference to undefined location {}{}".format(self.value,
                                                                               did_you_mean(self.value,
                                                                                            reference_table)))
-        return AddressValue(address=self.address, value=reference_table[self.value])
+        return AddressValue(address=self.address,
+                            value=reference_table[self.value],
+                            line=self.line,
+                            reference=self.value)
 
 
 def force_resolved(generator_function):
@@ -196,8 +232,39 @@ CONSTANTS = {
 }
 
 
-def _is_c_name(to_test: str):
-    return all(map(str.isalnum, filter(len, to_test.split("_")))) and not to_test[0].isnumeric()
+_C_NAME = compile_regex(r"(?!\d)\w+")
+_LINE = compile_regex(
+    r"\s*(?:#.*|((?:(?!\d)\w+:\s*)*)(?:(\S+)\s*"
+    r"(?:@((?!\d)\w+)|0x([0-9a-fA-F]+)|0b([01]+)|([0-9]+)|(.*?)))?)\s*", DOTALL)
+_LABEL = compile_regex(r"((?!\d)\w+):\s*")
+_INTEGER = compile_regex(r"0x([0-9a-fA-F]+)|0b([01]+)|([0-9]+)")
+_LITERAL = compile_regex(r"""([sa])(?:"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)')\s*(?:#.*)?""", DOTALL)
+_ESCAPE = compile_regex(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|[0-7]{1,3}|.)", DOTALL)
+
+_ESCAPES = {
+    "\n": "",
+    "\\": "\\",
+    "'": "'",
+    "\"": "\"",
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+}
+
+_LITERAL_TYPES = {
+    ("s", True): ("short_string", 2, "small string"),
+    ("a", True): ("ascii_string", 2, "ascii string"),
+    ("s", False): ("short_character", 1, "short character"),
+    ("a", False): ("ascii_character", 1, "ascii character"),
+}
+
+
+def _is_c_name(to_test: str) -> bool:
+    return _C_NAME.fullmatch(to_test) is not None
 
 
 def get_file_lines(file_path: str) -> Iterator[str]:
@@ -207,33 +274,66 @@ def get_file_lines(file_path: str) -> Iterator[str]:
             yield line
 
 
-def parse_line(line: str, line_number: int) -> Iterator[ParsedItem]:
-    """Parse a line."""
-    line = line.strip()
-    if line and not line.startswith("#"):
-        keep_checking_for_labels = True
-        while keep_checking_for_labels and ":" in line:
-            label, *rest = line.split(":")
-            if _is_c_name(label):
-                line = ":".join(rest).strip()
-                yield ParsedLabel(name=label)
-            else:
-                keep_checking_for_labels = False
-
-        if line.startswith("."):
-            name, *value = line.split(" ")
-            yield ParsedDirective(name=name,
-                                  value=parse_value(" ".join(value), line_number),
-                                  labels=set(),
-                                  section="any",
-                                  line=line_number)
-        elif line:
-            name, *value = line.split(" ")
-            yield ParsedInstruction(name=name,
-                                    value=parse_value(" ".join(value), line_number),
-                                    labels=set(),
-                                    section="any",
-                                    line=line_number)
+def parse_line(line: str, line_number: int) -> List[ParsedItem]:
+    """Parse a line in a single pass, tracking the column each item starts at."""
+    match = _LINE.fullmatch(line)
+    if not match:
+        return []
+
+    labels, name, reference, hexadecimal, binary, decimal, value = match.groups()
+    items: List[ParsedItem] = []
+
+    if labels:
+        labels_start = match.start(1)
+        for label in _LABEL.finditer(labels):
+            items.append(ParsedLabel(name=label.group(1), column=labels_start + label.start() + 1))
+
+    if name:
+        # Common values are decoded by the line pattern, anything else is left to parse_value
+        if reference:
+            parsed_value: Optional[ParsedValue] = ParsedValue(type="reference", value=reference)
+        elif hexadecimal:
+            parsed_value = ParsedValue(type="integer", value=int(hexadecimal, 16))
+        elif binary:
+            parsed_value = ParsedValue(type="integer", value=int(binary, 2))
+        elif decimal:
+            parsed_value = ParsedValue(type="integer", value=int(decimal, 10))
+        elif value:
+            parsed_value = parse_value(value, line_number)
+        else:
+            parsed_value = None
+
+        item_class = ParsedDirective if name[0] == "." else ParsedInstruction
+        items.append(
+            item_class(name=name,
+                       value=parsed_value,
+                       labels=set(),
+                       section="any",
+                       line=line_number,
+                       column=match.start(2) + 1))
+
+    return items
+
+
+def decode_literal(to_decode: str) -> str:
+    """Decode the escape sequences in the body of a string or character literal.
+
+    Raises ValueError for a truncated or out of range escape sequence.
+    """
+
+    def _decode_escape(match: Match) -> str:
+        escape = match.group(1)
+        if escape in _ESCAPES:
+            return _ESCAPES[escape]
+        if escape in ("x", "u", "U"):
+            raise ValueError("truncated escape sequence \\{}".format(escape))
+        if escape[0] in "xuU":
+            return chr(int(escape[1:], 16))
+        if escape[0] in "01234567":
+            return chr(int(escape, 8))
+        return "\\" + escape
+
+    return _ESCAPE.sub(_decode_escape, to_decode)
 
 
 def parse_value(to_parse: str, line_number: int) -> Optional[ParsedValue]:
@@ -243,85 +343,266 @@ def parse_value(to_parse: str, line_number: int) -> Optional[ParsedValue]:
     if not to_parse:
         return None
 
-    if to_parse.lower() == "?":
+    first_character = to_parse[0]
+
+    if to_parse == "?":
         return ParsedValue(type="integer", value=0)
 
-    if to_parse.startswith("@"):
+    if first_character == "@":
         if not _is_c_name(to_parse[1:]):
             raise AssemblyError("reference name invalid {} on line {}".format(to_parse[1:], line_number))
         return ParsedValue(type="reference", value=to_parse[1:])
 
-    if to_parse.startswith("0x"):
-        return ParsedValue(type="integer", value=int(to_parse, 16))
-
-    if to_parse.startswith("0b"):
-        return ParsedValue(type="integer", value=int(to_parse, 2))
-
-    if to_parse.isdigit():
-        return ParsedValue(type="integer", value=int(to_parse, 10))
-
-    if to_parse.startswith("s\""):
-        try:
-            eval_value = eval(to_parse[1:])
-        except SyntaxError:
-            raise AssemblyError("invalid small string {} on line {}".format(to_parse[1:], line_number))
-        if not isinstance(eval_value, str) or len(eval_value) != 2:
-            raise AssemblyError("invalid small string value {} on line {}".format(to_parse[1:], line_number))
-        return ParsedValue(type="short_string", value=eval_value)
-
-    if to_parse.startswith("a\""):
-        try:
-            eval_value = eval(to_parse[1:])
-        except SyntaxError:
-            raise AssemblyError("invalid ascii string {} on line {}".format(to_parse[1:], line_number))
-        if not isinstance(eval_value, str) or len(eval_value) != 2:
-            raise AssemblyError("invalid ascii string value {} on line {}".format(to_parse[1:], line_number))
-        return ParsedValue(type="ascii_string", value=eval_value)
-
-    if to_parse.startswith("s'"):
-        try:
-            eval_value = eval(to_parse[1:])
-        except SyntaxError:
-            raise AssemblyError("invalid short character {} on line {}".format(to_parse[1:], line_number))
-        if not isinstance(eval_value, str) or len(eval_value) != 1:
-            raise AssemblyError("invalid short character value {} on line {}".format(to_parse[1:], line_number))
-        return ParsedValue(type="short_character", value=eval_value)
-
-    if to_parse.startswith("a'"):
+    if first_character.isdigit():
+        integer = _INTEGER.fullmatch(to_parse)
+        if integer:
+            hexadecimal, binary, decimal = integer.groups()
+            if hexadecimal:
+                return ParsedValue(type="integer", value=int(hexadecimal, 16))
+            if binary:
+                return ParsedValue(type="integer", value=int(binary, 2))
+            return ParsedValue(type="integer", value=int(decimal, 10))
+        # Several words, such as the arguments of .stack, are left as a raw value
+        if to_parse.startswith(("0x", "0b")) and len(to_parse.split()) == 1:
+            raise AssemblyError("invalid integer {} on line {}".format(to_parse, line_number))
+
+    if first_character in "sa" and to_parse[1:2] in ("\"", "'"):
+        is_string = to_parse[1] == "\""
+        value_type, length, description = _LITERAL_TYPES[(first_character, is_string)]
+        literal = _LITERAL.fullmatch(to_parse)
+        if not literal:
+            raise AssemblyError("invalid {} {} on line {}".format(description, to_parse[1:], line_number))
         try:
-            eval_value = eval(to_parse[1:])
-        except SyntaxError:
-            raise AssemblyError("invalid ascii character {} on line {}".format(to_parse[1:], line_number))
-        if not isinstance(eval_value, str) or len(eval_value) != 1:
-            raise AssemblyError("invalid ascii character value {} on line {}".format(to_parse[1:], line_number))
-        return ParsedValue(type="ascii_character", value=eval_value)
+            value = decode_literal(literal.group(2) if is_string else literal.group(3))
+        except ValueError as error:
+            raise AssemblyError("invalid {} {} on line {}".format(description, to_parse[1:], line_number)) from error
+        if len(value) != length:
+            raise AssemblyError("invalid {} value {} on line {}".format(description, to_parse[1:], line_number))
+        return ParsedValue(type=value_type, value=value)
 
     return ParsedValue(type="raw_value", value=to_parse)
 
 
+def parse_text_lines(lines: Iterable[str]) -> Iterator[ParsedItem]:
+    """Parse lines of source text."""
+    for line_number, line in enumerate(lines, start=1):
+        yield from parse_line(line, line_number)
+
+
 def parse_lines(file_path: str) -> Iterator[ParsedItem]:
     """Parse all lines in a file."""
-    for line_number, line in enumerate(get_file_lines(file_path), start=1):
-        yield from parse_line(line, line_number)
+    yield from parse_text_lines(get_file_lines(file_path))
 
 
-def glue_labels_and_sections(items: Iterable[ParsedItem]) -> Iterator[GluedItem]:
-    """Glue labels to items."""
+def glue_labels_and_sections(items: Iterable[ParsedItem],
+                             section_addresses: Optional[Dict[str, int]] = None,
+                             exported_labels: Optional[List[str]] = None) -> Iterator[GluedItem]:
+    """Glue labels to items.
+
+    Sections may be pinned to a fixed address with `.sec name address`, these
+    are added to section_addresses if given. Labels named by `.global` are
+    added to exported_labels if given.
+    """
     labels = set()
     section = "any"
     for item in items:
         if isinstance(item, ParsedLabel):
             labels.add(item.name)
+        elif isinstance(item, ParsedDirective) and item.name == ".global":
+            if not (item.value and item.value.type == "raw_value" and isinstance(item.value.value, str)
+                    and all(map(_is_c_name, item.value.value.split()))):
+                raise AssemblyError("exported label names '{}' were invalid on line {}".format(
+                    item.value.value if item.value else None, item.line))
+            if exported_labels is not None:
+                exported_labels.extend(name for name in item.value.value.split() if name not in exported_labels)
         elif isinstance(item, ParsedDirective) and item.name == (".sec"):
             if not (item.value and item.value.type == "raw_value" and isinstance(item.value.value, str)):
                 raise AssemblyError("section name '{}' with type {} was invalid on line {}".format(
                     item.value.value if item.value else None, item.value.type if item.value else None, item.line))
-            section = item.value.value
+            section, *pin = item.value.value.split()
+            if pin:
+                section_address = parse_value(" ".join(pin), item.line)
+                if not (section_address and section_address.type == "integer" and isinstance(
+                        section_address.value, int)):
+                    raise AssemblyError("section address '{}' was invalid on line {}".format(" ".join(pin), item.line))
+                if section_addresses is not None:
+                    if section_addresses.get(section, section_address.value) != section_address.value:
+                        raise AssemblyError("section {} pinned to a second address on line {}".format(
+                            section, item.line))
+                    section_addresses[section] = section_address.value
         else:
-            yield item.__class__(labels=labels, value=item.value, name=item.name, section=section, line=item.line)
+            yield item.__class__(labels=labels,
+                                 value=item.value,
+                                 name=item.name,
+                                 section=section,
+                                 line=item.line,
+                                 column=item.column)
             labels = set()
 
 
+STACK_SECTION = "__stack"
+STACK_HANDLER_SECTION = "__stack_handler"
+
+# The handler, one entry per word as (label, instruction, operand, saves_flag).
+# Operands are references, integers, or keys into the values computed from
+# the directive. The pointer words are rewritten at run time: __stack_top
+# loads the top of the stack, __stack_clear zeroes it and __stack_write
+# pushes. Words with saves_flag set only save and restore the zero flag, and
+# are left out of a fast stack. __stack_flag itself is kept, so both handlers
+# have the same constants.
+STACK_HANDLER: List[Tuple[Optional[str], str, Union[int, str], bool]] = [
+    ("__stack_reset", "load", "__stack_depth", False),
+    (None, "sfull", "STACK_SIZE", False),
+    (None, "jump", "reset", False),
+    ("__stack_handler", "sfull", "__stack_value", False),
+    # Only ADD sets the zero flag, so it is saved as 0 if set or 1 if not, and restored by adding zero
+    (None, "lshft", 0x020, True),
+    (None, "jumpz", "__stack_save_flag", True),
+    (None, "xor", 0x001, True),
+    ("__stack_save_flag", "sfull", "__stack_flag", True),
+    (None, "load", "INTERRUPT_REASON", False),
+    (None, "add", 0x002, False),
+    (None, "jumpz", "__stack_push", False),
+    ("__stack_top", "load", "top", False),
+    (None, "sfull", "__stack_value", False),
+    (None, "lshft", 0x020, False),
+    ("__stack_clear", "sfull", "top", False),
+    (None, "load", "__stack_top", False),
+    (None, "add", 0xfff, False),
+    (None, "and", "mask", False),
+    (None, "xor", "base", False),
+    (None, "store", "__stack_top", False),
+    (None, "store", "__stack_clear", False),
+    (None, "load", "INTERRUPT_RETURN", False),
+    (None, "store", "__stack_pop_return", False),
+    (None, "load", "__stack_flag", True),
+    (None, "add", 0x000, True),
+    (None, "load", "__stack_value", False),
+    ("__stack_pop_return", "jump", 0x000, False),
+    ("__stack_push", "load", "__stack_top", False),
+    (None, "add", 0x001, False),
+    (None, "and", "mask", False),
+    (None, "xor", "base", False),
+    (None, "store", "__stack_top", False),
+    (None, "store", "__stack_clear", False),
+    (None, "store", "__stack_write", False),
+    (None, "load", "INTERRUPT_RETURN", False),
+    (None, "store", "__stack_push_return", False),
+    (None, "load", "__stack_flag", True),
+    (None, "add", 0x000, True),
+    (None, "load", "__stack_value", False),
+    ("__stack_write", "sfull", 0x000, False),
+    ("__stack_push_return", "jump", 0x000, False),
+    ("__stack_value", ".var", 0x000, False),
+    ("__stack_flag", ".var", 0x000, False),
+    ("__stack_depth", ".const", "depth", False),
+]
+
+# Constants are placed before instructions, so these lead the handler section
+STACK_HANDLER_CONSTANTS = sum(1 for _, name, _, _ in STACK_HANDLER if name[0] == ".")
+
+
+def expand_stack_directives(items: Iterable[GluedItem],
+                            section_addresses: Optional[Dict[str, int]] = None) -> List[GluedItem]:
+    """Expand a `.stack base depth [fast]` directive into a software stack. Mutates section_addresses.
+
+    The stack is a circular buffer of depth words pinned at base, so pushing
+    more than depth items loses the oldest and popped words are zeroed. A
+    handler supporting PUSH and POP becomes the fault vector, and the reset
+    vector is routed through code setting STACK_SIZE to depth.
+
+    The handler saves the zero flag on entry and restores it on return, as
+    PUSH and POP must leave it unchanged. That costs 6 of the 24 cycles a
+    PUSH takes and of the 26 a POP takes, or 5 when the flag is set. A fast
+    stack leaves the flag out, taking 18 and 20 cycles, for programs which
+    never test the flag straight after a PUSH or POP. It leaves the flag as
+    the handler's own ADD instructions set it.
+    """
+    items = list(items)
+    directives = [item for item in items if isinstance(item, ParsedDirective) and item.name == ".stack"]
+    if not directives:
+        return items
+    directive = directives[0]
+    if len(directives) > 1:
+        raise AssemblyError("second stack declared on line {}".format(directives[1].line))
+
+    arguments = []
+    if directive.value and directive.value.type == "raw_value" and isinstance(directive.value.value, str):
+        arguments = directive.value.value.split()
+    fast = arguments[2:] == ["fast"]
+    if fast:
+        arguments = arguments[:2]
+    values = [parse_value(argument, directive.line) for argument in arguments]
+    integers = [
+        value.value for value in values
+        if value is not None and value.type == "integer" and isinstance(value.value, int)
+    ]
+    if len(arguments) != 2 or len(integers) != 2:
+        raise AssemblyError("stack on line {} must be given as .stack base depth [fast]".format(directive.line))
+    base, depth = integers
+    if depth <= 0 or depth & (depth - 1) or base % depth or base + depth > 2**12:
+        raise AssemblyError("stack on line {} must have a power of two depth, and a base which is a multiple of it "
+                            "and leaves the stack in memory".format(directive.line))
+
+    reset_vectors = [item for item in items if isinstance(item, ParsedDirective) and item.name == ".vec.reset"]
+    if not reset_vectors:
+        raise AssemblyError("stack on line {} needs a reset vector".format(directive.line))
+    if any(isinstance(item, ParsedDirective) and item.name == ".vec.fault" for item in items):
+        raise AssemblyError("stack on line {} replaces the fault vector, which is also set".format(directive.line))
+
+    computed = {"base": base, "depth": depth, "mask": depth - 1, "top": base + depth - 1}
+    computed_references: Dict[str, Optional[ParsedValue]] = {"reset": reset_vectors[0].value}
+
+    expanded: List[GluedItem] = []
+    for item in items:
+        if item is directive:
+            continue
+        if item is reset_vectors[0]:
+            item = replace_dataclass(item, value=ParsedValue(type="reference", value="__stack_reset"))
+        expanded.append(item)
+
+    expanded.append(
+        ParsedDirective(name=".vec.fault",
+                        value=ParsedValue(type="reference", value="__stack_handler"),
+                        labels=set(),
+                        section=directive.section,
+                        line=directive.line,
+                        column=directive.column))
+    for index in range(depth):
+        expanded.append(
+            ParsedDirective(name=".var",
+                            value=ParsedValue(type="integer", value=0),
+                            labels=directive.labels if index == 0 else set(),
+                            section=STACK_SECTION,
+                            line=directive.line,
+                            column=directive.column))
+    for label, name, operand, saves_flag in STACK_HANDLER:
+        if fast and saves_flag:
+            continue
+        value: Optional[ParsedValue]
+        if isinstance(operand, int):
+            value = ParsedValue(type="integer", value=operand)
+        elif operand in computed_references:
+            value = computed_references[operand]
+        elif operand in computed:
+            value = ParsedValue(type="integer", value=computed[operand])
+        else:
+            value = ParsedValue(type="reference", value=operand)
+        item_class = ParsedDirective if name[0] == "." else ParsedInstruction
+        expanded.append(
+            item_class(name=name,
+                       value=value,
+                       labels={label} if label else set(),
+                       section=STACK_HANDLER_SECTION,
+                       line=directive.line,
+                       column=directive.column))
+
+    if section_addresses is not None:
+        section_addresses[STACK_SECTION] = base
+
+    return expanded
+
+
 @force_resolved
 def assign_vectors(items: Iterable[GluedItem]) -> Iterator[Union[GluedItem, UnresolvedAddressValue]]:
     """Assign vectors from directives."""
@@ -332,7 +613,8 @@ def assign_vectors(items: Iterable[GluedItem]) -> Iterator[Union[GluedItem, Unre
                 item.value.value, str)
             yield UnresolvedAddressValue(instruction=Instruction.JUMP,
                                          data=item.value.value,
-                                         address=VECTORS[vector_name].address)
+                                         address=VECTORS[vector_name].address,
+                                         line=item.line)
         else:
             yield item
 
@@ -349,36 +631,141 @@ def get_section_sizes(items: Iterable[Union[GluedItem, UnresolvedAddressValue]])
     return sections
 
 
-def assign_sections(region_table: RegionTable, sections: Dict[str, int]):
-    """Assign memory sections.
+class AddressSpace:
+    """A sorted index of free address intervals.
 
-    This is a packing problem and therefore reasonably complex.
-    A simplistic algorithm is used here which may not always be optimal if user
-    assigned addresses are used for some sections.
+    Intervals are inclusive and never overlap. They are kept both in address
+    order, so overlap checks are a single bisect, and in (size, start) order,
+    so a best fit is a single bisect.
     """
-    used_space: Set[Tuple[int, int]] = set()
 
-    def in_used_space(start, end):
-        return start > 0xfff or end > 0xfff or any(
-            map(lambda x: (start >= x[0] and start <= x[1]) or (end >= x[0] and end <= x[1]), used_space))
-
-    def find_free_space(size):
-        for _, end in used_space:
-            start_to_try = end + 1
-            end_to_try = end + size
-            if not in_used_space(start_to_try, end_to_try):
-                return start_to_try, end_to_try
-        raise AssemblyError("ran out of free space")
+    def __init__(self, size: int = 0x1000):
+        self.size = size
+        self.free_by_address: List[Tuple[int, int]] = [(0, size - 1)] if size > 0 else []
+        self.free_by_size: List[Tuple[int, int]] = [(size, 0)] if size > 0 else []
+
+    def copy(self) -> "AddressSpace":
+        """Get an independent copy of the address space."""
+        address_space = AddressSpace(self.size)
+        address_space.free_by_address = list(self.free_by_address)
+        address_space.free_by_size = list(self.free_by_size)
+        return address_space
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """Check whether an interval is out of range or overlaps a used interval."""
+        if start < 0 or end >= self.size or end < start:
+            return True
+        index = bisect_right(self.free_by_address, (start, self.size))
+        return index == 0 or self.free_by_address[index - 1][1] < end
+
+    def add(self, start: int, end: int):
+        """Mark an interval as used."""
+        if end < start:
+            return
+        index = bisect_right(self.free_by_address, (start, self.size))
+        if index > 0 and self.free_by_address[index - 1][1] >= start:
+            index -= 1
+        remainders = []
+        while index < len(self.free_by_address) and self.free_by_address[index][0] <= end:
+            free_start, free_end = self.free_by_address.pop(index)
+            del self.free_by_size[bisect_left(self.free_by_size, (free_end - free_start + 1, free_start))]
+            if free_start < start:
+                remainders.append((free_start, start - 1))
+            if free_end > end:
+                remainders.append((end + 1, free_end))
+        for free_start, free_end in remainders:
+            insort(self.free_by_address, (free_start, free_end))
+            insort(self.free_by_size, (free_end - free_start + 1, free_start))
+
+    def free_blocks(self) -> Iterator[Tuple[int, int]]:
+        """Get the free intervals in address order."""
+        return iter(self.free_by_address)
+
+    def best_fit(self, size: int) -> Optional[int]:
+        """Get the start of the smallest free interval that can hold size words, lowest address first."""
+        index = bisect_left(self.free_by_size, (size, 0))
+        return self.free_by_size[index][1] if index < len(self.free_by_size) else None
+
+    @property
+    def free_space(self) -> int:
+        """Get the number of free words."""
+        return sum(free_size for free_size, _ in self.free_by_size)
+
+    @property
+    def largest_free_block(self) -> int:
+        """Get the size of the largest free interval."""
+        return self.free_by_size[-1][0] if self.free_by_size else 0
+
+    @property
+    def fragmentation(self) -> float:
+        """Get the proportion of free space outside the largest free interval."""
+        free_space = self.free_space
+        if not free_space:
+            return 0.0
+        return 1.0 - self.largest_free_block / free_space
+
+
+def _place_sections(address_space: AddressSpace, sections: List[Tuple[str, int]]) -> Optional[Dict[str, int]]:
+    """Best fit each section in order, returning section start addresses or None if one does not fit."""
+    address_space = address_space.copy()
+    section_starts = {}
+    for section_name, section_size in sections:
+        section_start = address_space.best_fit(section_size)
+        if section_start is None:
+            return None
+        address_space.add(section_start, section_start + section_size - 1)
+        section_starts[section_name] = section_start
+    return section_starts
+
+
+def assign_sections(region_table: RegionTable,
+                    sections: Dict[str, int],
+                    section_addresses: Optional[Dict[str, int]] = None) -> AddressSpace:
+    """Assign memory sections. Mutates region_table.
+
+    Pinned sections are placed at their given addresses first. The remaining
+    sections are placed best-fit in declaration order, and if that fails in
+    decreasing order of size, which packs fragmented memory more tightly.
+    Returns the resulting address space.
+    """
+    section_addresses = section_addresses or {}
+    address_space = AddressSpace()
 
     for name, item in region_table.items():
-        if in_used_space(item.start, item.end):
+        if address_space.overlaps(item.start, item.end):
             raise AssemblyError("region {} assigned in used space, memory is likely full".format(name))
-        used_space.add((item.start, item.end))
+        address_space.add(item.start, item.end)
+
+    section_starts: Dict[str, int] = {}
+
+    for section_name, section_start in section_addresses.items():
+        if section_name not in sections:
+            continue
+        section_end = section_start + sections[section_name] - 1
+        if address_space.overlaps(section_start, section_end):
+            raise AssemblyError("section {} pinned at 0x{:03x} overlaps used space".format(section_name, section_start))
+        address_space.add(section_start, section_end)
+        section_starts[section_name] = section_start
+
+    unpinned = [(name, size) for name, size in sections.items() if name not in section_starts]
+    placed = _place_sections(address_space, unpinned)
+    if placed is None:
+        placed = _place_sections(address_space, sorted(unpinned, key=lambda x: -x[1]))
+    if placed is None:
+        raise AssemblyError(
+            "ran out of free space, {} words free in blocks of at most {} words, {:.0%} fragmented".format(
+                address_space.free_space, address_space.largest_free_block, address_space.fragmentation))
+    section_starts.update(placed)
 
     for section_name, section_size in sections.items():
-        section_start, section_end = find_free_space(section_size)
-        used_space.add((section_start, section_end))
-        region_table[section_name] = Region(type="user", start=section_start, end=section_end, count=0)
+        section_start = section_starts[section_name]
+        address_space.add(section_start, section_start + section_size - 1)
+        region_table[section_name] = Region(type="user",
+                                            start=section_start,
+                                            end=section_start + section_size - 1,
+                                            count=0)
+
+    return address_space
 
 
 def get_address(region_table: RegionTable, item: GluedItem) -> int:
@@ -466,15 +853,23 @@ def serialise_value(value: Optional[ParsedValue]) -> Union[int, str]:
 
 @force_resolved
 def assign_constants(
-    reference_table: ReferenceTable, region_table: RegionTable, items: Iterable[Union[GluedItem,
-                                                                                      UnresolvedAddressValue]]
+    reference_table: ReferenceTable,
+    region_table: RegionTable,
+    items: Iterable[Union[GluedItem, UnresolvedAddressValue]],
+    variable_addresses: Optional[Set[int]] = None
 ) -> Iterator[Union[GluedItem, UnresolvedAddressValue, UnresolvedAddressConstant, AddressValue]]:
-    """Assign addresses to constants. Mutates region_table and reference_table."""
+    """Assign addresses to constants. Mutates region_table and reference_table.
+
+    Variables declared with `.var` are assigned like constants, and their
+    addresses are added to variable_addresses if given.
+    """
     for item in items:
         # If the item is a directive
-        if isinstance(item, ParsedDirective) and item.name == ".const":
+        if isinstance(item, ParsedDirective) and item.name in (".const", ".var"):
             # Assign the instruction address
             address = get_address(region_table, item)
+            if item.name == ".var" and variable_addresses is not None:
+                variable_addresses.add(address)
 
             # Add labels associated with this instruction to the reference
             # table now that we have an address
@@ -487,12 +882,12 @@ def assign_constants(
             # If value is an unresolved reference
             if isinstance(value, str):
                 # Create an unresolved constant
-                yield UnresolvedAddressConstant(address=address, value=value)
+                yield UnresolvedAddressConstant(address=address, value=value, line=item.line)
 
             # If value is an integer
             elif isinstance(value, int):
                 # Simply store it
-                yield AddressValue(address=address, value=value)
+                yield AddressValue(address=address, value=value, line=item.line)
 
         # If not a directive, passthrough
         else:
@@ -528,12 +923,12 @@ def assign_instructions(
             # If we got a string back, it's a reference
             if isinstance(value, str):
                 # Create an unresolved address value to be resolved later
-                yield UnresolvedAddressValue(address=address, instruction=instruction, data=value)
+                yield UnresolvedAddressValue(address=address, instruction=instruction, data=value, line=item.line)
 
             # If we got an integer back it's a raw value
             elif isinstance(value, int):
                 value = ((instruction << 12) & 0xf000) | (value & 0x0fff)
-                yield AddressValue(address=address, value=value)
+                yield AddressValue(address=address, value=value, line=item.line)
 
             # If it is neither someting has gone very wrong
             else:
@@ -563,6 +958,403 @@ def resolve_references(
         yield item.resolve(reference_table)
 
 
+PeepholeItem = Union[UnresolvedAddressValue, UnresolvedAddressConstant, AddressValue]
+
+ADDRESS_INSTRUCTIONS = {Instruction.JUMP, Instruction.JUMPZ, Instruction.LOAD, Instruction.STORE, Instruction.SFULL}
+FAULTING_INSTRUCTIONS = {Instruction.RESERVED1, Instruction.RESERVED2, Instruction.POP, Instruction.PUSH}
+HOST_INSTRUCTIONS = {Instruction.HALT, Instruction.POP, Instruction.PUSH, Instruction.NOOP}
+TERMINAL_INSTRUCTIONS = {Instruction.HALT, Instruction.JUMP}
+
+
+class WordAnalysis:
+    """How the words of a program with assigned addresses may be used at run time.
+
+    This is conservative around self-modifying code:
+
+    - Words which are LOAD, STORE or SFULL targets are protected.
+    - Addresses used as values, by constants, arithmetic or any protected word,
+      may be offset at run time, so they are protected and words at or after
+      them in their section are never changed.
+    - Sections targeted by literal addresses are frozen, except for the
+      placeholder operands of protected words.
+    - Words are never removed from a section holding an address used as a
+      value, as removing them would move it, nor from a section whose last
+      instruction falls through into the word after it, as that word would
+      become the HALT left behind by compacting.
+    """
+
+    def __init__(self, reference_table: ReferenceTable, region_table: RegionTable, words: Dict[int, PeepholeItem],
+                 constant_addresses: Set[int]):
+        self.reference_table = reference_table
+        self.words = words
+        self.constant_addresses = constant_addresses
+        self.sections = {name: region for name, region in region_table.items() if region.type == "user"}
+        self.section_of = {
+            address: name
+            for name, region in self.sections.items()
+            for address in range(region.start, region.start + region.count)
+        }
+
+        self.protected: Set[int] = set()
+        self.address_taken: Set[int] = set()
+        self.written: Set[int] = set()
+        self.jumped: Set[int] = set()
+        self.frozen: Set[str] = set()
+        protected_count = -1
+        while protected_count != len(self.protected):
+            protected_count = len(self.protected)
+            for address, item in words.items():
+                instruction = self.opcode(item)
+                target = self.operand(item)
+                if target is None:
+                    continue
+                if isinstance(item, AddressValue):
+                    # Literal operands of words changed at run time are placeholders
+                    if address in self.protected:
+                        continue
+                    if target in self.section_of:
+                        self.frozen.add(self.section_of[target])
+                if address in self.protected or instruction not in ADDRESS_INSTRUCTIONS:
+                    self.address_taken.add(target)
+                    self.protected.add(target)
+                elif instruction in (Instruction.LOAD, Instruction.STORE, Instruction.SFULL):
+                    self.protected.add(target)
+                if instruction in (Instruction.STORE, Instruction.SFULL):
+                    self.written.add(target)
+                elif instruction in (Instruction.JUMP, Instruction.JUMPZ):
+                    self.jumped.add(target)
+
+        self.cutoffs = {
+            name: min((address for address in self.address_taken if self.section_of.get(address) == name),
+                      default=region.start + region.count)
+            for name, region in self.sections.items() if name not in self.frozen
+        }
+
+        self.fixed_layout = {self.section_of[address] for address in self.address_taken if address in self.section_of}
+        for name, region in self.sections.items():
+            end = region.start + region.count
+            if region.count and end in words:
+                last = self.opcode(words[end - 1])
+                if end - 1 in self.written or (last is not None and last not in TERMINAL_INSTRUCTIONS):
+                    self.fixed_layout.add(name)
+
+    def opcode(self, item: PeepholeItem) -> Optional[Instruction]:
+        """Get the instruction of a word, or None if it is a constant."""
+        if isinstance(item, UnresolvedAddressConstant) or item.address in self.constant_addresses:
+            return None
+        if isinstance(item, UnresolvedAddressValue):
+            return item.instruction
+        return Instruction(item.value >> 12)
+
+    def operand(self, item: PeepholeItem) -> Optional[int]:
+        """Get the address a word refers to, if any."""
+        if isinstance(item, UnresolvedAddressValue):
+            return self.reference_table.get(item.data)
+        if isinstance(item, UnresolvedAddressConstant):
+            return self.reference_table.get(item.value)
+        if self.opcode(item) in ADDRESS_INSTRUCTIONS:
+            return item.value & 0x0fff
+        return None
+
+    def rewritable(self, address: int) -> bool:
+        """Check if a word may be changed or removed."""
+        return address not in self.protected and address < self.cutoffs.get(self.section_of.get(address, ""), -1)
+
+    def removable(self, address: int) -> bool:
+        """Check if a word may be removed, moving the words after it in its section."""
+        return self.rewritable(address) and self.section_of[address] not in self.fixed_layout
+
+    def compact(self, removed: Set[int]):
+        """Close the gaps left by removed words. Mutates words and the reference and region tables."""
+        for name, region in self.sections.items():
+            section_removed = sorted(address for address in removed if self.section_of[address] == name)
+            if not section_removed:
+                continue
+            end = region.start + region.count - 1
+
+            def relocate(address: int) -> int:
+                return address - bisect_left(section_removed, address) if region.start <= address <= end else address
+
+            for label, address in self.reference_table.items():
+                self.reference_table[label] = relocate(address)
+            for address in range(region.start, end + 1):
+                if address not in removed:
+                    self.words[address] = replace_dataclass(self.words[address], address=relocate(address))
+            region.count -= len(section_removed)
+            region.end -= len(section_removed)
+
+
+@dataclass
+class PeepholeReport:
+    """Counts of the rewrites made by the peephole pass."""
+
+    removed_noops: int = 0
+    folded_immediates: int = 0
+    threaded_jumps: int = 0
+    removed_loads: int = 0
+
+    @property
+    def words_saved(self) -> int:
+        """Get the number of words removed."""
+        return self.removed_noops + self.folded_immediates + self.removed_loads
+
+    @property
+    def cycles_saved(self) -> int:
+        """Get an estimate of the cycles saved, counting each rewritten instruction as executed once."""
+        return self.words_saved + self.threaded_jumps
+
+
+def _fold_immediates(instruction: Instruction, first: int, second: int) -> Optional[int]:
+    if instruction == Instruction.XOR:
+        return first ^ second
+    if instruction == Instruction.AND:
+        return first & second
+    if instruction == Instruction.ADD:
+        return (first + second) & 0x0fff
+    return None
+
+
+def peephole_optimise(reference_table: ReferenceTable,
+                      region_table: RegionTable,
+                      items: Iterable[PeepholeItem],
+                      constant_addresses: Set[int],
+                      report: Optional[PeepholeReport] = None) -> List[PeepholeItem]:
+    """Rewrite redundant instruction sequences, then compact sections. Mutates region_table and reference_table.
+
+    Jumps to unconditional jumps are retargeted, and within a section NOOPs,
+    XOR 0 and AND 0xfff are removed, consecutive XOR, AND or ADD immediates
+    are folded, and a LOAD straight after an SFULL of the same address is
+    removed. Only words which WordAnalysis finds rewritable are changed, and
+    a word is only folded into the one before it if nothing can jump to it.
+
+    Counts of rewrites are added to report if given.
+    """
+    report = report if report is not None else PeepholeReport()
+    items = list(items)
+    words: Dict[int, PeepholeItem] = {item.address: item for item in items}
+    analysis = WordAnalysis(reference_table, region_table, words, constant_addresses)
+    opcode, operand, rewritable = analysis.opcode, analysis.operand, analysis.rewritable
+
+    for address, item in words.items():
+        instruction = opcode(item)
+        if instruction not in (Instruction.JUMP, Instruction.JUMPZ) or instruction is None or not rewritable(address):
+            continue
+        destination = item
+        seen = {address}
+        target = operand(destination)
+        while (target is not None and target not in seen and target not in analysis.protected and target in words
+               and opcode(words[target]) == Instruction.JUMP):
+            seen.add(target)
+            destination = words[target]
+            target = operand(destination)
+        if destination is item:
+            continue
+        if isinstance(destination, UnresolvedAddressValue):
+            words[address] = UnresolvedAddressValue(address=address,
+                                                    instruction=instruction,
+                                                    data=destination.data,
+                                                    line=item.line)
+        elif isinstance(destination, AddressValue):
+            words[address] = AddressValue(address=address,
+                                          value=((instruction << 12) & 0xf000) | (destination.value & 0x0fff),
+                                          line=item.line)
+        report.threaded_jumps += 1
+
+    entry_points = set(reference_table.values())
+    entry_points.update(address + 1 for address, item in words.items() if opcode(item) in FAULTING_INSTRUCTIONS)
+
+    removed: Set[int] = set()
+    for region in analysis.sections.values():
+        end = region.start + region.count - 1
+        previous: Optional[int] = None
+        for address in range(region.start, end + 1):
+            item = words[address]
+            instruction = opcode(item)
+            if address < end and analysis.removable(address):
+                literal = item.value & 0x0fff if isinstance(item, AddressValue) else None
+                if instruction == Instruction.NOOP or (instruction, literal) in ((Instruction.XOR, 0x000),
+                                                                                 (Instruction.AND, 0xfff)):
+                    if address in entry_points:
+                        entry_points.add(address + 1)
+                    removed.add(address)
+                    report.removed_noops += 1
+                    continue
+
+                if previous is not None and rewritable(previous) and address not in entry_points:
+                    before = words[previous]
+                    if (isinstance(before, AddressValue) and instruction is not None and literal is not None
+                            and opcode(before) == instruction):
+                        folded = _fold_immediates(instruction, before.value & 0x0fff, literal)
+                        if folded is not None:
+                            words[previous] = AddressValue(address=previous,
+                                                           value=(before.value & 0xf000) | folded,
+                                                           line=before.line)
+                            removed.add(address)
+                            report.folded_immediates += 1
+                            continue
+                    if (opcode(before) == Instruction.SFULL and instruction == Instruction.LOAD
+                            and operand(before) is not None and operand(before) == operand(item)):
+                        removed.add(address)
+                        report.removed_loads += 1
+                        continue
+            previous = address if instruction is not None else None
+
+    analysis.compact(removed)
+    return [words[item.address] for item in items if item.address not in removed]
+
+
+@dataclass
+class ConstantPoolReport:
+    """Counts of the constants removed by constant pool packing."""
+
+    merged_constants: int = 0
+    packed_constants: int = 0
+
+    @property
+    def words_saved(self) -> int:
+        """Get the number of words removed."""
+        return self.merged_constants + self.packed_constants
+
+
+def pack_constants(reference_table: ReferenceTable,
+                   region_table: RegionTable,
+                   items: Iterable[PeepholeItem],
+                   constant_addresses: Set[int],
+                   variable_addresses: Set[int],
+                   report: Optional[ConstantPoolReport] = None) -> List[PeepholeItem]:
+    """Merge duplicate constants and pack constants into unused operands. Mutates region_table and reference_table.
+
+    A constant is read-only if it is not a `.var`, is never written and is
+    not at or after an address used as a value. A read-only constant which
+    is labelled, only read through its labels, never jumped to, not
+    executed by falling through from an instruction and in a section
+    WordAnalysis lets words be removed from is movable. Each movable
+    constant is merged into another read-only constant with the same
+    value, or else packed into the operand of a HALT, POP, PUSH or NOOP whose
+    opcode matches its upper nibble and whose operand is zero, and its
+    labels are pointed at the new location. Sections are then compacted.
+
+    Counts of removed constants are added to report if given.
+    """
+    report = report if report is not None else ConstantPoolReport()
+    items = list(items)
+    words: Dict[int, PeepholeItem] = {item.address: item for item in items}
+    analysis = WordAnalysis(reference_table, region_table, words, constant_addresses | variable_addresses)
+    labelled = set(reference_table.values())
+
+    def constant_key(item: Union[UnresolvedAddressConstant, AddressValue]) -> Tuple[str, Union[int, str]]:
+        if isinstance(item, UnresolvedAddressConstant):
+            return ("reference", item.value)
+        return ("integer", item.value & 0xffff)
+
+    def read_only(address: int) -> bool:
+        return (address not in variable_addresses and address not in analysis.written
+                and address < analysis.cutoffs.get(analysis.section_of.get(address, ""), -1))
+
+    def movable(address: int) -> bool:
+        if not (read_only(address) and address in labelled and address not in analysis.address_taken
+                and address not in analysis.jumped and analysis.section_of[address] not in analysis.fixed_layout):
+            return False
+        before = words.get(address - 1)
+        return (analysis.section_of.get(address - 1) != analysis.section_of[address] or before is None
+                or analysis.opcode(before) in (None, Instruction.HALT, Instruction.JUMP))
+
+    hosts = [
+        address for address, item in sorted(words.items())
+        if isinstance(item, AddressValue) and analysis.opcode(item) in HOST_INSTRUCTIONS and item.value & 0x0fff == 0
+        and analysis.rewritable(address)
+    ]
+
+    constants = {
+        address: item
+        for address, item in sorted(words.items())
+        if address in constant_addresses and address in analysis.section_of
+        and isinstance(item, (UnresolvedAddressConstant, AddressValue))
+    }
+    canonical: Dict[Tuple[str, Union[int, str]], int] = {}
+    for address, item in constants.items():
+        if read_only(address) and not movable(address):
+            canonical.setdefault(constant_key(item), address)
+
+    removed: Set[int] = set()
+    for address, item in constants.items():
+        if not movable(address):
+            continue
+        key = constant_key(item)
+        if key in canonical:
+            destination = canonical[key]
+            report.merged_constants += 1
+        else:
+            nibble = 0 if isinstance(item, UnresolvedAddressConstant) else (item.value >> 12) & 0xf
+            host = next((host for host in hosts if analysis.opcode(words[host]) == nibble), None)
+            if host is None:
+                canonical[key] = address
+                continue
+            hosts.remove(host)
+            if isinstance(item, UnresolvedAddressConstant):
+                words[host] = UnresolvedAddressValue(address=host,
+                                                     instruction=Instruction.HALT,
+                                                     data=item.value,
+                                                     line=words[host].line)
+            else:
+                words[host] = AddressValue(address=host, value=item.value & 0xffff, line=words[host].line)
+            canonical[key] = destination = host
+            report.packed_constants += 1
+        for label, label_address in reference_table.items():
+            if label_address == address:
+                reference_table[label] = destination
+        removed.add(address)
+
+    analysis.compact(removed)
+    return [words[item.address] for item in items if item.address not in removed]
+
+
+class SymbolIndex:
+    """An index from addresses to the regions and labels covering them.
+
+    Built once from a reference table and region table, after which every
+    lookup is a bisect or a dictionary access. All labels at an address are
+    kept, so aliases are never lost.
+    """
+
+    def __init__(self, reference_table: ReferenceTable, region_table: RegionTable):
+        regions = sorted(region_table.items(), key=lambda x: (x[1].start, x[1].end))
+        self.region_starts = [region.start for _, region in regions]
+        self.region_ends = [region.end for _, region in regions]
+        self.region_names = [name for name, _ in regions]
+
+        # Labels are sorted as those sharing an instruction come from a set
+        self.labels: Dict[int, List[str]] = {}
+        for name, address in sorted(reference_table.items()):
+            self.labels.setdefault(address, []).append(name)
+        self.label_addresses = sorted(self.labels)
+        self.label_texts = {address: ", ".join(names) for address, names in self.labels.items()}
+        self.max_label_text_length = max(map(len, self.label_texts.values()), default=0)
+
+    def region(self, address: int) -> str:
+        """Get the name of the region containing an address, or any if none does."""
+        index = bisect_right(self.region_starts, address) - 1
+        if index >= 0 and self.region_ends[index] >= address:
+            return self.region_names[index]
+        return "any"
+
+    def labels_at(self, address: int) -> List[str]:
+        """Get every label at an address."""
+        return self.labels.get(address, [])
+
+    def label_text(self, address: int) -> str:
+        """Get every label at an address joined into a single string."""
+        return self.label_texts.get(address, "")
+
+    def nearest_label(self, address: int) -> Optional[Tuple[str, int]]:
+        """Get the closest label at or before an address and the offset from it."""
+        index = bisect_right(self.label_addresses, address) - 1
+        if index < 0:
+            return None
+        label_address = self.label_addresses[index]
+        return self.labels[label_address][0], address - label_address
+
+
 def serialise_to_c_file(reference_table: ReferenceTable, region_table: RegionTable,
                         resolved_items: Iterable[AddressValue]) -> bytes:
     """Serialise to a C source file."""
@@ -618,16 +1410,41 @@ def serialise_to_text_file(reference_table: ReferenceTable, region_table: Region
     return "\n".join(lines).encode("ascii")
 
 
-def serialise_to_debug_file(reference_table: ReferenceTable, region_table: RegionTable,
+def serialise_to_image_file(reference_table: ReferenceTable, region_table: RegionTable,
                             resolved_items: Iterable[AddressValue]) -> bytes:
-    """Serialise to a debug file."""
+    """Serialise to a memory file holding a dense memory image.
+
+    The image covers memory up to the highest used address, so sma16vm.c can
+    copy it into memory in one go rather than loading it word by word.
+    """
+    memory = _dense_memory(resolved_items)
     lines = []
 
-    def _get_region_name(address):
-        for region_name, region_properties in region_table.items():
-            if region_properties.start <= address <= region_properties.end:
-                return region_name
-        return "any"
+    lines.append("/* GENERATED from sma16asm.py")
+    lines.append(" *")
+    lines.append(" * Regions:")
+    for region_name, region_properties in sorted(region_table.items(), key=lambda x: x[1].start):
+        lines.append(" *   - {} from 0x{:03x} to 0x{:03x}".format(region_name, region_properties.start,
+                                                                  region_properties.end))
+    lines.append(" */")
+
+    lines.append("#define MEMORY_IMAGE_WORDS 0x{:03x}".format(len(memory)))
+    lines.append("static const uint16_t MEMORY_IMAGE[MEMORY_IMAGE_WORDS] = {")
+    for line_start in range(0, len(memory), 8):
+        lines.append("    " + " ".join("0x{:04x},".format(value) for value in memory[line_start:line_start + 8]))
+    lines.append("};")
+
+    return "\n".join(lines).encode("ascii")
+
+
+def serialise_to_debug_file(reference_table: ReferenceTable,
+                            region_table: RegionTable,
+                            resolved_items: Iterable[AddressValue],
+                            annotations: Optional[Dict[int, str]] = None) -> bytes:
+    """Serialise to a debug file, appending any annotation given for an address to its line."""
+    lines = []
+
+    symbol_index = SymbolIndex(reference_table, region_table)
 
     lines.append("/* GENERATED from sma16asm.py")
     lines.append(" *")
@@ -641,15 +1458,13 @@ def serialise_to_debug_file(reference_table: ReferenceTable, region_table: Regio
         lines.append(" *   - 0x{:03x} -> {} ".format(reference_address, reference_name))
     lines.append(" */")
 
-    reverse_reference_table = dict((v, k) for k, v in reference_table.items())
-
     lines.append("=== START MEMORY ===")
     current_section = ""
-    max_reference_name_length = max(map(len, reference_table.keys()))
+    max_reference_name_length = symbol_index.max_label_text_length
     debug_format = "0x{{:03x}} ({{:{}s}}) -> 0x{{:x}} ({{:5s}}), 0x{{:03x}} ({{:{}s}})".format(
         max_reference_name_length, max_reference_name_length)
     for item in resolved_items:
-        section = _get_region_name(item.address)
+        section = symbol_index.region(item.address)
         if section != current_section:
             current_section = section
             lines.append("--- {} ---".format(current_section))
@@ -658,134 +1473,1323 @@ def serialise_to_debug_file(reference_table: ReferenceTable, region_table: Regio
         lines.append(
             debug_format.format(
                 item.address,
-                reverse_reference_table[item.address] if item.address in reverse_reference_table else "",
+                symbol_index.label_text(item.address),
                 instruction_code,
                 Instruction(instruction_code).name,
                 data_value,
-                reverse_reference_table[data_value] if data_value in reverse_reference_table else "",
-            ))
+                symbol_index.label_text(data_value),
+            ) + (annotations.get(item.address, "") if annotations else ""))
     lines.append("===  END MEMORY  ===")
 
     return "\n".join(lines).encode("ascii")
 
 
-def serialise_to_bin_file(resolved_items: Iterable[AddressValue]) -> bytes:
-    """Serialise to a memory image file."""
-    resolved_items = list(resolved_items)
-
-    memory: Dict[int, int] = {key: 0 for key in range(max(map(lambda x: x.address, resolved_items)))}
+def serialise_to_map_file(reference_table: ReferenceTable, region_table: RegionTable,
+                          resolved_items: Iterable[AddressValue]) -> bytes:
+    """Serialise to a machine-readable JSON symbol and source map.
 
+    Addresses are keyed by their hexadecimal form, each giving the value, the
+    source line, the section, every label and any reference resolved there.
+    """
+    symbol_index = SymbolIndex(reference_table, region_table)
+
+    address_map = {
+        "0x{:03x}".format(item.address): {
+            "value": item.value,
+            "line": item.line,
+            "section": symbol_index.region(item.address),
+            "labels": symbol_index.labels_at(item.address),
+            "reference": item.reference,
+        }
+        for item in sorted(resolved_items, key=lambda x: x.address)
+    }
+
+    source_map = {
+        "version": ASSEMBLER_VERSION,
+        "regions": {
+            name: {
+                "type": region.type,
+                "start": region.start,
+                "end": region.end
+            }
+            for name, region in sorted(region_table.items(), key=lambda x: x[1].start)
+        },
+        "symbols": dict(sorted(reference_table.items(), key=lambda x: (x[1], x[0]))),
+        "addresses": address_map,
+    }
+
+    return json_dumps(source_map, separators=(",", ":")).encode("ascii")
+
+
+def _dense_memory(resolved_items: Iterable[AddressValue]) -> List[int]:
+    """Get memory from address zero up to the highest used address, with unused addresses zeroed."""
+    resolved_items = list(resolved_items)
+    memory = [0] * (max(item.address for item in resolved_items) + 1)
     for item in resolved_items:
         memory[item.address] = item.value
+    return memory
 
-    memory_bytes = b""
-    for _, value in memory.items():
-        memory_bytes += struct_pack(">H", value)
 
-    return memory_bytes
+def serialise_to_bin_file(resolved_items: Iterable[AddressValue]) -> bytes:
+    """Serialise to a memory image file."""
+    memory = _dense_memory(resolved_items)
+    return struct_pack(">{}H".format(len(memory)), *memory)
 
 
 def serialise_to_hex_file(resolved_items: Iterable[AddressValue]) -> bytes:
     """Serialise to a hex file."""
-    resolved_items = list(resolved_items)
+    memory = _dense_memory(resolved_items)
+    hex_words = ["{:04x}".format(value) for value in memory]
+    return "".join("".join(hex_words[line_start:line_start + 8]) + ("\n" if line_start + 8 <= len(memory) else "")
+                   for line_start in range(0, len(memory), 8)).encode("ascii")
 
-    memory: Dict[int, int] = {key: 0 for key in range(max(map(lambda x: x.address, resolved_items)))}
 
-    for item in resolved_items:
-        memory[item.address] = item.value
+SEGMENT_IMAGE_MAGIC = b"S16S"
 
-    memory_bytes = b""
-    for address, value in memory.items():
-        memory_bytes += "{:04x}".format(value).encode("ascii")
-        if address % 8 == 7:
-            memory_bytes += b"\n"
+# Gaps of up to this many words are cheaper to fill with zeros than to start a new segment
+SEGMENT_GAP_WORDS = 2
 
-    return memory_bytes
 
+def get_segments(resolved_items: Iterable[AddressValue]) -> List[Tuple[int, List[int]]]:
+    """Get runs of occupied memory as (start, words) pairs, in address order."""
+    memory = {item.address: item.value for item in resolved_items}
+    segments: List[Tuple[int, List[int]]] = []
+    for address in sorted(memory):
+        if segments:
+            start, words = segments[-1]
+            gap = address - start - len(words)
+            if gap <= SEGMENT_GAP_WORDS:
+                words.extend([0] * gap)
+                words.append(memory[address])
+                continue
+        segments.append((address, [memory[address]]))
+    return segments
 
-def assemble_file(file_path: str, output_file: str, output_format: str = "text"):
-    """Assemble a file."""
-    parsed_lines = parse_lines(file_path)
 
-    glued_items = glue_labels_and_sections(parsed_lines)
+def serialise_to_segment_file(resolved_items: Iterable[AddressValue]) -> bytes:
+    """Serialise to a sparse memory image file.
 
-    reference_table: ReferenceTable = {}
-    reference_table.update(CONSTANTS)
+    The image is SEGMENT_IMAGE_MAGIC and a segment count, followed by each
+    segment's start address, length and words, all as big endian 16 bit
+    values. Unlike a memory image, unused memory between segments is not
+    stored.
+    """
+    segments = get_segments(resolved_items)
+    image = bytearray(len(SEGMENT_IMAGE_MAGIC) + 2 + sum(4 + 2 * len(words) for _, words in segments))
+    image[:len(SEGMENT_IMAGE_MAGIC)] = SEGMENT_IMAGE_MAGIC
+    offset = len(SEGMENT_IMAGE_MAGIC)
+    struct_pack_into(">H", image, offset, len(segments))
+    offset += 2
+    for start, words in segments:
+        struct_pack_into(">HH{}H".format(len(words)), image, offset, start, len(words), *words)
+        offset += 4 + 2 * len(words)
+    return bytes(image)
+
+
+def serialise_items(reference_table: ReferenceTable, region_table: RegionTable, resolved_items: List[AddressValue],
+                    output_format: str) -> bytes:
+    """Serialise resolved address values in an output format."""
+    if output_format == "bin":
+        return serialise_to_bin_file(resolved_items)
+    if output_format == "hex":
+        return serialise_to_hex_file(resolved_items)
+    if output_format == "segment":
+        return serialise_to_segment_file(resolved_items)
+    if output_format == "c":
+        return serialise_to_c_file(reference_table, region_table, resolved_items)
+    if output_format == "debug":
+        return serialise_to_debug_file(reference_table, region_table, resolved_items)
+    if output_format == "map":
+        return serialise_to_map_file(reference_table, region_table, resolved_items)
+    if output_format == "image":
+        return serialise_to_image_file(reference_table, region_table, resolved_items)
+    return serialise_to_text_file(reference_table, region_table, resolved_items)
 
-    region_table: RegionTable = {}
-    region_table.update(REGIONS)
 
-    items_with_vectors_assigned = assign_vectors(glued_items)
+@dataclass
+class AssembledImage:
+    """An assembled program, serialised to bytes on demand."""
 
-    sections = get_section_sizes(items_with_vectors_assigned)
-    if sum(sections.values()) >= 2**12 - 16:
-        raise AssemblyError("memory full")
+    reference_table: ReferenceTable
+    region_table: RegionTable
+    words: List[AddressValue]
+    peephole_report: Optional[PeepholeReport] = None
+    constant_pool_report: Optional[ConstantPoolReport] = None
 
-    assign_sections(region_table, sections)
+    def serialise(self, output_format: str = "text") -> bytes:
+        """Serialise the image in an output format."""
+        return serialise_items(self.reference_table, self.region_table, self.words, output_format)
 
-    partially_unresolved_items = assign_constants(reference_table, region_table, items_with_vectors_assigned)
-    unresolved_items = assign_instructions(reference_table, region_table, partially_unresolved_items)
-    resolved_items = resolve_references(reference_table, unresolved_items)
+    def analyse(self) -> "ControlFlowAnalysis":
+        """Analyse the image's control flow."""
+        # Imported here as sma16cfg imports this module
+        from sma16cfg import analyse_control_flow  # pylint: disable=import-outside-toplevel
+        return analyse_control_flow(self.words)
 
-    if output_format == "bin":
-        output_bytes = serialise_to_bin_file(resolved_items)
-    elif output_format == "hex":
-        output_bytes = serialise_to_hex_file(resolved_items)
-    elif output_format == "c":
-        output_bytes = serialise_to_c_file(reference_table, region_table, resolved_items)
-    elif output_format == "debug":
-        output_bytes = serialise_to_debug_file(reference_table, region_table, resolved_items)
-    else:
-        output_bytes = serialise_to_text_file(reference_table, region_table, resolved_items)
+
+@dataclass
+class StageStatistics:
+    """Measurements of a single assembler stage.
+
+    Peak memory is None unless memory was traced.
+    """
+
+    stage: str
+    seconds: float
+    peak_memory: Optional[int]
+    items_in: int
+    items_out: int
+
+
+StageHook = Callable[[StageStatistics], None]
+
+
+def run_stage(stage_hook: StageHook,
+              stage: str,
+              items: Any,
+              function: Callable[..., Any],
+              *args: Any,
+              trace_memory: bool = False) -> Any:
+    """Run a stage to completion, passing its measurements to stage_hook.
+
+    Generator stages are collected into a list so that their work is counted
+    here rather than in the stage which consumes them. If trace_memory is
+    set, peak memory is the most allocated during the stage, beyond what was
+    allocated before it. Tracing slows every allocation, and so distorts the
+    time, which is why it is off unless asked for.
+    """
+    started_tracing = False
+    if trace_memory:
+        started_tracing = not is_tracing()
+        if started_tracing:
+            start_tracing()
+        reset_peak()
+        memory_before = get_traced_memory()[0]
+    start = perf_counter()
+
+    result = function(*args)
+    if isinstance(result, Iterator):
+        result = list(result)
+
+    seconds = perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = get_traced_memory()[1] - memory_before
+    if started_tracing:
+        stop_tracing()
+
+    items_in = len(items) if isinstance(items, Sized) else 0
+    items_out = len(result) if isinstance(result, Sized) else items_in
+    stage_hook(
+        StageStatistics(stage=stage, seconds=seconds, peak_memory=peak_memory, items_in=items_in, items_out=items_out))
+    return result
+
+
+def format_stage_table(statistics: List[StageStatistics]) -> str:
+    """Format stage measurements as a table."""
+    lines = ["{:<26} {:>12} {:>14} {:>10} {:>10}".format("stage", "time (ms)", "peak memory (B)", "items in",
+                                                          "items out")]
+    for stage_statistics in statistics:
+        peak_memory = "-" if stage_statistics.peak_memory is None else str(stage_statistics.peak_memory)
+        lines.append("{:<26} {:12.3f} {:>14} {:10d} {:10d}".format(stage_statistics.stage,
+                                                                   stage_statistics.seconds * 1000,
+                                                                   peak_memory,
+                                                                   stage_statistics.items_in,
+                                                                   stage_statistics.items_out))
+    lines.append("{:<26} {:12.3f}".format("total", sum(stage_statistics.seconds for stage_statistics in statistics) *
+                                          1000))
+    return "\n".join(lines)
+
+
+OBJECT_SECTION_BASE = 0x1000
+
+
+@dataclass
+class Relocation:
+    """A reference in an object module, patched with the referenced address when linked.
+
+    Relocations outside any section, such as vectors, have no section and an
+    absolute offset. Relocations of constants have no instruction.
+    """
+
+    section: Optional[str]
+    offset: int
+    symbol: str
+    instruction: Optional[Instruction] = None
+    line: int = 0
+
+
+@dataclass
+class ObjectSection:
+    """The words of a section in an object module, with any pinned address."""
+
+    words: List[int]
+    lines: List[int]
+    address: Optional[int] = None
+
+
+@dataclass
+class ObjectModule:
+    """A relocatable object module, as stored in a .o16 file.
+
+    Labels map to a section and an offset within it. Only exported labels are
+    visible to other modules.
+    """
+
+    name: str
+    sections: Dict[str, ObjectSection]
+    labels: Dict[str, Tuple[str, int]]
+    exports: List[str]
+    relocations: List[Relocation]
+
+    def serialise(self) -> bytes:
+        """Serialise the module as JSON."""
+        return json_dumps(
+            {
+                "format": "sma16-object",
+                "version": ASSEMBLER_VERSION,
+                "name": self.name,
+                "sections": {name: asdict(section)
+                             for name, section in self.sections.items()},
+                "labels": self.labels,
+                "exports": self.exports,
+                "relocations": [asdict(relocation) for relocation in self.relocations],
+            },
+            separators=(",", ":")).encode("ascii")
+
+    @classmethod
+    def load(cls, object_bytes: bytes) -> "ObjectModule":
+        """Load a module serialised with serialise."""
+        try:
+            module = json_loads(object_bytes)
+        except ValueError:
+            module = None
+        if not isinstance(module, dict) or module.get("format") != "sma16-object":
+            raise AssemblyError("not an SMA16 object file")
+        if module["version"] != ASSEMBLER_VERSION:
+            raise AssemblyError("object file {} is from assembler version {}".format(module["name"],
+                                                                                    module["version"]))
+        return cls(name=module["name"],
+                   sections={name: ObjectSection(**section)
+                             for name, section in module["sections"].items()},
+                   labels={label: (section, offset)
+                           for label, (section, offset) in module["labels"].items()},
+                   exports=module["exports"],
+                   relocations=[
+                       Relocation(**{
+                           **relocation, "instruction":
+                           None if relocation["instruction"] is None else Instruction(relocation["instruction"])
+                       }) for relocation in module["relocations"]
+                   ])
+
+
+class Assembler:
+    """A reusable assembler.
+
+    The base reference and region tables are built once, and each assembly
+    starts from a copy of them. If a stage_hook is given, every stage is run
+    to completion in turn and its measurements are passed to the hook, with
+    peak memory only if trace_memory is set. If optimise is set, the
+    peephole pass is run before references are resolved, followed by
+    constant pool packing if pack_constants is set.
+    """
+
+    def __init__(self,
+                 constants: Optional[ReferenceTable] = None,
+                 regions: Optional[RegionTable] = None,
+                 stage_hook: Optional[StageHook] = None,
+                 optimise: bool = False,
+                 pack_constants: bool = False,
+                 trace_memory: bool = False):
+        self.reference_table: ReferenceTable = dict(CONSTANTS if constants is None else constants)
+        self.region_table: RegionTable = dict(REGIONS if regions is None else regions)
+        self.stage_hook = stage_hook
+        self.optimise = optimise
+        self.pack_constants = pack_constants
+        self.trace_memory = trace_memory
+
+    def _stage(self, stage: str, items: Any, function: Callable[..., Any], *args: Any) -> Any:
+        if self.stage_hook is None:
+            return function(*args)
+        return run_stage(self.stage_hook, stage, items, function, *args, trace_memory=self.trace_memory)
+
+    def prepare_lines(
+        self,
+        lines: Iterable[str],
+        exported_labels: Optional[List[str]] = None
+    ) -> Tuple[List[Union[GluedItem, UnresolvedAddressValue]], Dict[str, int]]:
+        """Run the stages before layout, returning the items with vectors assigned and any pinned sections.
+
+        Labels named by `.global` are added to exported_labels if given.
+        """
+        if self.stage_hook is not None:
+            lines = list(lines)
+        parsed_lines = self._stage("parse_lines", lines, parse_text_lines, lines)
+
+        section_addresses: Dict[str, int] = {}
+        glued_items = self._stage("glue_labels_and_sections", parsed_lines, glue_labels_and_sections, parsed_lines,
+                                  section_addresses, exported_labels)
+        glued_items = self._stage("expand_stack_directives", glued_items, expand_stack_directives, glued_items,
+                                  section_addresses)
+
+        return self._stage("assign_vectors", glued_items, assign_vectors, glued_items), section_addresses
+
+    def assemble_prepared(self, items_with_vectors_assigned: List[Union[GluedItem, UnresolvedAddressValue]],
+                          section_addresses: Dict[str, int]) -> AssembledImage:
+        """Run the layout and resolution stages on items from prepare_lines."""
+        reference_table = dict(self.reference_table)
+        region_table = {name: replace_dataclass(region) for name, region in self.region_table.items()}
+
+        sections = self._stage("get_section_sizes", items_with_vectors_assigned, get_section_sizes,
+                               items_with_vectors_assigned)
+        if sum(sections.values()) >= 2**12 - 16:
+            raise AssemblyError("memory full")
+
+        self._stage("assign_sections", sections, assign_sections, region_table, sections, section_addresses)
+
+        variable_addresses: Set[int] = set()
+        partially_unresolved_items = self._stage("assign_constants", items_with_vectors_assigned, assign_constants,
+                                                 reference_table, region_table, items_with_vectors_assigned,
+                                                 variable_addresses)
+        unresolved_items = self._stage("assign_instructions", partially_unresolved_items, assign_instructions,
+                                       reference_table, region_table, partially_unresolved_items)
+
+        constant_addresses = {
+            item.address
+            for item in partially_unresolved_items
+            if isinstance(item, (AddressValue, UnresolvedAddressConstant))
+        }
+
+        peephole_report = None
+        if self.optimise:
+            peephole_report = PeepholeReport()
+            unresolved_items = self._stage("peephole_optimise", unresolved_items, peephole_optimise, reference_table,
+                                           region_table, unresolved_items, constant_addresses, peephole_report)
+
+        constant_pool_report = None
+        if self.pack_constants:
+            constant_pool_report = ConstantPoolReport()
+            unresolved_items = self._stage("pack_constants", unresolved_items, pack_constants, reference_table,
+                                           region_table, unresolved_items, constant_addresses, variable_addresses,
+                                           constant_pool_report)
+
+        resolved_items = list(
+            self._stage("resolve_references", unresolved_items, resolve_references, reference_table, unresolved_items))
+
+        return AssembledImage(reference_table=reference_table,
+                              region_table=region_table,
+                              words=resolved_items,
+                              peephole_report=peephole_report,
+                              constant_pool_report=constant_pool_report)
+
+    def assemble_lines(self, lines: Iterable[str]) -> AssembledImage:
+        """Assemble lines of source text."""
+        return self.assemble_prepared(*self.prepare_lines(lines))
+
+    def assemble_text(self, text: str) -> AssembledImage:
+        """Assemble source text."""
+        return self.assemble_lines(text.splitlines())
+
+    def assemble_path(self, file_path: str) -> AssembledImage:
+        """Assemble a source file."""
+        return self.assemble_lines(get_file_lines(file_path))
+
+    def serialise(self, image: AssembledImage, output_format: str = "text") -> bytes:
+        """Serialise an assembled image in an output format, as the final stage."""
+        return self._stage("serialise_to_{}_file".format(output_format), image.words, image.serialise, output_format)
+
+    def assemble_object(self, lines: Iterable[str], name: str) -> ObjectModule:
+        """Assemble lines of source text into a relocatable object module.
+
+        Sections are laid out one after another from OBJECT_SECTION_BASE, so
+        that every label falls in exactly one section, and references are
+        recorded as relocations rather than resolved.
+        """
+        exports: List[str] = []
+        items, section_addresses = self.prepare_lines(lines, exports)
+
+        region_table: RegionTable = {}
+        base = OBJECT_SECTION_BASE
+        for section_name, size in self._stage("get_section_sizes", items, get_section_sizes, items).items():
+            region_table[section_name] = Region(type="user", start=base, end=base + size - 1, count=0)
+            base += size
+        section_starts = sorted((region.start, section_name) for section_name, region in region_table.items())
+
+        def locate(address: int) -> Tuple[str, int]:
+            start, section_name = section_starts[bisect_right(section_starts, (address, "\uffff")) - 1]
+            return section_name, address - start
+
+        reference_table = dict(self.reference_table)
+        partially_unresolved_items = self._stage("assign_constants", items, assign_constants, reference_table,
+                                                 region_table, items)
+        unresolved_items = self._stage("assign_instructions", partially_unresolved_items, assign_instructions,
+                                       reference_table, region_table, partially_unresolved_items)
+
+        sections = {
+            section_name: ObjectSection(words=[0] * region.count,
+                                        lines=[0] * region.count,
+                                        address=section_addresses.get(section_name))
+            for section_name, region in region_table.items()
+        }
+        relocations = []
+        for item in unresolved_items:
+            if item.address < OBJECT_SECTION_BASE:
+                section_name, offset = None, item.address
+            else:
+                section_name, offset = locate(item.address)
+                sections[section_name].lines[offset] = item.line
+            if isinstance(item, AddressValue):
+                sections[section_name].words[offset] = item.value & 0xffff
+            elif isinstance(item, UnresolvedAddressValue):
+                if section_name is not None:
+                    sections[section_name].words[offset] = (item.instruction << 12) & 0xf000
+                relocations.append(Relocation(section_name, offset, item.data, item.instruction, item.line))
+            else:
+                relocations.append(Relocation(section_name, offset, item.value, None, item.line))
+
+        labels = {
+            label: locate(address)
+            for label, address in reference_table.items() if address >= OBJECT_SECTION_BASE
+        }
+        for label in exports:
+            if label not in labels:
+                raise AssemblyError("exported label {} is not defined{}".format(label,
+                                                                                did_you_mean(label, reference_table)))
+
+        return ObjectModule(name=name, sections=sections, labels=labels, exports=exports, relocations=relocations)
+
+    def link(self, modules: Iterable[ObjectModule]) -> AssembledImage:
+        """Link object modules into an image.
+
+        Sections with the same name are concatenated in module order and placed
+        by assign_sections. References resolve to the module's own labels, then
+        to labels exported by any module, then to the base reference table.
+        """
+        modules = list(modules)
+        return self._stage("link", modules, self._link, modules)
+
+    def _link(self, modules: List[ObjectModule]) -> AssembledImage:
+        sections: Dict[str, int] = {}
+        section_addresses: Dict[str, int] = {}
+        module_offsets: List[Dict[str, int]] = []
+        exported: Dict[str, int] = {}
+        for index, module in enumerate(modules):
+            offsets = {}
+            for section_name, section in module.sections.items():
+                offsets[section_name] = sections.get(section_name, 0)
+                sections[section_name] = offsets[section_name] + len(section.words)
+                if section.address is not None:
+                    if section_addresses.get(section_name, section.address) != section.address:
+                        raise AssemblyError("section {} pinned to a second address in module {}".format(
+                            section_name, module.name))
+                    section_addresses[section_name] = section.address
+            module_offsets.append(offsets)
+            for label in module.exports:
+                if label in exported:
+                    raise AssemblyError("label {} exported by both {} and {}".format(
+                        label, modules[exported[label]].name, module.name))
+                exported[label] = index
+
+        if sum(sections.values()) >= 2**12 - 16:
+            raise AssemblyError("memory full")
+
+        region_table = {name: replace_dataclass(region) for name, region in self.region_table.items()}
+        assign_sections(region_table, sections, section_addresses)
+        for section_name, size in sections.items():
+            region_table[section_name].count = size
+
+        def label_address(index: int, label: str) -> int:
+            section_name, offset = modules[index].labels[label]
+            return region_table[section_name].start + module_offsets[index][section_name] + offset
+
+        reference_table = dict(self.reference_table)
+        reference_table.update((label, label_address(index, label)) for label, index in exported.items())
+
+        words: Dict[int, AddressValue] = {}
+        word_order: Dict[int, Tuple[int, ...]] = {}
+        for index, module in enumerate(modules):
+            for section_name, section in module.sections.items():
+                start = region_table[section_name].start + module_offsets[index][section_name]
+                for offset, (value, line) in enumerate(zip(section.words, section.lines)):
+                    words[start + offset] = AddressValue(address=start + offset, value=value, line=line)
+                    word_order[start + offset] = (index, *_generated_order(section_name, offset, len(section.words)),
+                                                  line, start + offset)
+
+            for relocation in module.relocations:
+                if relocation.symbol in module.labels:
+                    target = label_address(index, relocation.symbol)
+                elif relocation.symbol in reference_table:
+                    target = reference_table[relocation.symbol]
+                else:
+                    raise AssemblyError("reference to undefined location {} in module {}{}".format(
+                        relocation.symbol, module.name, did_you_mean(relocation.symbol, reference_table)))
+
+                address = relocation.offset
+                if relocation.section is not None:
+                    address += region_table[relocation.section].start + module_offsets[index][relocation.section]
+                elif address in words:
+                    raise AssemblyError("address 0x{:03x} assigned by module {} is already in use".format(
+                        address, module.name))
+
+                value = target
+                if relocation.instruction is not None:
+                    value = (target & 0x0fff) | ((relocation.instruction << 12) & 0xf000)
+                words[address] = AddressValue(address=address,
+                                              value=value,
+                                              line=relocation.line,
+                                              reference=relocation.symbol)
+                if relocation.section is None:
+                    generated = relocation.symbol == "__stack_handler"
+                    word_order[address] = (index, int(generated), 0, 0, relocation.line, address)
+
+        for index, module in enumerate(modules):
+            for label in module.labels:
+                if exported.get(label) != index:
+                    qualified = label if label not in reference_table else "{}.{}".format(module.name, label)
+                    reference_table[qualified] = label_address(index, label)
+
+        # Keep words in module and source order, as a single module would be assembled
+        return AssembledImage(reference_table=reference_table,
+                              region_table=region_table,
+                              words=sorted(words.values(), key=lambda word: word_order[word.address]))
+
+
+def _generated_order(section_name: str, offset: int, size: int) -> Tuple[int, int, int]:
+    """Order words generated by .stack after the module's own words, in the order they were generated.
+
+    The generated fault vector comes first, then the stack, then the handler's
+    instructions followed by its constants.
+    """
+    if section_name == STACK_SECTION:
+        return 1, 1, offset
+    if section_name == STACK_HANDLER_SECTION:
+        return 1, 2, (offset - STACK_HANDLER_CONSTANTS) % size
+    return 0, 0, 0
+
+
+DEFAULT_ASSEMBLER = Assembler()
+
+
+def _item_layout(item: Union[GluedItem, UnresolvedAddressValue]) -> Tuple[Optional[str], bool, Tuple[str, ...]]:
+    if isinstance(item, UnresolvedAddressValue):
+        return None, False, ()
+    # Constants are placed before a section's instructions, so swapping the two moves labels
+    is_constant = isinstance(item, ParsedDirective) and item.name in (".const", ".var")
+    return item.section, is_constant, tuple(sorted(item.labels))
+
+
+class IncrementalBuild:
+    """Assembler state kept between rebuilds of the same source.
+
+    If a rebuild leaves every section's size, position and labels unchanged,
+    and every labelled item is still a constant or an instruction as before,
+    only the sections containing changed items are assigned addresses and
+    resolved again, reusing the previous layout and reference table. Any
+    other change falls back to a full build.
+    """
+
+    def __init__(self, assembler: Assembler = DEFAULT_ASSEMBLER):
+        self.assembler = assembler
+        self.items: List[Union[GluedItem, UnresolvedAddressValue]] = []
+        self.layout: Optional[Tuple[object, ...]] = None
+        self.image: Optional[AssembledImage] = None
+
+    def build(self, lines: Iterable[str]) -> Tuple[AssembledImage, Optional[List[str]]]:
+        """Build from source lines.
+
+        Returns the image and the names of the rebuilt sections, or None if a
+        full build was needed.
+        """
+        items, section_addresses = self.assembler.prepare_lines(lines)
+        layout = (tuple(map(_item_layout, items)), tuple(sorted(section_addresses.items())))
+
+        rebuilt = None
+        if (self.image is not None and layout == self.layout
+                and not (self.assembler.optimise or self.assembler.pack_constants)):
+            rebuilt = self._rebuild_sections(self.image, items)
+
+        rebuilt_sections: Optional[List[str]] = None
+        if rebuilt is None:
+            image = self.assembler.assemble_prepared(items, section_addresses)
+        else:
+            image, rebuilt_sections = rebuilt
+
+        self.image = image
+        self.items = items
+        self.layout = layout
+        return image, rebuilt_sections
+
+    def _rebuild_sections(self, image: AssembledImage, items: List[Union[GluedItem, UnresolvedAddressValue]]
+                          ) -> Optional[Tuple[AssembledImage, List[str]]]:
+        sections: List[str] = []
+        for item, old_item in zip(items, self.items):
+            if item == old_item:
+                continue
+            if isinstance(item, UnresolvedAddressValue):
+                return None
+            if item.section not in sections:
+                sections.append(item.section)
+
+        reference_table = dict(image.reference_table)
+        region_table = {name: replace_dataclass(region) for name, region in image.region_table.items()}
+        for section in sections:
+            region_table[section].count = 0
+
+        section_indices = [
+            index for index, item in enumerate(items)
+            if not isinstance(item, UnresolvedAddressValue) and item.section in sections
+        ]
+        section_items = [items[index] for index in section_indices]
+        partially_unresolved_items = assign_constants(reference_table, region_table, section_items)
+        unresolved_items = assign_instructions(reference_table, region_table, partially_unresolved_items)
+
+        words = list(image.words)
+        for index, word in zip(section_indices, resolve_references(reference_table, unresolved_items)):
+            words[index] = word
+
+        return AssembledImage(reference_table=reference_table, region_table=region_table, words=words), sections
+
+
+def assemble_items(file_path: str) -> Tuple[ReferenceTable, RegionTable, List[AddressValue]]:
+    """Assemble a file into resolved address values."""
+    image = DEFAULT_ASSEMBLER.assemble_path(file_path)
+    return image.reference_table, image.region_table, image.words
+
+
+DEFAULT_CACHE_DIR = path.join(environ.get("XDG_CACHE_HOME", path.join(path.expanduser("~"), ".cache")), "sma16asm")
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def _get_assembler_hash() -> str:
+    with open(path.abspath(__file__), "rb") as assembler_handle:
+        return sha256(assembler_handle.read()).hexdigest()
+
+
+# Cached output is keyed on the assembler's own source, so any change to the assembler invalidates it
+ASSEMBLER_HASH = _get_assembler_hash()
+
+
+class AssemblyCache:
+    """An on-disk cache of assembled output.
+
+    Entries are keyed on a hash of the source bytes, the assembler's version
+    and own source, the output format and any options, such as the module
+    name an object module is given. When the total size of all entries
+    exceeds max_size the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source: bytes, output_format: str, options: Iterable[str] = ()) -> str:
+        """Get the cache key for a source file in an output format, assembled with options."""
+        source_hash = sha256()
+        source_hash.update("{}\0{}\0{}\0{}\0".format(ASSEMBLER_VERSION, ASSEMBLER_HASH, output_format,
+                                                     " ".join(options)).encode("utf-8"))
+        source_hash.update(source)
+        return source_hash.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return path.join(self.directory, key + ".out")
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Get cached output, or None on a miss."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "rb") as entry_handle:
+                output_bytes = entry_handle.read()
+            # The modification time records when an entry was last used
+            utime(entry_path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return output_bytes
+
+    def put(self, key: str, output_bytes: bytes):
+        """Store output in the cache, evicting old entries if needed.
+
+        Failing to write to the cache is not an assembly error, so it is ignored.
+        """
+        try:
+            makedirs(self.directory, exist_ok=True)
+            # Each writer gets its own temporary file, so concurrent writers never see a partial entry
+            entry_handle = NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+        except OSError:
+            return
+        try:
+            with entry_handle:
+                entry_handle.write(output_bytes)
+            replace(entry_handle.name, self._entry_path(key))
+        except OSError:
+            try:
+                remove(entry_handle.name)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        entries = []
+        try:
+            for entry_name in listdir(self.directory):
+                if entry_name.endswith(".out"):
+                    entry_stat = stat(path.join(self.directory, entry_name))
+                    entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_name))
+        except OSError:
+            return
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                remove(path.join(self.directory, entry_name))
+            except OSError:
+                continue
+            total_size -= size
+
+
+def assemble_file(file_path: str,
+                  output_file: str,
+                  output_format: str = "text",
+                  cache: Optional[AssemblyCache] = None,
+                  stage_hook: Optional[StageHook] = None,
+                  optimise: bool = False,
+                  pack_constants: bool = False,
+                  trace_memory: bool = False) -> Optional[AssembledImage]:
+    """Assemble a file, using cached output if a cache is given and holds it.
+
+    If a stage_hook is given it is passed the measurements of every stage,
+    including the serialiser, unless the output came from the cache. Peak
+    memory is only measured if trace_memory is set. Returns
+    the assembled image, or None if the output came from the cache or is an
+    object module. Object modules are named after the file and are never
+    optimised.
+    """
+    output_bytes = None
+    image = None
+
+    module_name, _ = path.splitext(path.basename(file_path))
+    if output_format == "object":
+        optimise = pack_constants = False
+
+    if cache is not None:
+        with open(file_path, "rb") as source_handle:
+            options = [
+                option for option, enabled in (("-O", optimise), ("--pack-constants", pack_constants)) if enabled
+            ]
+            if output_format == "object":
+                # Object modules embed their name, so files with the same source must not share an entry
+                options.append("--module-name={}".format(module_name))
+            key = cache.key(source_handle.read(), output_format, options)
+        output_bytes = cache.get(key)
+
+    if output_bytes is None and output_format == "object":
+        assembler = Assembler(stage_hook=stage_hook, trace_memory=trace_memory)
+        output_bytes = assembler.assemble_object(get_file_lines(file_path), module_name).serialise()
+        if cache is not None:
+            cache.put(key, output_bytes)
+
+    if output_bytes is None:
+        assembler = DEFAULT_ASSEMBLER
+        if stage_hook is not None or optimise or pack_constants:
+            assembler = Assembler(stage_hook=stage_hook,
+                                  optimise=optimise,
+                                  pack_constants=pack_constants,
+                                  trace_memory=trace_memory)
+        image = assembler.assemble_path(file_path)
+        output_bytes = assembler.serialise(image, output_format)
+        if cache is not None:
+            cache.put(key, output_bytes)
 
     with open(output_file, "wb") as output_handle:
         output_handle.write(output_bytes)
 
+    return image
 
-def main() -> int:
-    """Entry point function."""
-    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
 
-    argument_parser.add_argument("INPUT")
-    argument_parser.add_argument("-o", "--output", default="a.dbg")
-    argument_parser.add_argument("-f", "--format", default="auto", choices=("auto", "bin", "c", "debug", "hex", "text"))
+FORMAT_EXTENSIONS = {
+    "bin": ".bin",
+    "hex": ".hex",
+    "c": ".c",
+    "debug": ".dbg",
+    "map": ".map",
+    "image": ".i16",
+    "segment": ".seg",
+    "text": ".s16",
+    "object": ".o16",
+}
 
-    parsed_arguments = argument_parser.parse_args()
 
-    output_path = path.abspath(parsed_arguments.output)
-
-    output_format = parsed_arguments.format
-    if output_format == "auto":
-        _, ext = path.splitext(output_path)
-        if ext == ".bin":
-            output_format = "bin"
-        elif ext == ".hex":
-            output_format = "hex"
-        elif ext == ".c":
-            output_format = "c"
-        elif ext == ".dbg":
-            output_format = "debug"
-        else:
-            output_format = "text"
+def get_output_format(output_path: str, output_format: str = "auto") -> str:
+    """Get the output format for an output path, guessing from its extension if the format is auto."""
+    if output_format != "auto":
+        return output_format
+    _, ext = path.splitext(output_path)
+    for format_name, format_extension in FORMAT_EXTENSIONS.items():
+        if ext == format_extension:
+            return format_name
+    return "text"
 
-    if not path.isdir(path.dirname(output_path)):
-        print("Output directory does not exist.")
-        return 2
 
-    input_file = path.abspath(parsed_arguments.INPUT)
+def get_output_path(output: str, input_file: str, output_format: str) -> str:
+    """Get the output path for an input file.
+
+    The output may be a pattern containing {stem} and {name}, which are
+    replaced with the input file's name without and with its extension, or a
+    directory, in which case the output is named after the input file. Raises
+    ValueError if the pattern uses anything else.
+    """
+    name = path.basename(input_file)
+    stem, _ = path.splitext(name)
+    if "{" in output:
+        try:
+            return path.abspath(output.format(stem=stem, name=name))
+        except (AttributeError, IndexError, KeyError, ValueError) as error:
+            raise ValueError("Output pattern {} can only use {{stem}} and {{name}}".format(output)) from error
+    if path.isdir(output):
+        extension = FORMAT_EXTENSIONS["debug" if output_format == "auto" else output_format]
+        return path.abspath(path.join(output, stem + extension))
+    return path.abspath(output)
+
+
+def _cache_counts(cache: Optional[AssemblyCache]) -> Tuple[int, int]:
+    return (cache.hits, cache.misses) if cache is not None else (0, 0)
+
+
+def assemble_job(input_file: str,
+                 output_path: str,
+                 output_format: str,
+                 cache_directory: Optional[str],
+                 cache_size: int,
+                 stats: bool = False,
+                 optimise: bool = False,
+                 pack_constants: bool = False,
+                 trace_memory: bool = False) -> Tuple[int, str, List[StageStatistics], Tuple[int, int]]:
+    """Assemble a single file for main(), returning an exit code, a message, stage measurements and cache counts.
+
+    The cache counts are the hits and misses. This is run in worker
+    processes, so errors are returned rather than printed.
+    """
+    output_format = get_output_format(output_path, output_format)
+    statistics: List[StageStatistics] = []
+
+    if not path.isdir(path.dirname(output_path)):
+        return 2, "Output directory does not exist.", statistics, (0, 0)
 
     if not path.isfile(input_file):
-        print("Input file does not exist.")
-        return 3
+        return 3, "Input file does not exist.", statistics, (0, 0)
+
+    cache = None
+    if cache_directory is not None:
+        cache = AssemblyCache(cache_directory, cache_size)
+
+    try:
+        image = assemble_file(input_file,
+                              output_file=output_path,
+                              output_format=output_format,
+                              cache=cache,
+                              stage_hook=statistics.append if stats else None,
+                              optimise=optimise,
+                              pack_constants=pack_constants,
+                              trace_memory=trace_memory)
+    except AssemblyError as error:
+        return 1, "Assembly failed: {}.".format(error), statistics, _cache_counts(cache)
+
+    messages = []
+    if image is not None and image.peephole_report is not None:
+        messages.append("Peephole pass saved {} words and an estimated {} cycles.".format(
+            image.peephole_report.words_saved, image.peephole_report.cycles_saved))
+    if image is not None and image.constant_pool_report is not None:
+        messages.append("Constant packing saved {} words, {} merged and {} packed.".format(
+            image.constant_pool_report.words_saved, image.constant_pool_report.merged_constants,
+            image.constant_pool_report.packed_constants))
+    cached = image is None and cache is not None and cache.hits
+    if cached and output_format != "object" and (optimise or pack_constants):
+        messages.append("Output was taken from the cache, so its savings are not reported.")
+
+    return 0, " ".join(messages), statistics, _cache_counts(cache)
+
+
+def link_files(input_files: List[str],
+               output_path: str,
+               output_format: str,
+               cache_directory: Optional[str],
+               cache_size: int,
+               stats: bool = False,
+               trace_memory: bool = False) -> Tuple[int, str, List[StageStatistics], Tuple[int, int]]:
+    """Link object files and assembly files into a single output for main(), returning as assemble_job does.
+
+    Assembly files are first assembled to object modules, through the cache
+    if a cache_directory is given, so only changed modules are reassembled.
+    """
+    output_format = get_output_format(output_path, output_format)
+    statistics: List[StageStatistics] = []
+
+    if output_format == "object":
+        return 2, "Linked output cannot be an object file.", statistics, (0, 0)
+
+    if not path.isdir(path.dirname(output_path)):
+        return 2, "Output directory does not exist.", statistics, (0, 0)
+
+    for input_file in input_files:
+        if not path.isfile(input_file):
+            return 3, "Input file {} does not exist.".format(path.relpath(input_file)), statistics, (0, 0)
+
+    cache = None
+    if cache_directory is not None:
+        cache = AssemblyCache(cache_directory, cache_size)
+
+    assembler = Assembler(stage_hook=statistics.append if stats else None, trace_memory=trace_memory)
+    modules = []
+    try:
+        for input_file in input_files:
+            if path.splitext(input_file)[1] == FORMAT_EXTENSIONS["object"]:
+                with open(input_file, "rb") as object_handle:
+                    object_bytes = object_handle.read()
+            else:
+                module_name, _ = path.splitext(path.basename(input_file))
+                if cache is None:
+                    object_bytes = assembler.assemble_object(get_file_lines(input_file), module_name).serialise()
+                else:
+                    with open(input_file, "rb") as source_handle:
+                        key = cache.key(source_handle.read(), "object", ["--module-name={}".format(module_name)])
+                    cached_bytes = cache.get(key)
+                    if cached_bytes is None:
+                        cached_bytes = assembler.assemble_object(get_file_lines(input_file), module_name).serialise()
+                        cache.put(key, cached_bytes)
+                    object_bytes = cached_bytes
+            modules.append(ObjectModule.load(object_bytes))
+        output_bytes = assembler.serialise(assembler.link(modules), output_format)
+    except AssemblyError as error:
+        return 1, "Linking failed: {}.".format(error), statistics, _cache_counts(cache)
 
+    with open(output_path, "wb") as output_handle:
+        output_handle.write(output_bytes)
+
+    return 0, "", statistics, _cache_counts(cache)
+
+
+def handle_request(assembler: Assembler, request_line: str) -> str:
+    """Handle a JSON request line for the assembly server, returning a JSON response line.
+
+    Requests give either "source" text or a "path" to assemble, an optional
+    output "format" and an optional "id" which is echoed back. Responses hold
+    the base64 encoded "output", any "diagnostics" and the request latency.
+    """
+    start = perf_counter()
+    response: Dict[str, object] = {"id": None, "ok": False, "output": None, "diagnostics": []}
     try:
-        assemble_file(input_file, output_file=output_path, output_format=output_format)
+        request = json_loads(request_line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be an object")
+        response["id"] = request.get("id")
+        output_format = request.get("format", "text")
+        if output_format not in FORMAT_EXTENSIONS or output_format == "object":
+            raise ValueError("unsupported output format {}".format(output_format))
+        if "source" in request:
+            if not isinstance(request["source"], str):
+                raise ValueError("source must be a string")
+            image = assembler.assemble_text(request["source"])
+        elif "path" in request:
+            if not isinstance(request["path"], str):
+                raise ValueError("path must be a string")
+            image = assembler.assemble_path(request["path"])
+        else:
+            raise ValueError("request must have a source or a path")
+        response["output"] = b64encode(image.serialise(output_format)).decode("ascii")
+        response["ok"] = True
     except AssemblyError as error:
-        print("Assembly failed: {}.".format(error), file=stderr)
-        return 1
+        response["diagnostics"] = ["Assembly failed: {}.".format(error)]
+    except (OSError, TypeError, ValueError) as error:
+        response["diagnostics"] = ["Bad request: {}.".format(error)]
+    except Exception as error:  # pylint: disable=broad-except
+        # One bad request must not stop the server
+        response["diagnostics"] = ["Internal error: {!r}.".format(error)]
+    response["seconds"] = perf_counter() - start
+    return json_dumps(response, separators=(",", ":"))
+
+
+def serve_stdio(assembler: Assembler):
+    """Serve JSON-lines assembly requests from stdin until it closes."""
+    for request_line in stdin:
+        if request_line.strip():
+            stdout.write(handle_request(assembler, request_line) + "\n")
+            stdout.flush()
+
+
+def serve_socket(assembler: Assembler, socket_path: str) -> int:
+    """Serve JSON-lines assembly requests on a Unix socket, one thread per client.
+
+    A stale socket left at the path is replaced, but any other file is left
+    alone. Returns an exit code for main().
+    """
+    # Only imported when serving, to keep normal start up fast
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer  # pylint: disable=import-outside-toplevel
+
+    class RequestHandler(StreamRequestHandler):
+        """Handle a single client connection."""
+
+        def handle(self):
+            for request_line in self.rfile:
+                if request_line.strip():
+                    response_line = handle_request(assembler, request_line.decode("utf-8", "replace"))
+                    self.wfile.write(response_line.encode("ascii") + b"\n")
+                    self.wfile.flush()
+
+    if path.exists(socket_path):
+        if not S_ISSOCK(stat(socket_path).st_mode):
+            print("{} exists and is not a socket.".format(socket_path), file=stderr)
+            return 2
+        remove(socket_path)
+
+    try:
+        server = ThreadingUnixStreamServer(socket_path, RequestHandler)
+    except OSError as error:
+        print("Cannot serve on {}: {}.".format(socket_path, error.strerror), file=stderr)
+        return 2
 
+    with server:
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove(socket_path)
     return 0
 
 
+def analyse_files(input_files: List[str], optimise: bool = False, pack_constants: bool = False) -> int:
+    """Assemble files and print the analysis of their control flow for main(), returning an exit code."""
+    assembler = Assembler(optimise=optimise, pack_constants=pack_constants)
+    exit_code = 0
+    for input_file in input_files:
+        if len(input_files) > 1:
+            print("{}:".format(path.relpath(input_file)))
+        if not path.isfile(input_file):
+            print("Input file does not exist.")
+            exit_code = max(exit_code, 3)
+            continue
+        try:
+            image = assembler.assemble_path(input_file)
+        except AssemblyError as error:
+            print("Assembly failed: {}.".format(error), file=stderr)
+            exit_code = max(exit_code, 1)
+            continue
+        print(image.analyse().format(SymbolIndex(image.reference_table, image.region_table)))
+    return exit_code
+
+
+def watch_file(input_file: str,
+               output_path: str,
+               output_format: str,
+               poll_interval: float = 0.25,
+               assembler: Assembler = DEFAULT_ASSEMBLER):
+    """Rebuild a file whenever it changes, until interrupted."""
+    incremental_build = IncrementalBuild(assembler)
+    last_modified = None
+    while True:
+        try:
+            modified = stat(input_file).st_mtime_ns
+        except OSError:
+            modified = None
+        if modified is not None and modified != last_modified:
+            last_modified = modified
+            start = perf_counter()
+            try:
+                image, rebuilt_sections = incremental_build.build(list(get_file_lines(input_file)))
+                with open(output_path, "wb") as output_handle:
+                    output_handle.write(image.serialise(output_format))
+            except AssemblyError as error:
+                print("Assembly failed: {}.".format(error), file=stderr)
+            else:
+                if rebuilt_sections is None:
+                    description = "full rebuild"
+                elif rebuilt_sections:
+                    description = "rebuilt {}".format(", ".join(rebuilt_sections))
+                else:
+                    description = "no changes"
+                print("{} ({}) in {:.3f}ms.".format(path.relpath(input_file), description,
+                                                   (perf_counter() - start) * 1000))
+            stdout.flush()
+        sleep(poll_interval)
+
+
+def print_cache_counts(cache_counts: Iterable[Tuple[int, int]]):
+    """Print the total cache hits and misses of several jobs."""
+    cache_counts = list(cache_counts)
+    hits = sum(job_hits for job_hits, _ in cache_counts)
+    misses = sum(job_misses for _, job_misses in cache_counts)
+    print("Cache: {} hits, {} misses.".format(hits, misses), file=stderr)
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        epilog="The exit code is 1 if assembly failed, 2 for an invalid output or option and 3 if an input does not "
+        "exist. With several inputs, every input is assembled and the exit code is the highest of theirs.")
+
+    argument_parser.add_argument("INPUT", nargs="*")
+    argument_parser.add_argument("-o",
+                                 "--output",
+                                 default="a.dbg",
+                                 help="output file, directory, or pattern using {stem} and {name}")
+    argument_parser.add_argument("-f",
+                                 "--format",
+                                 default="auto",
+                                 choices=("auto", "bin", "c", "debug", "hex", "image", "map", "object", "segment",
+                                          "text"))
+    argument_parser.add_argument("-O",
+                                 "--optimise",
+                                 action="store_true",
+                                 help="run the peephole pass, removing redundant instructions")
+    argument_parser.add_argument("--pack-constants",
+                                 action="store_true",
+                                 help="merge duplicate constants and pack constants into unused operands")
+    argument_parser.add_argument("--link",
+                                 action="store_true",
+                                 help="link all inputs, object files or assembly files, into a single output")
+    argument_parser.add_argument("--analyse",
+                                 action="store_true",
+                                 help="print each input's control flow and cycle bounds rather than writing output")
+    argument_parser.add_argument("-j", "--jobs", type=int, default=cpu_count() or 1, help="number of worker processes")
+    argument_parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="directory to cache output in")
+    argument_parser.add_argument("--cache-size",
+                                 type=int,
+                                 default=DEFAULT_CACHE_SIZE,
+                                 help="maximum total size of cached output in bytes")
+    argument_parser.add_argument("--no-cache", action="store_true", help="always assemble from scratch")
+    argument_parser.add_argument("--cache-stats",
+                                 action="store_true",
+                                 help="print how many outputs were taken from the cache and how many were assembled")
+    argument_parser.add_argument("--stats",
+                                 nargs="?",
+                                 const="table",
+                                 default=None,
+                                 choices=("table", "json"),
+                                 help="print time and item counts for each stage, bypassing the cache")
+    argument_parser.add_argument("--stats-memory",
+                                 action="store_true",
+                                 help="with --stats, also trace each stage's peak memory, which slows the stages down")
+    argument_parser.add_argument("--serve",
+                                 action="store_true",
+                                 help="stay resident and serve JSON-lines assembly requests")
+    argument_parser.add_argument("--socket", default=None, help="serve on this Unix socket rather than stdin/stdout")
+    argument_parser.add_argument("-w", "--watch", action="store_true", help="rebuild whenever the input changes")
+    argument_parser.add_argument("--poll-interval",
+                                 type=float,
+                                 default=0.25,
+                                 help="seconds between checks in watch mode")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    if parsed_arguments.serve:
+        if parsed_arguments.socket:
+            return serve_socket(DEFAULT_ASSEMBLER, path.abspath(parsed_arguments.socket))
+        serve_stdio(DEFAULT_ASSEMBLER)
+        return 0
+
+    if not parsed_arguments.INPUT:
+        argument_parser.error("the following arguments are required: INPUT")
+
+    input_files = [path.abspath(input_file) for input_file in parsed_arguments.INPUT]
+    output = parsed_arguments.output
+
+    cache_directory = None
+    if not (parsed_arguments.no_cache or parsed_arguments.stats):
+        cache_directory = path.abspath(parsed_arguments.cache_dir)
+
+    if parsed_arguments.analyse:
+        if parsed_arguments.link:
+            print("Linked programs cannot be analysed.")
+            return 2
+        return analyse_files(input_files, parsed_arguments.optimise, parsed_arguments.pack_constants)
+
+    try:
+        output_paths = [get_output_path(output, input_file, parsed_arguments.format) for input_file in input_files]
+    except ValueError as error:
+        print("{}.".format(error))
+        return 2
+
+    if parsed_arguments.link:
+        exit_code, message, statistics, cache_counts = link_files(
+            input_files, output_paths[0], parsed_arguments.format,
+            cache_directory, parsed_arguments.cache_size, parsed_arguments.stats is not None,
+            parsed_arguments.stats_memory)
+        if message:
+            print(message, file=stdout if exit_code in (2, 3) else stderr)
+        if statistics and parsed_arguments.stats == "json":
+            print(json_dumps({"file": output, "stages": [asdict(stage_statistics) for stage_statistics in statistics]}))
+        elif statistics:
+            print(format_stage_table(statistics))
+        if parsed_arguments.cache_stats:
+            print_cache_counts([cache_counts])
+        return exit_code
+
+    if len(input_files) > 1 and "{" not in output and not path.isdir(output):
+        print("Output must be a directory or a pattern when assembling multiple files.")
+        return 2
+
+    if parsed_arguments.watch:
+        if len(input_files) > 1:
+            print("Only a single file can be watched.")
+            return 2
+        output_path = output_paths[0]
+        if not path.isdir(path.dirname(output_path)):
+            print("Output directory does not exist.")
+            return 2
+        if get_output_format(output_path, parsed_arguments.format) == "object":
+            print("Object files cannot be watched.")
+            return 2
+        try:
+            watch_file(input_files[0], output_path, get_output_format(output_path, parsed_arguments.format),
+                       parsed_arguments.poll_interval,
+                       Assembler(optimise=parsed_arguments.optimise, pack_constants=parsed_arguments.pack_constants))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    jobs = [(input_file, output_path, parsed_arguments.format, cache_directory, parsed_arguments.cache_size,
+             parsed_arguments.stats is not None, parsed_arguments.optimise, parsed_arguments.pack_constants,
+             parsed_arguments.stats_memory) for input_file, output_path in zip(input_files, output_paths)]
+
+    if len(jobs) == 1 or parsed_arguments.jobs <= 1:
+        results = [assemble_job(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(parsed_arguments.jobs, len(jobs))) as executor:
+            results = list(executor.map(assemble_job, *zip(*jobs)))
+
+    exit_code = 0
+    for input_file, (file_exit_code, message, statistics, _) in zip(input_files, results):
+        if message:
+            if len(input_files) > 1:
+                message = "{}: {}".format(path.relpath(input_file), message)
+            print(message, file=stdout if file_exit_code in (2, 3) else stderr)
+        if statistics and parsed_arguments.stats == "json":
+            print(
+                json_dumps({
+                    "file": path.relpath(input_file),
+                    "stages": [asdict(stage_statistics) for stage_statistics in statistics]
+                }))
+        elif statistics:
+            if len(input_files) > 1:
+                print("{}:".format(path.relpath(input_file)))
+            print(format_stage_table(statistics))
+        exit_code = max(exit_code, file_exit_code)
+
+    if parsed_arguments.cache_stats:
+        print_cache_counts([result[3] for result in results])
+
+    return exit_code
+
+
 if __name__ == "__main__":
     exit(main())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""SMA16 batch emulator.
+
+Runs many copies of an SMA16 machine in lock-step using NumPy, with the same
+semantics as sma16vm.c. Every machine executes one instruction per step, and
+machines are grouped by opcode so each instruction is applied as a single
+array operation across all machines currently executing it.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from os import path
+from sys import stderr, stdout
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from sma16asm import AddressValue, AssemblyError, Instruction, assemble_items
+from sma16emu import (ASCII_OUT, FAULT_VECTOR, INTERRUPT_REASON, INTERRUPT_REASON_UNSUPPORTED, INTERRUPT_RETURN,
+                      MEMORY_SIZE, SMALL_OUT, SMALL_OUTPUT_TABLE, MachineState, RunStatistics, load_bin_image,
+                      load_image)
+
+
+class BatchEmulator:
+    """A batch of SMA16 machines sharing one (N, 4096) memory array.
+
+    Accumulators, program counters and the halt and zero flags are vectors
+    with one entry per machine. Halted machines are masked out of each step.
+    """
+
+    def __init__(self, memory: np.ndarray):
+        if memory.ndim != 2 or memory.shape[1] != MEMORY_SIZE:
+            raise ValueError("batch memory must have shape (N, {})".format(MEMORY_SIZE))
+        self.memory = np.ascontiguousarray(memory, dtype=np.uint16)
+        count = self.memory.shape[0]
+        self.accumulator = np.zeros(count, dtype=np.uint16)
+        self.program_counter = np.zeros(count, dtype=np.uint16)
+        self.halt = np.zeros(count, dtype=bool)
+        self.test = np.zeros(count, dtype=bool)
+        self.instructions = np.zeros(count, dtype=np.int64)
+        self.outputs: List[bytearray] = [bytearray() for _ in range(count)]
+
+        handlers: Dict[Instruction, Callable[[np.ndarray, np.ndarray], None]] = {
+            Instruction.HALT: self._halt,
+            Instruction.RESERVED1: self._noop,
+            Instruction.JUMP: self._jump,
+            Instruction.JUMPZ: self._jumpz,
+            Instruction.LOAD: self._load,
+            Instruction.STORE: self._store,
+            Instruction.LSHFT: self._lshft,
+            Instruction.RSHFT: self._rshft,
+            Instruction.XOR: self._xor,
+            Instruction.AND: self._and,
+            Instruction.SFULL: self._sfull,
+            Instruction.ADD: self._add,
+            Instruction.RESERVED2: self._noop,
+            Instruction.POP: self._pop,
+            Instruction.PUSH: self._push,
+            Instruction.NOOP: self._noop,
+        }
+        self.dispatch_table: List[Callable[[np.ndarray, np.ndarray], None]] = [
+            handlers[instruction] for instruction in Instruction
+        ]
+
+    @property
+    def count(self) -> int:
+        """Get the number of machines in the batch."""
+        return self.memory.shape[0]
+
+    @classmethod
+    def from_items(cls, resolved_items: Iterable[AddressValue], count: int) -> "BatchEmulator":
+        """Create a batch of identical machines from resolved address values."""
+        image = np.frombuffer(load_image(resolved_items), dtype=np.uint16)
+        return cls(np.tile(image, (count, 1)))
+
+    @classmethod
+    def from_bin(cls, image: bytes, count: int) -> "BatchEmulator":
+        """Create a batch of identical machines from a memory image."""
+        return cls(np.tile(np.frombuffer(load_bin_image(image), dtype=np.uint16), (count, 1)))
+
+    @classmethod
+    def from_bins(cls, images: Iterable[bytes]) -> "BatchEmulator":
+        """Create a batch with one machine per memory image."""
+        return cls(np.stack([np.frombuffer(load_bin_image(image), dtype=np.uint16) for image in images]))
+
+    @classmethod
+    def from_state(cls, state: MachineState, count: int) -> "BatchEmulator":
+        """Create a batch of machines forked from one machine state."""
+        emulator = cls(np.tile(np.frombuffer(state.memory, dtype=np.uint16), (count, 1)))
+        emulator.accumulator[:] = state.accumulator
+        emulator.program_counter[:] = state.program_counter
+        emulator.halt[:] = state.halt
+        emulator.test[:] = state.test
+        return emulator
+
+    def _halt(self, machines: np.ndarray, data: np.ndarray):
+        self.halt[machines] = True
+        self.program_counter[machines] += 1
+
+    def _jump(self, machines: np.ndarray, data: np.ndarray):
+        self.program_counter[machines] = data
+
+    def _jumpz(self, machines: np.ndarray, data: np.ndarray):
+        program_counter = self.program_counter[machines]
+        self.program_counter[machines] = np.where(self.test[machines], data, program_counter + 1)
+
+    def _load(self, machines: np.ndarray, data: np.ndarray):
+        self.accumulator[machines] = self.memory[machines, data]
+        self.program_counter[machines] += 1
+
+    def _write_output(self, machines: np.ndarray, data: np.ndarray):
+        for machine in machines[data == SMALL_OUT].tolist():
+            self.outputs[machine] += SMALL_OUTPUT_TABLE[int(self.accumulator[machine]) & 0xfff]
+        for machine in machines[data == ASCII_OUT].tolist():
+            self.outputs[machine].append(int(self.accumulator[machine]) & 0xff)
+
+    def _store(self, machines: np.ndarray, data: np.ndarray):
+        self._write_output(machines, data)
+        self.memory[machines, data] = (self.memory[machines, data] & 0xf000) | (self.accumulator[machines] & 0x0fff)
+        self.program_counter[machines] += 1
+
+    def _sfull(self, machines: np.ndarray, data: np.ndarray):
+        self._write_output(machines, data)
+        self.memory[machines, data] = self.accumulator[machines]
+        self.program_counter[machines] += 1
+
+    def _shift(self, machines: np.ndarray, data: np.ndarray, left: bool):
+        # Shifts of 16 or more clear the accumulator, as they do in sma16vm.c
+        accumulator = self.accumulator[machines].astype(np.uint32)
+        upper = accumulator & 0xf000
+        preserve = (data & 0x1).astype(bool)
+        distance = np.minimum(data >> 1, 16).astype(np.uint32)
+        accumulator = np.where(preserve, accumulator & 0x0fff, accumulator)
+        accumulator = (accumulator << distance if left else accumulator >> distance) & 0xffff
+        accumulator = np.where(preserve, (accumulator & 0x0fff) | upper, accumulator)
+        self.accumulator[machines] = accumulator
+        self.program_counter[machines] += 1
+
+    def _lshft(self, machines: np.ndarray, data: np.ndarray):
+        self._shift(machines, data, left=True)
+
+    def _rshft(self, machines: np.ndarray, data: np.ndarray):
+        self._shift(machines, data, left=False)
+
+    def _xor(self, machines: np.ndarray, data: np.ndarray):
+        self.accumulator[machines] ^= data
+        self.program_counter[machines] += 1
+
+    def _and(self, machines: np.ndarray, data: np.ndarray):
+        self.accumulator[machines] &= data | 0xf000
+        self.program_counter[machines] += 1
+
+    def _add(self, machines: np.ndarray, data: np.ndarray):
+        accumulator = self.accumulator[machines]
+        accumulator = (accumulator & 0xf000) | ((accumulator + data) & 0x0fff)
+        self.test[machines] = accumulator == 0
+        self.accumulator[machines] = accumulator
+        self.program_counter[machines] += 1
+
+    def _fault(self, machines: np.ndarray, instruction: Instruction):
+        self.memory[machines, INTERRUPT_RETURN] = self.program_counter[machines] + 1
+        self.program_counter[machines] = FAULT_VECTOR
+        self.memory[machines, INTERRUPT_REASON] = INTERRUPT_REASON_UNSUPPORTED + instruction
+
+    def _pop(self, machines: np.ndarray, data: np.ndarray):
+        self._fault(machines, Instruction.POP)
+
+    def _push(self, machines: np.ndarray, data: np.ndarray):
+        self._fault(machines, Instruction.PUSH)
+
+    def _noop(self, machines: np.ndarray, data: np.ndarray):
+        self.program_counter[machines] += 1
+
+    def step(self) -> int:
+        """Execute a single instruction on every machine which has not halted.
+
+        Returns the number of machines which executed an instruction.
+        """
+        machines = np.flatnonzero(~self.halt)
+        if not machines.size:
+            return 0
+        self.program_counter[machines] &= 0xfff
+        words = self.memory[machines, self.program_counter[machines]]
+        opcodes = words >> 12
+        data = words & 0x0fff
+        for opcode in np.unique(opcodes).tolist():
+            mask = opcodes == opcode
+            self.dispatch_table[opcode](machines[mask], data[mask])
+        self.instructions[machines] += 1
+        return machines.size
+
+    def run(self, max_steps: Optional[int] = None) -> RunStatistics:
+        """Run until every machine has halted, or until max_steps steps have been taken."""
+        executed = 0
+        steps = 0
+        start = perf_counter()
+        while max_steps is None or steps < max_steps:
+            stepped = self.step()
+            if not stepped:
+                break
+            executed += stepped
+            steps += 1
+        seconds = perf_counter() - start
+        return RunStatistics(instructions=executed, seconds=seconds)
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("INPUT",
+                                 help="memory image (.bin or .seg), machine state (.snap) or assembly file (.a16)")
+    argument_parser.add_argument("-c", "--count", type=int, default=1000, help="number of machines to run")
+    argument_parser.add_argument("-n", "--max-steps", type=int, default=None)
+    argument_parser.add_argument("-t", "--time", action="store_true", help="display timing information")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    input_file = path.abspath(parsed_arguments.INPUT)
+
+    if not path.isfile(input_file):
+        print("Input file does not exist.")
+        return 3
+
+    if path.splitext(input_file)[1] in (".bin", ".seg"):
+        with open(input_file, "rb") as input_handle:
+            emulator = BatchEmulator.from_bin(input_handle.read(), parsed_arguments.count)
+    elif path.splitext(input_file)[1] == ".snap":
+        with open(input_file, "rb") as input_handle:
+            try:
+                state = MachineState.load(input_handle.read())
+            except ValueError as error:
+                print("Loading state failed: {}.".format(error), file=stderr)
+                return 1
+        # A halted machine continues, as it does when C is pressed in sma16vm
+        state.halt = False
+        emulator = BatchEmulator.from_state(state, parsed_arguments.count)
+    else:
+        try:
+            _, _, resolved_items = assemble_items(input_file)
+            emulator = BatchEmulator.from_items(resolved_items, parsed_arguments.count)
+        except AssemblyError as error:
+            print("Assembly failed: {}.".format(error), file=stderr)
+            return 1
+
+    statistics = emulator.run(parsed_arguments.max_steps)
+
+    stdout.buffer.write(emulator.outputs[0])
+    stdout.flush()
+
+    if parsed_arguments.time:
+        print("{} machines, {} halted, {} instructions in {:.6f}s ({:.0f} instructions per second).".format(
+            emulator.count, int(emulator.halt.sum()), statistics.instructions, statistics.seconds,
+            statistics.instructions_per_second),
+              file=stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
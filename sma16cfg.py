@@ -0,0 +1,425 @@
+"""SMA16 control flow analysis.
+
+Builds a control flow graph of an assembled program, finds its loops and
+bounds the cycles taken on any path from the reset vector to a halt.
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sma16asm import CONSTANTS, AddressValue, Instruction, SymbolIndex
+
+# Blocks ending in these instructions always end, as they can go somewhere other than the next address
+BLOCK_ENDING_INSTRUCTIONS = {Instruction.HALT, Instruction.JUMP, Instruction.JUMPZ, Instruction.PUSH, Instruction.POP}
+
+# A handler returns from a fault through a jump whose operand is stored straight after this word is loaded
+LOAD_INTERRUPT_RETURN = (Instruction.LOAD << 12) | CONSTANTS["INTERRUPT_RETURN"]
+
+
+@dataclass
+class BasicBlock:
+    """A run of instructions which is only entered at its start and only left at its end.
+
+    Each instruction takes one cycle. A block ending in PUSH or POP goes
+    through the fault vector and continues at its successor once the fault
+    handler returns. The exit says how a block leaves without a successor:
+    halt, return (from the fault handler) or unknown, when a jump target is
+    rewritten at run time.
+    """
+
+    start: int
+    end: int
+    successors: List[int]
+    fault: bool = False
+    exit: str = ""
+
+    @property
+    def cycles(self) -> int:
+        """Get the cycles taken to run the block once, not counting any fault handler."""
+        return self.end - self.start + 1
+
+
+@dataclass
+class Loop:
+    """A natural loop, which is entered only through its header."""
+
+    header: int
+    blocks: List[int]
+    depth: int
+    parent: Optional[int]
+    iteration_cycles: Optional[int]
+
+
+@dataclass
+class RegionAnalysis:
+    """The loops and path bounds of the code reachable from an entry point.
+
+    Path bounds count the cycles from the entry to a halt or a return, without
+    repeating any loop. The worst case is only known when there are no loops
+    and every jump target is known, otherwise notes says why it is not. Writes
+    to addresses set at run time are assumed not to change the code, and
+    assumptions lists any the bounds rely on.
+    """
+
+    entry: int
+    blocks: List[int]
+    loops: List[Loop]
+    shortest_cycles: Optional[int]
+    longest_cycles: Optional[int]
+    worst_case_cycles: Optional[int]
+    notes: List[str]
+    assumptions: List[str]
+
+
+@dataclass
+class ControlFlowAnalysis:
+    """A control flow graph of a program, with the loops and path bounds of the program and its fault handler."""
+
+    blocks: Dict[int, BasicBlock]
+    writers: Dict[int, List[int]]
+    unknown_writers: List[int]
+    program: RegionAnalysis
+    handler: Optional[RegionAnalysis]
+
+    def format(self, symbol_index: SymbolIndex) -> str:
+        """Format the analysis as a report, naming addresses after their labels."""
+
+        def name(address: int) -> str:
+            labels = symbol_index.labels_at(address)
+            return "0x{:03x} ({})".format(address, ", ".join(labels)) if labels else "0x{:03x}".format(address)
+
+        def plural(count: int, noun: str) -> str:
+            return "{} {}{}".format(count, noun, "" if count == 1 else "s")
+
+        lines = []
+        for title, region in (("Program", self.program), ("Fault handler", self.handler)):
+            if region is None:
+                continue
+            lines.append("{} from {}:".format(title, name(region.entry)))
+            for start in sorted(region.blocks):
+                block = self.blocks[start]
+                targets = [name(successor) for successor in block.successors]
+                if block.fault:
+                    targets.append("fault vector")
+                if block.exit:
+                    targets.append(block.exit)
+                lines.append("  block {} to 0x{:03x}, {} -> {}".format(name(block.start), block.end,
+                                                                       plural(block.cycles, "cycle"),
+                                                                       ", ".join(targets)))
+            for loop in region.loops:
+                lines.append("  loop at {}, depth {}{}, {}, {} per iteration, iteration bound unknown".format(
+                    name(loop.header), loop.depth,
+                    " in loop at {}".format(name(loop.parent)) if loop.parent is not None else "",
+                    plural(len(loop.blocks), "block"), "unknown cycles" if loop.iteration_cycles is None else
+                    plural(loop.iteration_cycles, "cycle")))
+            if region.shortest_cycles is not None and region.longest_cycles is not None:
+                bounds = plural(region.longest_cycles, "cycle")
+                if region.shortest_cycles != region.longest_cycles:
+                    bounds = "{} to {}".format(region.shortest_cycles, bounds)
+                lines.append("  {} to {}{}".format(bounds, "return" if region is self.handler else "halt",
+                                                   " without repeating a loop" if region.loops else ""))
+            if region.worst_case_cycles is not None:
+                lines.append("  worst case {}{}".format(plural(region.worst_case_cycles, "cycle"),
+                                                        ", assuming:" if region.assumptions else ""))
+                lines.extend("    - " + assumption for assumption in region.assumptions)
+            else:
+                lines.append("  worst case cannot be determined:")
+                lines.extend("    - " + note for note in region.notes)
+
+        if self.writers:
+            code = {address for block in self.blocks.values() for address in range(block.start, block.end + 1)}
+            lines.append("Written at run time:")
+            for address, writers in sorted(self.writers.items()):
+                lines.append("  {} {} by {}".format("code" if address in code else "data", name(address),
+                                                    ", ".join(map(name, writers))))
+        if self.unknown_writers:
+            lines.append("Writing to addresses set at run time:")
+            lines.append("  " + ", ".join(map(name, self.unknown_writers)))
+
+        return "\n".join(lines)
+
+
+def _instruction_flow(memory: Dict[int, int], address: int, writers: Dict[int, List[int]],
+                      returns: Set[int]) -> Tuple[List[int], bool, str]:
+    """Get the successors of an instruction, whether it faults, and how it exits."""
+    value = memory.get(address, 0)
+    instruction = value >> 12
+    target = value & 0xfff
+    following = (address + 1) & 0xfff
+    exit_kind = ""
+
+    if address in returns:
+        return [], False, "return"
+    if address in writers and (instruction in (Instruction.JUMP, Instruction.JUMPZ) or any(
+            memory.get(writer, 0) >> 12 == Instruction.SFULL for writer in writers[address])):
+        exit_kind = "unknown"
+
+    if instruction == Instruction.HALT:
+        return [], False, exit_kind or "halt"
+    if instruction == Instruction.JUMP:
+        return [target], False, exit_kind
+    if instruction == Instruction.JUMPZ:
+        return list(dict.fromkeys([target, following])), False, exit_kind
+    return [following], instruction in (Instruction.PUSH, Instruction.POP), exit_kind
+
+
+def _reachable_instructions(memory: Dict[int, int], entries: List[int], writers: Dict[int, List[int]],
+                            returns: Set[int]) -> Dict[int, Tuple[List[int], bool, str]]:
+    flows: Dict[int, Tuple[List[int], bool, str]] = {}
+    pending = list(entries)
+    while pending:
+        address = pending.pop()
+        if address in flows:
+            continue
+        flows[address] = _instruction_flow(memory, address, writers, returns)
+        pending.extend(flows[address][0])
+        if flows[address][1]:
+            pending.append(CONSTANTS["FAULT_VECTOR"])
+    return flows
+
+
+def _build_blocks(memory: Dict[int, int], flows: Dict[int, Tuple[List[int], bool, str]],
+                  entries: Set[int]) -> Dict[int, BasicBlock]:
+    predecessors: Dict[int, List[int]] = {}
+    for address, (successors, _, _) in flows.items():
+        for successor in successors:
+            predecessors.setdefault(successor, []).append(address)
+
+    def ends_block(address: int) -> bool:
+        return bool(flows[address][2]) or memory.get(address, 0) >> 12 in BLOCK_ENDING_INSTRUCTIONS
+
+    def is_leader(address: int) -> bool:
+        sources = predecessors.get(address, [])
+        return address in entries or len(sources) != 1 or ends_block(sources[0])
+
+    blocks = {}
+    for start in sorted(address for address in flows if is_leader(address)):
+        end = start
+        while not ends_block(end) and not is_leader(flows[end][0][0]):
+            end = flows[end][0][0]
+        successors, fault, exit_kind = flows[end]
+        blocks[start] = BasicBlock(start=start, end=end, successors=successors, fault=fault, exit=exit_kind)
+    return blocks
+
+
+def _analyse_region(blocks: Dict[int, BasicBlock],
+                    entry: int,
+                    unknown_writers: List[int],
+                    handler: Optional[RegionAnalysis] = None) -> RegionAnalysis:
+    """Find the loops and path bounds of the blocks reachable from an entry.
+
+    Each PUSH and POP adds the bounds of the fault handler's region, if one is
+    given. Outside the fault handler a return goes wherever the last fault came
+    from, so the path bounds only end at a return in the handler.
+    """
+    in_handler = entry == CONSTANTS["FAULT_VECTOR"]
+    bounded_faults = handler is not None and handler.worst_case_cycles is not None
+    notes = []
+
+    # Depth first search, finding a reverse postorder and the edges which retreat to a block still being searched
+    postorder: List[int] = []
+    retreating: Set[Tuple[int, int]] = set()
+    on_stack = {entry}
+    visited = {entry}
+    stack = [(entry, iter(blocks[entry].successors))]
+    while stack:
+        block, successors = stack[-1]
+        for successor in successors:
+            if successor in on_stack:
+                retreating.add((block, successor))
+            elif successor not in visited:
+                visited.add(successor)
+                on_stack.add(successor)
+                stack.append((successor, iter(blocks[successor].successors)))
+                break
+        else:
+            stack.pop()
+            on_stack.discard(block)
+            postorder.append(block)
+    order = postorder[::-1]
+    position = {block: index for index, block in enumerate(order)}
+
+    predecessors: Dict[int, List[int]] = {block: [] for block in order}
+    for block in order:
+        for successor in blocks[block].successors:
+            predecessors[successor].append(block)
+
+    # Dominators, by Cooper, Harvey and Kennedy's iterative algorithm
+    dominators = {entry: entry}
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new_dominator = None
+            for predecessor in predecessors[block]:
+                if predecessor not in dominators:
+                    continue
+                if new_dominator is None:
+                    new_dominator = predecessor
+                    continue
+                first, second = predecessor, new_dominator
+                while first != second:
+                    while position[first] > position[second]:
+                        first = dominators[first]
+                    while position[second] > position[first]:
+                        second = dominators[second]
+                new_dominator = first
+            if new_dominator is not None and dominators.get(block) != new_dominator:
+                dominators[block] = new_dominator
+                changed = True
+
+    def dominates(dominator: int, block: int) -> bool:
+        while block != dominator and block != entry:
+            block = dominators[block]
+        return block == dominator
+
+    back_edges: Dict[int, List[int]] = {}
+    for source, header in sorted(retreating):
+        if dominates(header, source):
+            back_edges.setdefault(header, []).append(source)
+        else:
+            notes.append("the edge from 0x{:03x} to 0x{:03x} is in a loop with more than one entry".format(
+                blocks[source].end, header))
+
+    # Each natural loop is its header and every block which reaches a back edge without passing the header
+    bodies: Dict[int, Set[int]] = {}
+    for header, sources in back_edges.items():
+        body = {header}
+        pending = list(sources)
+        while pending:
+            block = pending.pop()
+            if block not in body:
+                body.add(block)
+                pending.extend(predecessors[block])
+        bodies[header] = body
+
+    def cost(block: int, shortest: bool = False) -> int:
+        if blocks[block].fault and handler is not None:
+            fault_cycles = handler.shortest_cycles if shortest else handler.worst_case_cycles
+            return blocks[block].cycles + (fault_cycles or 0)
+        return blocks[block].cycles
+
+    def path_cycles(start: int, within: Set[int], pick: Callable[[int, int], int]) -> Dict[int, int]:
+        paths = {start: cost(start, pick is min)}
+        for block in order[position[start]:]:
+            if block not in paths or block not in within:
+                continue
+            for successor in blocks[block].successors:
+                if successor in within and (block, successor) not in retreating:
+                    candidate = paths[block] + cost(successor, pick is min)
+                    paths[successor] = candidate if successor not in paths else pick(paths[successor], candidate)
+        return paths
+
+    loops = []
+    for header in sorted(bodies, key=lambda header: position[header]):
+        enclosing = [other for other in bodies if other != header and header in bodies[other]]
+        parent = max(enclosing, key=lambda other: position[other], default=None)
+        iteration_cycles = None
+        if bounded_faults or not any(blocks[block].fault for block in bodies[header]):
+            paths = path_cycles(header, bodies[header], max)
+            iteration_cycles = max(paths[source] for source in back_edges[header])
+        loops.append(
+            Loop(header=header,
+                 blocks=sorted(bodies[header]),
+                 depth=len(enclosing) + 1,
+                 parent=parent,
+                 iteration_cycles=iteration_cycles))
+        notes.append("the loop at 0x{:03x} has no static iteration bound".format(header))
+
+    unknown = [block for block in order if blocks[block].exit == "unknown"]
+    for block in unknown:
+        notes.append("the jump at 0x{:03x} is rewritten at run time, so its target is unknown".format(
+            blocks[block].end))
+    if not in_handler:
+        for block in order:
+            if blocks[block].exit == "return":
+                notes.append("the fault handler's return at 0x{:03x} is reached outside a fault".format(
+                    blocks[block].end))
+                unknown.append(block)
+    faults = [block for block in order if blocks[block].fault]
+    if faults and not bounded_faults:
+        notes.append("the fault handler, entered by PUSH or POP at {}, has no bound".format(", ".join(
+            "0x{:03x}".format(blocks[block].end) for block in faults)))
+
+    assumptions = [
+        "the write at 0x{:03x} goes to an address set at run time, which is not code".format(writer)
+        for writer in unknown_writers
+        if any(blocks[block].start <= writer <= blocks[block].end for block in order)
+    ]
+    if faults and handler is not None:
+        assumptions.extend(assumption for assumption in handler.assumptions if assumption not in assumptions)
+
+    shortest_cycles = longest_cycles = None
+    if not unknown and (bounded_faults or not faults):
+        exits = [
+            block for block in order if blocks[block].exit == "halt" or in_handler and blocks[block].exit == "return"
+        ]
+        every_block = set(order)
+        shortest = path_cycles(entry, every_block, min)
+        longest = path_cycles(entry, every_block, max)
+        if exits:
+            shortest_cycles = min(shortest[block] for block in exits)
+            longest_cycles = max(longest[block] for block in exits)
+        else:
+            notes.append("no halt or return is reachable")
+
+    return RegionAnalysis(entry=entry,
+                          blocks=order,
+                          loops=loops,
+                          shortest_cycles=shortest_cycles,
+                          longest_cycles=longest_cycles,
+                          worst_case_cycles=longest_cycles if not notes else None,
+                          notes=notes,
+                          assumptions=assumptions)
+
+
+def analyse_control_flow(resolved_items: Iterable[AddressValue]) -> ControlFlowAnalysis:
+    """Build a control flow graph of a program from its reset vector, and bound the cycles it takes.
+
+    The addresses written by STORE and SFULL are found alongside the
+    reachable code, as a rewritten jump has an unknown target. A jump whose
+    target is stored straight after loading INTERRUPT_RETURN returns from the
+    fault handler. Faults are treated as calls, so the fault handler is
+    analysed on its own and its worst case added to every PUSH and POP.
+    """
+    memory = {item.address: item.value for item in resolved_items}
+    entries = [CONSTANTS["RESET_VECTOR"]]
+    writers: Dict[int, List[int]] = {}
+    returns: Set[int] = set()
+
+    # Writes only count if the code making them is reachable, so search until the writes found stop changing
+    while True:
+        flows = _reachable_instructions(memory, entries, writers, returns)
+        targets = {
+            address: memory[address] & 0xfff
+            for address in sorted(flows) if memory.get(address, 0) >> 12 in (Instruction.STORE, Instruction.SFULL)
+        }
+        # The assembled operand of a write which is itself rewritten is only a placeholder
+        rewritten = set(targets.values())
+        found_writers: Dict[int, List[int]] = {}
+        for address, target in targets.items():
+            if address not in rewritten:
+                found_writers.setdefault(target, []).append(address)
+        found_returns = {
+            address
+            for address, sources in found_writers.items() if memory.get(address, 0) >> 12 == Instruction.JUMP and all(
+                memory.get(source, 0) >> 12 == Instruction.STORE and memory.get(source - 1) == LOAD_INTERRUPT_RETURN
+                for source in sources)
+        }
+        if found_writers == writers and found_returns == returns:
+            break
+        writers, returns = found_writers, found_returns
+
+    unknown_writers = sorted(address for address in targets if address in rewritten)
+
+    fault_vector = CONSTANTS["FAULT_VECTOR"]
+    handles_faults = any(fault for _, fault, _ in flows.values())
+    blocks = _build_blocks(memory, flows, set(entries + ([fault_vector] if handles_faults else [])))
+
+    handler = _analyse_region(blocks, fault_vector, unknown_writers) if handles_faults else None
+    program = _analyse_region(blocks, entries[0], unknown_writers, handler)
+
+    return ControlFlowAnalysis(blocks=blocks,
+                               writers=writers,
+                               unknown_writers=unknown_writers,
+                               program=program,
+                               handler=handler)
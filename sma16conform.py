@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""SMA16 conformance harness.
+
+Generates or collects programs, assembles them in memory, runs them through
+the compiled sma16vm on a pool of subprocesses and compares the halt state
+and console output against the Python model in sma16emu.py. Any diverging
+program is shrunk to a minimal one.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from glob import glob
+from os import cpu_count, makedirs, path
+from random import Random
+from subprocess import DEVNULL, PIPE, TimeoutExpired
+from subprocess import run as run_subprocess
+from sys import stderr
+from tempfile import TemporaryDirectory
+from threading import get_ident
+from time import perf_counter
+from typing import Iterator, List
+
+from sma16asm import Assembler, AssemblyError
+from sma16emu import Emulator
+
+DEFAULT_VM = path.join(path.dirname(path.abspath(__file__)), "sma16vm")
+
+# sma16vm.c prints these when a program halts and stdin is not a terminal
+VM_HALT_OUTPUT = b"HALT\nSystem halted.\n"
+
+DATA_LABELS = ["d0", "d1", "d2", "d3"]
+
+
+@dataclass
+class Program:
+    """A program to check."""
+
+    name: str
+    source: str
+
+
+@dataclass
+class RunResult:
+    """The observable result of running a program."""
+
+    halted: bool
+    output: bytes
+
+
+@dataclass
+class CaseResult:
+    """The result of checking a program against the model."""
+
+    program: Program
+    status: str
+    detail: str = ""
+
+
+def generate_program(random: Random, length: int = 48) -> str:
+    """Generate a random program which uses every instruction.
+
+    Jumps are mostly forward so most programs halt, and faults from PUSH and
+    POP go to a handler which returns to the next instruction.
+    """
+    labels = ["l{}".format(index) for index in range(length)]
+    lines = [".vec.reset @l0", ".vec.fault @handler", ".sec code"]
+    for index in range(length):
+        forward = labels[index + 1:] or ["handler"]
+        choice = random.random()
+        if choice < 0.15:
+            instruction = "{} 0x{:03x}".format(random.choice(["xor", "and", "add"]), random.randrange(0x1000))
+        elif choice < 0.25:
+            instruction = "{} 0x{:03x}".format(random.choice(["lshft", "rshft"]), random.randrange(0x1000))
+        elif choice < 0.35:
+            instruction = "load @{}".format(random.choice(DATA_LABELS + labels))
+        elif choice < 0.45:
+            instruction = "{} @{}".format(random.choice(["store", "sfull"]), random.choice(DATA_LABELS))
+        elif choice < 0.58:
+            instruction = "{} @{}".format(random.choice(["store", "sfull"]), random.choice(["ASCII_OUT", "SMALL_OUT"]))
+        elif choice < 0.65:
+            instruction = "jump @{}".format(random.choice(forward))
+        elif choice < 0.75:
+            instruction = "jumpz @{}".format(random.choice(forward if random.random() < 0.9 else labels))
+        elif choice < 0.82:
+            instruction = random.choice(["push", "pop"])
+        elif choice < 0.86:
+            instruction = random.choice(["noop", "reserved1", "reserved2"])
+        elif choice < 0.88:
+            instruction = "halt"
+        elif choice < 0.9:
+            # Self-modifying code
+            instruction = "store @{}".format(random.choice(forward))
+        else:
+            instruction = "add @{}".format(random.choice(DATA_LABELS + labels))
+        lines.append("{}: {}".format(labels[index], instruction))
+    lines.append("    sfull @ASCII_OUT")
+    lines.append("    halt")
+    lines.append("handler:")
+    lines.append("    sfull @ASCII_OUT")
+    lines.append("    load @INTERRUPT_RETURN")
+    lines.append("    store @handler_return")
+    lines.append("    load @INTERRUPT_REASON")
+    lines.append("handler_return: jump 0")
+    lines.append(".sec data")
+    for label in DATA_LABELS:
+        lines.append("{}: .const 0x{:04x}".format(label, random.randrange(0x10000)))
+    return "\n".join(lines) + "\n"
+
+
+def collect_programs(patterns: List[str]) -> Iterator[Program]:
+    """Collect assembly files matching glob patterns, or in directories."""
+    for pattern in patterns:
+        if path.isdir(pattern):
+            pattern = path.join(pattern, "**", "*.a16")
+        for file_path in sorted(glob(pattern, recursive=True)):
+            with open(file_path, "r") as source_handle:
+                yield Program(name=path.relpath(file_path), source=source_handle.read())
+
+
+def run_model(image: bytes, max_instructions: int) -> RunResult:
+    """Run a memory image on the Python model."""
+    emulator = Emulator.from_bin(image)
+    emulator.run(max_instructions)
+    return RunResult(halted=emulator.halt, output=bytes(emulator.output))
+
+
+def run_vm(vm_path: str, image: bytes, directory: str, timeout: float) -> RunResult:
+    """Run a memory image on the compiled VM, which counts as not halting if it times out."""
+    image_path = path.join(directory, "{}.bin".format(get_ident()))
+    with open(image_path, "wb") as image_handle:
+        image_handle.write(image)
+    try:
+        completed = run_subprocess([vm_path, image_path], stdin=DEVNULL, stdout=PIPE, stderr=PIPE, timeout=timeout)
+    except TimeoutExpired as error:
+        return RunResult(halted=False, output=error.stdout or b"")
+    if completed.returncode == 0 and completed.stdout.endswith(VM_HALT_OUTPUT):
+        return RunResult(halted=True, output=completed.stdout[:-len(VM_HALT_OUTPUT)])
+    return RunResult(halted=False, output=completed.stdout + completed.stderr)
+
+
+def check_source(source: str, vm_path: str, directory: str, timeout: float, max_instructions: int) -> CaseResult:
+    """Check a program, returning a passed, skipped or diverged result.
+
+    Programs which fail to assemble, assemble to nothing, or do not halt on
+    the model within max_instructions, are skipped as there is nothing to
+    compare.
+    """
+    program = Program(name="", source=source)
+    try:
+        assembled = Assembler().assemble_text(source)
+    except AssemblyError as error:
+        return CaseResult(program, "skipped", "assembly failed: {}".format(error))
+    if not assembled.words:
+        return CaseResult(program, "skipped", "nothing was assembled")
+    image = assembled.serialise("bin")
+
+    expected = run_model(image, max_instructions)
+    if not expected.halted:
+        return CaseResult(program, "skipped", "did not halt within {} instructions".format(max_instructions))
+
+    actual = run_vm(vm_path, image, directory, timeout)
+    if actual != expected:
+        return CaseResult(program, "diverged", "expected {}, sma16vm gave {}".format(expected, actual))
+    return CaseResult(program, "passed")
+
+
+def shrink(source: str, vm_path: str, directory: str, timeout: float, max_instructions: int) -> str:
+    """Shrink a diverging program by removing lines while it still diverges.
+
+    Labels are first moved onto lines of their own, so an instruction can be
+    removed while references to its label still resolve.
+    """
+    lines = []
+    for line in source.splitlines():
+        label, separator, rest = line.partition(":")
+        if separator and label.strip().isidentifier() and rest.strip():
+            lines.extend([label + ":", "    " + rest.strip()])
+        else:
+            lines.append(line)
+    chunk = len(lines) // 2
+    while chunk >= 1:
+        start = 0
+        while start < len(lines):
+            candidate = lines[:start] + lines[start + chunk:]
+            result = check_source("\n".join(candidate) + "\n", vm_path, directory, timeout, max_instructions)
+            if result.status == "diverged":
+                lines = candidate
+            else:
+                start += chunk
+        chunk //= 2
+    return "\n".join(lines) + "\n"
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("PROGRAMS", nargs="*", help="assembly files, glob patterns or directories to check")
+    argument_parser.add_argument("-c", "--count", type=int, default=1000, help="number of programs to generate")
+    argument_parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the first generated program")
+    argument_parser.add_argument("-l", "--length", type=int, default=48, help="instructions per generated program")
+    argument_parser.add_argument("-j", "--jobs", type=int, default=cpu_count() or 1, help="number of concurrent VMs")
+    argument_parser.add_argument("--vm", default=DEFAULT_VM, help="compiled sma16vm to check")
+    argument_parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a VM run is abandoned")
+    argument_parser.add_argument("-n",
+                                 "--max-instructions",
+                                 type=int,
+                                 default=100000,
+                                 help="instructions before a model run is abandoned")
+    argument_parser.add_argument("-f", "--failures", default=None, help="write shrunk diverging programs here")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    if not path.isfile(parsed_arguments.vm):
+        print("VM {} does not exist, build it with make.".format(parsed_arguments.vm))
+        return 3
+
+    programs = list(collect_programs(parsed_arguments.PROGRAMS))
+    for seed in range(parsed_arguments.seed, parsed_arguments.seed + parsed_arguments.count):
+        programs.append(Program(name="seed {}".format(seed),
+                                source=generate_program(Random(seed), parsed_arguments.length)))
+
+    vm_path = path.abspath(parsed_arguments.vm)
+    timeout = parsed_arguments.timeout
+    max_instructions = parsed_arguments.max_instructions
+
+    with TemporaryDirectory() as directory:
+
+        def check_program(program: Program) -> CaseResult:
+            return check_source(program.source, vm_path, directory, timeout, max_instructions)
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=max(parsed_arguments.jobs, 1)) as executor:
+            results = list(executor.map(check_program, programs))
+        seconds = perf_counter() - start
+
+        counts = {"passed": 0, "skipped": 0, "diverged": 0}
+        for program, result in zip(programs, results):
+            counts[result.status] += 1
+            if result.status != "diverged":
+                continue
+            shrunk = shrink(program.source, vm_path, directory, timeout, max_instructions)
+            print("{} diverged: {}".format(program.name, result.detail), file=stderr)
+            print(shrunk, file=stderr)
+            if parsed_arguments.failures:
+                makedirs(parsed_arguments.failures, exist_ok=True)
+                failure_name = program.name.replace(" ", "_").replace(path.sep, "_")
+                with open(path.join(parsed_arguments.failures, failure_name + ".a16"), "w") as failure_handle:
+                    failure_handle.write(shrunk)
+
+    print("{} programs, {} passed, {} skipped, {} diverged in {:.3f}s ({:.0f} programs per second).".format(
+        len(programs), counts["passed"], counts["skipped"], counts["diverged"], seconds,
+        len(programs) / seconds if seconds > 0 else 0.0))
+
+    return 1 if counts["diverged"] else 0
+
+
+if __name__ == "__main__":
+    exit(main())
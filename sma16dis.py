@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""SMA16 disassembler.
+
+Turns memory images and machine state dumps back into assembly which
+assembles to the same image. Words are streamed through, so memory use does
+not grow with the size of the input.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from array import array
+from dataclasses import dataclass, field
+from json import loads as json_loads
+from os import path
+from re import sub
+from sys import byteorder, stderr, stdout
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from sma16asm import CONSTANTS, REGIONS, SEGMENT_IMAGE_MAGIC, VECTORS, Instruction
+from sma16emu import MEMORY_SIZE, MachineState
+
+# Words read from a .bin image at a time
+CHUNK_WORDS = 1024
+
+# Runs of at least this many unlabelled zero words are left out, and a new section is started after them
+GAP_WORDS = 4
+
+# Memory below this is the vectors and configuration, which cannot be assembled into directly
+USER_MEMORY_START = max(region.end for region in REGIONS.values()) + 1
+
+VECTOR_NAMES = {vector.address: name for name, vector in VECTORS.items()}
+
+CONSTANT_NAMES = {address: name for name, address in CONSTANTS.items()}
+
+SMALL_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 _"
+
+ASCII_ESCAPES = {0: "\\x00", 0x07: "\\a", 0x08: "\\b", 0x09: "\\t", 0x0a: "\\n", 0x0b: "\\v", 0x0c: "\\f", 0x0d: "\\r"}
+
+
+@dataclass
+class Opcode:
+    """How to render an instruction."""
+
+    mnemonic: str
+    address_operand: bool
+
+
+OPCODE_TABLE = [
+    Opcode(mnemonic=instruction.name.lower(),
+           address_operand=instruction in (Instruction.JUMP, Instruction.JUMPZ, Instruction.LOAD, Instruction.STORE,
+                                           Instruction.SFULL)) for instruction in sorted(Instruction)
+]
+
+
+def _ascii_character(value: int) -> Optional[str]:
+    if value in ASCII_ESCAPES:
+        return ASCII_ESCAPES[value]
+    if value < 0x20 or value > 0x7e:
+        return None
+    return "\\" + chr(value) if chr(value) in "\\\"'" else chr(value)
+
+
+ASCII_TABLE = [_ascii_character(value) for value in range(0x100)]
+
+SMALL_TABLE = ["s\"{}{}\"".format(SMALL_CHARACTERS[value >> 6], SMALL_CHARACTERS[value & 0x3f])
+               for value in range(0x1000)]
+
+
+def data_forms(value: int) -> List[str]:
+    """Get the string and character constants which assemble to a word."""
+    forms = []
+    if value <= 0xfff:
+        forms.append(SMALL_TABLE[value])
+    low, high = ASCII_TABLE[value & 0xff], ASCII_TABLE[value >> 8]
+    if low is not None and value <= 0xff:
+        forms.append("a'{}'".format(low))
+    elif low is not None and high is not None:
+        forms.append("a\"{}{}\"".format(low, high))
+    return forms
+
+
+@dataclass
+class Symbols:
+    """Labels by address, and the reference assembled into each address where it is known."""
+
+    labels: Dict[int, List[str]] = field(default_factory=dict)
+    references: Dict[int, str] = field(default_factory=dict)
+    addresses: Dict[str, int] = field(default_factory=dict)
+
+    def add_label(self, address: int, name: str):
+        """Add a label, ignoring the predefined constants.
+
+        Names which cannot be assembled, such as the module qualified names in
+        the map of a linked program, are made into unique valid labels.
+        """
+        if CONSTANTS.get(name) == address:
+            return
+        label = sub(r"\W", "_", name)
+        if label[:1].isdigit():
+            label = "_" + label
+        while label != name and (label in self.addresses or label in CONSTANTS):
+            label += "_"
+        self.addresses[label] = address
+        self.labels.setdefault(address, []).append(label)
+
+    def address(self, name: str) -> Optional[int]:
+        """Get the address of a label or a predefined constant."""
+        return self.addresses.get(name, CONSTANTS.get(name))
+
+    def name(self, address: int) -> Optional[str]:
+        """Get a name for an address."""
+        labels = self.labels.get(address)
+        return labels[0] if labels else CONSTANT_NAMES.get(address)
+
+
+def load_symbols(file_path: str) -> Symbols:
+    """Load symbols from a map file, as produced by serialise_to_map_file, or a debug file."""
+    symbols = Symbols()
+    with open(file_path, "r") as symbols_handle:
+        text = symbols_handle.read()
+
+    if text.lstrip().startswith("{"):
+        source_map = json_loads(text)
+        for name, address in source_map["symbols"].items():
+            symbols.add_label(address, name)
+        for address, entry in source_map["addresses"].items():
+            if entry.get("reference"):
+                symbols.references[int(address, 16)] = entry["reference"]
+        return symbols
+
+    # Debug files list every reference as " *   - 0x010 -> name" in their header
+    for line in text.splitlines():
+        if line.startswith(" */"):
+            break
+        if line.startswith(" *   - 0x") and " -> " in line:
+            address, name = line[len(" *   - "):].split(" -> ")
+            symbols.add_label(int(address, 16), name.strip())
+    return symbols
+
+
+def _read(input_handle: BinaryIO, size: int) -> bytes:
+    # Unbuffered files and pipes may return fewer bytes than asked for before the end of the input
+    data = b""
+    while len(data) < size:
+        chunk = input_handle.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_bin_words(input_handle: BinaryIO, prefix: bytes = b"") -> Iterator[Tuple[int, int]]:
+    """Read (address, word) pairs from a dense image, as produced by serialise_to_bin_file.
+
+    prefix is any of the image already read from input_handle.
+    """
+    address = 0
+    while address < MEMORY_SIZE:
+        chunk = prefix + _read(input_handle, 2 * min(CHUNK_WORDS, MEMORY_SIZE - address) - len(prefix))
+        prefix = b""
+        words = array("H", chunk[:len(chunk) - len(chunk) % 2])
+        if not words:
+            return
+        if byteorder == "little":
+            words.byteswap()
+        for word in words:
+            yield address, word
+            address += 1
+
+
+def read_hex_words(input_handle: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """Read (address, word) pairs from a hex image, as produced by serialise_to_hex_file."""
+    address = 0
+    for line in input_handle:
+        line = line.strip()
+        for offset in range(0, len(line) - 3, 4):
+            if address >= MEMORY_SIZE:
+                return
+            try:
+                yield address, int(line[offset:offset + 4], 16)
+            except ValueError as error:
+                raise ValueError("invalid hex image") from error
+            address += 1
+
+
+def read_segment_words(input_handle: BinaryIO, prefix: bytes = b"") -> Iterator[Tuple[int, int]]:
+    """Read (address, word) pairs from a sparse image, as produced by serialise_to_segment_file.
+
+    prefix is any of the image already read from input_handle.
+    """
+    header = prefix + _read(input_handle, len(SEGMENT_IMAGE_MAGIC) + 2 - len(prefix))
+    for _ in range(int.from_bytes(header[len(SEGMENT_IMAGE_MAGIC):], "big")):
+        segment_header = _read(input_handle, 4)
+        start = int.from_bytes(segment_header[:2], "big")
+        length = int.from_bytes(segment_header[2:], "big")
+        if len(segment_header) != 4 or start + length > MEMORY_SIZE:
+            raise ValueError("invalid segment image")
+        for offset in range(0, length, CHUNK_WORDS):
+            chunk = _read(input_handle, 2 * min(CHUNK_WORDS, length - offset))
+            words = array("H", chunk[:len(chunk) - len(chunk) % 2])
+            if len(words) != min(CHUNK_WORDS, length - offset):
+                raise ValueError("invalid segment image")
+            if byteorder == "little":
+                words.byteswap()
+            for index, word in enumerate(words):
+                yield start + offset + index, word
+
+
+def read_words(input_handle: BinaryIO, input_format: str) -> Iterator[Tuple[int, int]]:
+    """Read (address, word) pairs in address order from an image or machine state."""
+    if input_format == "hex":
+        return read_hex_words(input_handle)
+    if input_format == "snap":
+        return enumerate(MachineState.load(input_handle.read()).memory)
+    # The magic is read rather than peeked at, as unbuffered files and pipes cannot peek
+    prefix = _read(input_handle, len(SEGMENT_IMAGE_MAGIC))
+    if prefix == SEGMENT_IMAGE_MAGIC:
+        return read_segment_words(input_handle, prefix)
+    return read_bin_words(input_handle, prefix)
+
+
+def render_word(address: int, value: int, symbols: Symbols) -> List[str]:
+    """Render a word as a comment giving its address and data forms, followed by it as an instruction."""
+    opcode = OPCODE_TABLE[value >> 12]
+    data = value & 0xfff
+    reference = symbols.references.get(address)
+    # A private label of a linked module is referenced by its unqualified name, which may belong to another module
+    if reference is not None and symbols.address(reference) != data:
+        reference = None
+    if reference is None and opcode.address_operand and data:
+        reference = symbols.name(data)
+
+    if reference is not None:
+        instruction = "{} @{}".format(opcode.mnemonic, reference)
+    elif data:
+        instruction = "{} 0x{:03x}".format(opcode.mnemonic, data)
+    else:
+        instruction = opcode.mnemonic
+
+    lines = [label + ":" for label in symbols.labels.get(address, [])]
+    lines.append("    # 0x{:03x}: {}".format(address, " ".join(["0x{:04x}".format(value)] + data_forms(value))))
+    lines.append("    " + instruction)
+    return lines
+
+
+def render_reserved_word(address: int, value: int, symbols: Symbols) -> List[str]:
+    """Render a word in the vectors or configuration, as a vector directive where possible."""
+    if address in VECTOR_NAMES and value >> 12 == Instruction.JUMP:
+        target = value & 0xfff
+        if symbols.name(target) is None and target >= USER_MEMORY_START:
+            symbols.add_label(target, "l_{:03x}".format(target))
+        if symbols.name(target) is not None:
+            return [".vec.{} @{}".format(VECTOR_NAMES[address], symbols.name(target))]
+    return ["# 0x{:03x}: 0x{:04x} cannot be assembled".format(address, value)]
+
+
+def disassemble(words: Iterable[Tuple[int, int]], symbols: Symbols) -> Iterator[str]:
+    """Disassemble (address, word) pairs, which must be in address order, into lines of assembly.
+
+    Each contiguous run of memory becomes a section pinned at its address.
+    Runs of unlabelled zero words are left out, as unused memory is zero, but
+    a zero word is written wherever a label needs defining.
+    """
+    next_address = -1
+    zeros_start = 0
+    zeros = 0
+    labelled: List[int] = []
+    labelled_index = 0
+
+    def emit(address: int, value: int) -> Iterator[str]:
+        nonlocal next_address, zeros
+        if zeros and zeros_start == next_address and zeros_start + zeros == address and zeros < GAP_WORDS:
+            for zero_address in range(zeros_start, address):
+                yield from render_word(zero_address, 0, symbols)
+        elif address != next_address:
+            yield ""
+            yield ".sec s_{0:03x} 0x{0:03x}".format(address)
+        yield from render_word(address, value, symbols)
+        next_address = address + 1
+        zeros = 0
+
+    def emit_labelled(before: int) -> Iterator[str]:
+        nonlocal labelled_index
+        while labelled_index < len(labelled) and labelled[labelled_index] < before:
+            if labelled[labelled_index] >= next_address:
+                yield from emit(labelled[labelled_index], 0)
+            labelled_index += 1
+
+    for address, value in words:
+        if address < USER_MEMORY_START:
+            if value:
+                yield from render_reserved_word(address, value, symbols)
+            continue
+        if next_address < 0:
+            # Vectors come first, so every label is known by now
+            labelled = sorted(label_address for label_address in symbols.labels if label_address >= USER_MEMORY_START)
+            next_address = 0
+        yield from emit_labelled(address)
+        if value or address in symbols.labels:
+            yield from emit(address, value)
+        else:
+            if not zeros or zeros_start + zeros != address:
+                zeros_start, zeros = address, 0
+            zeros += 1
+
+    if next_address < 0:
+        labelled = sorted(label_address for label_address in symbols.labels if label_address >= USER_MEMORY_START)
+    # Short runs of zeros at the end are kept, as they are usually the end of a section
+    if zeros and zeros_start == next_address and zeros < GAP_WORDS:
+        for zero_address in range(zeros_start, zeros_start + zeros):
+            yield from render_word(zero_address, 0, symbols)
+        next_address, zeros = zeros_start + zeros, 0
+    yield from emit_labelled(MEMORY_SIZE)
+
+
+INPUT_FORMATS = {".hex": "hex", ".snap": "snap"}
+
+
+def get_input_path(pattern: str, input_file: str) -> str:
+    """Get a path for an input file from a pattern containing {stem} and {name}."""
+    name = path.basename(input_file)
+    stem, _ = path.splitext(name)
+    return pattern.format(stem=stem, name=name)
+
+
+def disassemble_file(input_file: str, output_handle: TextIO, symbols: Symbols):
+    """Disassemble a file, writing assembly as it is produced."""
+    input_format = INPUT_FORMATS.get(path.splitext(input_file)[1], "bin")
+    with open(input_file, "rb") as input_handle:
+        output_handle.write("# Disassembled from {} by sma16dis.py\n".format(path.basename(input_file)))
+        for line in disassemble(read_words(input_handle, input_format), symbols):
+            output_handle.write(line + "\n")
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("INPUTS", nargs="+", help="memory images (.bin, .hex or .seg) or machine states")
+    argument_parser.add_argument("-o",
+                                 "--output",
+                                 default=None,
+                                 help="output file, directory, or pattern using {stem} and {name}, default is stdout")
+    argument_parser.add_argument("-s",
+                                 "--symbols",
+                                 default=None,
+                                 help="map or debug file to take labels from, or a pattern using {stem} and {name}")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    exit_code = 0
+    for input_file in parsed_arguments.INPUTS:
+        if not path.isfile(input_file):
+            print("Input file {} does not exist.".format(input_file), file=stderr)
+            exit_code = 3
+            continue
+
+        symbols = Symbols()
+        if parsed_arguments.symbols:
+            symbols_file = get_input_path(parsed_arguments.symbols, input_file)
+            # A pattern may match no symbols for some inputs
+            if path.isfile(symbols_file):
+                symbols = load_symbols(symbols_file)
+            elif "{" not in parsed_arguments.symbols:
+                print("Symbols file {} does not exist.".format(symbols_file), file=stderr)
+                return 3
+
+        output = parsed_arguments.output
+        try:
+            if output is None:
+                disassemble_file(input_file, stdout, symbols)
+                continue
+            if path.isdir(output):
+                output = path.join(output, "{stem}.a16")
+            with open(get_input_path(output, input_file), "w") as output_handle:
+                disassemble_file(input_file, output_handle, symbols)
+        except ValueError as error:
+            print("Disassembling {} failed: {}.".format(input_file, error), file=stderr)
+            exit_code = 1
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+"""SMA16 emulator.
+
+Runs assembled programs in-process with the same semantics as sma16vm.c.
+"""
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from array import array
+from dataclasses import dataclass
+from os import path
+from struct import calcsize
+from struct import pack as struct_pack
+from struct import unpack_from as struct_unpack_from
+from sys import byteorder, maxsize, stderr, stdout
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from zlib import compress, decompress
+from zlib import error as ZlibError
+
+from sma16asm import (CONSTANTS, REGIONS, SEGMENT_IMAGE_MAGIC, AddressValue, AssemblyError, Instruction, ReferenceTable,
+                      RegionTable, SymbolIndex, assemble_items, serialise_to_debug_file)
+
+MEMORY_SIZE = 0x1000
+
+ASCII_OUT = CONSTANTS["ASCII_OUT"]
+SMALL_OUT = CONSTANTS["SMALL_OUT"]
+INTERRUPT_REASON = CONSTANTS["INTERRUPT_REASON"]
+INTERRUPT_RETURN = CONSTANTS["INTERRUPT_RETURN"]
+FAULT_VECTOR = CONSTANTS["FAULT_VECTOR"]
+
+INTERRUPT_REASON_UNSUPPORTED = 0x0ff0
+
+
+def transform_small_character(x: int) -> bytes:
+    """Transform a small encoded character to an ASCII byte, as transform_char in sma16vm.c."""
+    if 0 <= x < 26:
+        return bytes((x + ord("A"), ))
+    if 26 <= x < 52:
+        return bytes((x - 26 + ord("a"), ))
+    if 52 <= x < 62:
+        return bytes((x - 52 + ord("0"), ))
+    if x == 62:
+        return b" "
+    return b"\0"
+
+
+def small_output(accumulator: int) -> bytes:
+    """Get the console output for a value written to SMALL_OUT.
+
+    This mirrors sma16vm.c exactly, which compares the encoded characters
+    against zero, so an encoded 'A' is omitted and an encoded NULL is sent.
+    """
+    first_character = 0x3f & (accumulator >> 6)
+    second_character = 0x3f & accumulator
+    output = b""
+    if first_character != 0:
+        output += transform_small_character(first_character)
+    if second_character != 0:
+        output += transform_small_character(second_character)
+    return output
+
+
+SMALL_OUTPUT_TABLE = [small_output(value) for value in range(0x1000)]
+
+
+def load_image(resolved_items: Iterable[AddressValue]) -> array:
+    """Create a memory array from resolved address values."""
+    memory = array("H", bytes(2 * MEMORY_SIZE))
+    for item in resolved_items:
+        memory[item.address & 0xfff] = item.value & 0xffff
+    return memory
+
+
+def load_segment_image(image: bytes) -> array:
+    """Create a memory array from a sparse memory image, as produced by serialise_to_segment_file."""
+    memory = array("H", bytes(2 * MEMORY_SIZE))
+    offset = len(SEGMENT_IMAGE_MAGIC)
+    segment_count = int.from_bytes(image[offset:offset + 2], "big")
+    offset += 2
+    for _ in range(segment_count):
+        start = int.from_bytes(image[offset:offset + 2], "big")
+        length = int.from_bytes(image[offset + 2:offset + 4], "big")
+        offset += 4
+        words = array("H", image[offset:offset + 2 * length])
+        if len(words) != length or start + length > MEMORY_SIZE:
+            raise ValueError("invalid segment image")
+        if byteorder == "little":
+            words.byteswap()
+        memory[start:start + length] = words
+        offset += 2 * length
+    return memory
+
+
+def load_bin_image(image: bytes) -> array:
+    """Create a memory array from a memory image, as produced by serialise_to_bin_file.
+
+    Sparse memory images, which start with SEGMENT_IMAGE_MAGIC, are also
+    accepted, as they are by sma16vm.c.
+    """
+    if image.startswith(SEGMENT_IMAGE_MAGIC):
+        return load_segment_image(image)
+    memory = array("H", bytes(2 * MEMORY_SIZE))
+    words = array("H", image[:min(len(image) - len(image) % 2, 2 * MEMORY_SIZE)])
+    if byteorder == "little":
+        words.byteswap()
+    memory[:len(words)] = words
+    return memory
+
+
+@dataclass
+class RunStatistics:
+    """Statistics from a run of the emulator."""
+
+    instructions: int
+    seconds: float
+
+    @property
+    def instructions_per_second(self) -> float:
+        """Get the execution rate."""
+        if self.seconds <= 0:
+            return 0.0
+        return self.instructions / self.seconds
+
+
+MACHINE_STATE_MAGIC = b"S16M"
+MACHINE_STATE_HEADER = ">4sHHB"
+MACHINE_STATE_HALT = 0x1
+MACHINE_STATE_TEST = 0x2
+
+
+@dataclass
+class MachineState:
+    """A snapshot of an SMA16 machine, holding exactly the state sma16vm.c has.
+
+    Console output and instruction counts belong to a run rather than the
+    machine, so are not part of the state.
+    """
+
+    memory: array
+    accumulator: int = 0
+    program_counter: int = 0
+    halt: bool = False
+    test: bool = False
+
+    def serialise(self) -> bytes:
+        """Serialise the state as a header followed by compressed big endian memory."""
+        memory = array("H", self.memory)
+        if byteorder == "little":
+            memory.byteswap()
+        flags = (MACHINE_STATE_HALT if self.halt else 0) | (MACHINE_STATE_TEST if self.test else 0)
+        return struct_pack(MACHINE_STATE_HEADER, MACHINE_STATE_MAGIC, self.accumulator, self.program_counter,
+                           flags) + compress(memory.tobytes(), 1)
+
+    @classmethod
+    def load(cls, state_bytes: bytes) -> "MachineState":
+        """Load a state serialised with serialise."""
+        header_size = calcsize(MACHINE_STATE_HEADER)
+        if len(state_bytes) < header_size or not state_bytes.startswith(MACHINE_STATE_MAGIC):
+            raise ValueError("not an SMA16 machine state")
+        _, accumulator, program_counter, flags = struct_unpack_from(MACHINE_STATE_HEADER, state_bytes)
+        try:
+            memory = array("H", decompress(state_bytes[header_size:]))
+        except ZlibError as error:
+            raise ValueError("machine state memory is corrupt") from error
+        if len(memory) != MEMORY_SIZE:
+            raise ValueError("machine state memory is corrupt")
+        if byteorder == "little":
+            memory.byteswap()
+        return cls(memory=memory,
+                   accumulator=accumulator,
+                   program_counter=program_counter,
+                   halt=bool(flags & MACHINE_STATE_HALT),
+                   test=bool(flags & MACHINE_STATE_TEST))
+
+
+class Emulator:
+    """An SMA16 machine.
+
+    Opcodes are dispatched through a table indexed by Instruction, with each
+    handler matching the corresponding case of the switch in sma16vm.c.
+    """
+
+    def __init__(self, memory: Optional[array] = None):
+        self.memory = memory if memory is not None else array("H", bytes(2 * MEMORY_SIZE))
+        self.accumulator = 0
+        self.program_counter = 0
+        self.halt = False
+        self.test = False
+        self.output = bytearray()
+        self.instructions = 0
+
+        handlers: Dict[Instruction, Callable[[int], None]] = {
+            Instruction.HALT: self._halt,
+            Instruction.RESERVED1: self._noop,
+            Instruction.JUMP: self._jump,
+            Instruction.JUMPZ: self._jumpz,
+            Instruction.LOAD: self._load,
+            Instruction.STORE: self._store,
+            Instruction.LSHFT: self._lshft,
+            Instruction.RSHFT: self._rshft,
+            Instruction.XOR: self._xor,
+            Instruction.AND: self._and,
+            Instruction.SFULL: self._sfull,
+            Instruction.ADD: self._add,
+            Instruction.RESERVED2: self._noop,
+            Instruction.POP: self._pop,
+            Instruction.PUSH: self._push,
+            Instruction.NOOP: self._noop,
+        }
+        self.dispatch_table: List[Callable[[int], None]] = [handlers[instruction] for instruction in Instruction]
+
+    @classmethod
+    def from_items(cls, resolved_items: Iterable[AddressValue]) -> "Emulator":
+        """Create a machine from resolved address values."""
+        return cls(load_image(resolved_items))
+
+    @classmethod
+    def from_bin(cls, image: bytes) -> "Emulator":
+        """Create a machine from a memory image."""
+        return cls(load_bin_image(image))
+
+    @classmethod
+    def from_state(cls, state: MachineState) -> "Emulator":
+        """Create a machine from a snapshot, which is left unchanged."""
+        emulator = cls(state.memory[:])
+        emulator.restore(state)
+        return emulator
+
+    def snapshot(self) -> MachineState:
+        """Take a snapshot of the machine, copying memory as a single block."""
+        return MachineState(memory=self.memory[:],
+                            accumulator=self.accumulator,
+                            program_counter=self.program_counter,
+                            halt=self.halt,
+                            test=self.test)
+
+    def restore(self, state: MachineState):
+        """Restore the machine to a snapshot, copying memory in place so the snapshot can be restored again."""
+        self.memory[:] = state.memory
+        self.accumulator = state.accumulator
+        self.program_counter = state.program_counter
+        self.halt = state.halt
+        self.test = state.test
+
+    def _halt(self, data: int):
+        self.halt = True
+        self.program_counter += 1
+
+    def _jump(self, data: int):
+        self.program_counter = data
+
+    def _jumpz(self, data: int):
+        if self.test:
+            self.program_counter = data
+        else:
+            self.program_counter += 1
+
+    def _load(self, data: int):
+        self.accumulator = self.memory[data]
+        self.program_counter += 1
+
+    def _write_output(self, address: int):
+        if address == SMALL_OUT:
+            self.output += SMALL_OUTPUT_TABLE[self.accumulator & 0xfff]
+        elif address == ASCII_OUT:
+            self.output.append(self.accumulator & 0xff)
+
+    def _store(self, data: int):
+        self._write_output(data)
+        self.memory[data] = (self.memory[data] & 0xf000) | (self.accumulator & 0x0fff)
+        self.program_counter += 1
+
+    def _sfull(self, data: int):
+        self._write_output(data)
+        self.memory[data] = self.accumulator
+        self.program_counter += 1
+
+    def _lshft(self, data: int):
+        accumulator = self.accumulator
+        upper = accumulator & 0xf000
+        if data & 0x1:
+            accumulator &= 0x0fff
+        accumulator = (accumulator << (data >> 1)) & 0xffff
+        if data & 0x1:
+            accumulator = (accumulator & 0x0fff) | upper
+        self.accumulator = accumulator
+        self.program_counter += 1
+
+    def _rshft(self, data: int):
+        accumulator = self.accumulator
+        upper = accumulator & 0xf000
+        if data & 0x1:
+            accumulator &= 0x0fff
+        accumulator >>= data >> 1
+        if data & 0x1:
+            accumulator = (accumulator & 0x0fff) | upper
+        self.accumulator = accumulator
+        self.program_counter += 1
+
+    def _xor(self, data: int):
+        self.accumulator ^= data
+        self.program_counter += 1
+
+    def _and(self, data: int):
+        self.accumulator &= data | 0xf000
+        self.program_counter += 1
+
+    def _add(self, data: int):
+        accumulator = self.accumulator
+        accumulator = (accumulator & 0xf000) | ((accumulator + data) & 0x0fff)
+        self.test = accumulator == 0
+        self.accumulator = accumulator
+        self.program_counter += 1
+
+    def _fault(self, instruction: Instruction):
+        self.memory[INTERRUPT_RETURN] = (self.program_counter + 1) & 0xffff
+        self.program_counter = FAULT_VECTOR
+        self.memory[INTERRUPT_REASON] = INTERRUPT_REASON_UNSUPPORTED + instruction
+
+    def _pop(self, data: int):
+        self._fault(Instruction.POP)
+
+    def _push(self, data: int):
+        self._fault(Instruction.PUSH)
+
+    def _noop(self, data: int):
+        self.program_counter += 1
+
+    def step(self):
+        """Execute a single instruction."""
+        self.program_counter &= 0xfff
+        word = self.memory[self.program_counter]
+        self.dispatch_table[word >> 12](word & 0x0fff)
+        self.instructions += 1
+
+    def run(self, max_instructions: Optional[int] = None) -> RunStatistics:
+        """Run until halted, or until max_instructions have been executed."""
+        memory = self.memory
+        dispatch_table = self.dispatch_table
+        executed = 0
+        start = perf_counter()
+        while not self.halt and (max_instructions is None or executed < max_instructions):
+            self.program_counter &= 0xfff
+            word = memory[self.program_counter]
+            dispatch_table[word >> 12](word & 0x0fff)
+            executed += 1
+        seconds = perf_counter() - start
+        self.instructions += executed
+        return RunStatistics(instructions=executed, seconds=seconds)
+
+
+MAX_BLOCK_LENGTH = 64
+
+BlockFunction = Callable[[int, bool, int], Tuple[int, int, bool, bool, int]]
+Block = Tuple[BlockFunction, int, List[int], Set[int]]
+
+
+class TranslatingEmulator(Emulator):
+    """An SMA16 machine which caches translated basic blocks.
+
+    Straight-line runs of instructions are decoded once into a Python function.
+    Unconditional jumps (and faults) are followed into their target, JUMPZ
+    becomes a side exit, and a block which jumps back to its own start loops
+    without returning to the dispatcher. Any STORE or SFULL to an address
+    covered by a cached block invalidates that block, so self-modifying code
+    behaves exactly as it does when stepping one instruction at a time.
+    """
+
+    def __init__(self, memory: Optional[array] = None):
+        super().__init__(memory)
+        self.block_cache: List[Optional[Block]] = [None] * MEMORY_SIZE
+        self.block_coverage: List[List[int]] = [[] for _ in range(MEMORY_SIZE)]
+        # The number of cached blocks covering each address, which can be more than a byte holds
+        self.covered = [0] * MEMORY_SIZE
+        self.store_watchers: List[Set[int]] = [set() for _ in range(MEMORY_SIZE)]
+        self.translations = 0
+        self.invalidations = 0
+
+    def invalidate(self, address: int, current_block: int = -1) -> bool:
+        """Drop all cached blocks covering an address.
+
+        Returns whether current_block was one of the dropped blocks.
+        """
+        block_starts = self.block_coverage[address]
+        dropped_current = current_block in block_starts
+        for block_start in list(block_starts):
+            self._drop_block(block_start)
+        return dropped_current
+
+    def _drop_block(self, block_start: int):
+        block = self.block_cache[block_start]
+        if block is None:
+            return
+        _, _, covered_addresses, unchecked_targets = block
+        self.block_cache[block_start] = None
+        for covered_address in covered_addresses:
+            self.block_coverage[covered_address].remove(block_start)
+            self.covered[covered_address] -= 1
+        for target in unchecked_targets:
+            self.store_watchers[target].discard(block_start)
+        self.invalidations += 1
+
+    def restore(self, state: MachineState):
+        """Restore the machine to a snapshot, dropping every translated block."""
+        super().restore(state)
+        for block_start, block in enumerate(self.block_cache):
+            if block is not None:
+                self._drop_block(block_start)
+
+    def _store(self, data: int):
+        super()._store(data)
+        if self.covered[data]:
+            self.invalidate(data)
+
+    def _sfull(self, data: int):
+        super()._sfull(data)
+        if self.covered[data]:
+            self.invalidate(data)
+
+    def _fault(self, instruction: Instruction):
+        super()._fault(instruction)
+        for address in (INTERRUPT_RETURN, INTERRUPT_REASON):
+            if self.covered[address]:
+                self.invalidate(address)
+
+    def _decode(self, start: int) -> Tuple[List[Tuple[int, int, int]], int, bool, bool]:
+        """Decode a trace of instructions from an address.
+
+        Returns the decoded (address, instruction, data) triples, the address
+        execution continues at, and whether the trace halts or loops.
+        """
+        memory = self.memory
+        decoded: List[Tuple[int, int, int]] = []
+        visited: Set[int] = set()
+        address = start
+        while len(decoded) < MAX_BLOCK_LENGTH and address < MEMORY_SIZE:
+            if address in visited:
+                return decoded, address, False, address == start
+            visited.add(address)
+            word = memory[address]
+            instruction = word >> 12
+            data = word & 0x0fff
+            decoded.append((address, instruction, data))
+            if instruction == Instruction.HALT:
+                return decoded, address + 1, True, False
+            if instruction == Instruction.JUMP:
+                address = data
+            elif instruction in (Instruction.POP, Instruction.PUSH):
+                address = FAULT_VECTOR
+            else:
+                address += 1
+        return decoded, address, False, False
+
+    def translate(self, start: int) -> Block:
+        """Translate the block starting at an address and cache it."""
+        decoded, exit_address, halts, looped = self._decode(start)
+        covered_addresses = [address for address, _, _ in decoded]
+        covered_set = set(covered_addresses)
+        unchecked_targets: Set[int] = set()
+        body: List[str] = []
+        # Index of the last zero flag update, dropped if nothing reads it before the next
+        pending_test: List[int] = []
+
+        def exit_line(next_address: int, offset: int) -> str:
+            return "return {}, acc, test, False, count + {}".format(next_address, offset)
+
+        def store_check(targets: Tuple[int, ...], next_address: int, offset: int):
+            # Writes to addresses no block covers need no check, as long as
+            # this block is dropped if one is translated over the target later
+            checked = []
+            for target in targets:
+                if self.covered[target] or target in covered_set:
+                    checked.append("(covered[{0}] and invalidate({0}, {1}))".format(target, start))
+                else:
+                    unchecked_targets.add(target)
+            if checked:
+                # Every target is invalidated before the block may be left
+                body.append("if {}:".format(" | ".join(checked)))
+                body.append("    " + exit_line(next_address, offset))
+                pending_test.clear()
+
+        for offset, (address, instruction, data) in enumerate(decoded, start=1):
+            next_address = address + 1
+
+            if instruction == Instruction.JUMPZ:
+                body.append("if test:")
+                body.append("    " + exit_line(data, offset))
+                pending_test.clear()
+            elif instruction == Instruction.LOAD:
+                body.append("acc = memory[{}]".format(data))
+            elif instruction in (Instruction.STORE, Instruction.SFULL):
+                if data == SMALL_OUT:
+                    body.append("output.extend(SMALL_OUTPUT_TABLE[acc & 0xfff])")
+                elif data == ASCII_OUT:
+                    body.append("output.append(acc & 0xff)")
+                if instruction == Instruction.STORE:
+                    body.append("memory[{0}] = (memory[{0}] & 0xf000) | (acc & 0x0fff)".format(data))
+                else:
+                    body.append("memory[{}] = acc".format(data))
+                store_check((data, ), next_address, offset)
+            elif instruction in (Instruction.LSHFT, Instruction.RSHFT):
+                operator = "<<" if instruction == Instruction.LSHFT else ">>"
+                if data & 0x1:
+                    body.append("acc = (((acc & 0x0fff) {} {}) & 0x0fff) | (acc & 0xf000)".format(operator, data >> 1))
+                else:
+                    body.append("acc = (acc {} {}) & 0xffff".format(operator, data >> 1))
+            elif instruction == Instruction.XOR:
+                body.append("acc ^= {}".format(data))
+            elif instruction == Instruction.AND:
+                body.append("acc &= {}".format(data | 0xf000))
+            elif instruction == Instruction.ADD:
+                body.append("acc = (acc & 0xf000) | ((acc + {}) & 0x0fff)".format(data))
+                if pending_test:
+                    body[pending_test.pop()] = ""
+                pending_test.append(len(body))
+                body.append("test = acc == 0")
+            elif instruction in (Instruction.POP, Instruction.PUSH):
+                body.append("memory[{}] = {}".format(INTERRUPT_RETURN, next_address & 0xffff))
+                body.append("memory[{}] = {}".format(INTERRUPT_REASON, INTERRUPT_REASON_UNSUPPORTED + instruction))
+                store_check((INTERRUPT_RETURN, INTERRUPT_REASON), FAULT_VECTOR, offset)
+
+        body = [line for line in body if line]
+        count = len(decoded)
+        lines = ["def block(acc, test, budget):", "    count = 0"]
+        if looped:
+            lines.append("    limit = budget - {}".format(count))
+            lines.append("    while True:")
+            lines.extend("        " + line for line in body)
+            lines.append("        count += {}".format(count))
+            lines.append("        if count > limit:")
+            lines.append("            return {}, acc, test, False, count".format(start))
+        else:
+            lines.extend("    " + line for line in body)
+            lines.append("    return {}, acc, test, {}, count + {}".format(exit_address, halts, count))
+
+        namespace: Dict[str, Any] = {
+            "memory": self.memory,
+            "output": self.output,
+            "covered": self.covered,
+            "invalidate": self.invalidate,
+            "SMALL_OUTPUT_TABLE": SMALL_OUTPUT_TABLE,
+        }
+        exec("\n".join(lines), namespace)  # pylint: disable=exec-used
+        block: Block = (namespace["block"], count, covered_addresses, unchecked_targets)
+
+        # Blocks which write to this block's addresses without checking must go
+        for covered_address in covered_addresses:
+            for watcher in list(self.store_watchers[covered_address]):
+                self._drop_block(watcher)
+
+        self.block_cache[start] = block
+        for covered_address in covered_addresses:
+            self.block_coverage[covered_address].append(start)
+            self.covered[covered_address] += 1
+        for target in unchecked_targets:
+            self.store_watchers[target].add(start)
+        self.translations += 1
+        return block
+
+    def run(self, max_instructions: Optional[int] = None) -> RunStatistics:
+        """Run until halted, or until max_instructions have been executed."""
+        block_cache = self.block_cache
+        translate = self.translate
+        program_counter = self.program_counter
+        accumulator = self.accumulator
+        test = self.test
+        halt = self.halt
+        budget = maxsize if max_instructions is None else max_instructions
+        executed = 0
+        start = perf_counter()
+        while not halt and executed < budget:
+            program_counter &= 0xfff
+            block = block_cache[program_counter] or translate(program_counter)
+            if executed + block[1] > budget:
+                # Not enough budget left for the whole block, so step through the remainder
+                self.program_counter, self.accumulator, self.test = program_counter, accumulator, test
+                stepped = super().run(budget - executed).instructions
+                self.instructions -= stepped
+                executed += stepped
+                program_counter, accumulator, test, halt = self.program_counter, self.accumulator, self.test, self.halt
+                break
+            program_counter, accumulator, test, halt, count = block[0](accumulator, test, budget - executed)
+            executed += count
+        seconds = perf_counter() - start
+        self.program_counter = program_counter
+        self.accumulator = accumulator
+        self.test = test
+        self.halt = halt
+        self.instructions += executed
+        return RunStatistics(instructions=executed, seconds=seconds)
+
+
+class ProfilingEmulator(Emulator):
+    """An SMA16 machine which records where execution time is spent.
+
+    Records per-address execution counts, an opcode histogram, counts for
+    each control flow edge taken by JUMP, JUMPZ, PUSH and POP, and counts of
+    writes to each address, from which self-modifying writes are found.
+    """
+
+    def __init__(self, memory: Optional[array] = None):
+        super().__init__(memory)
+        self.execution_counts = [0] * MEMORY_SIZE
+        self.opcode_counts = [0] * len(Instruction)
+        self.jump_edges: Dict[Tuple[int, int], int] = {}
+        self.write_counts = [0] * MEMORY_SIZE
+
+    @property
+    def self_modifying_writes(self) -> int:
+        """Get the number of writes to addresses which were also executed."""
+        return sum(writes for writes, executions in zip(self.write_counts, self.execution_counts) if executions)
+
+    def run(self, max_instructions: Optional[int] = None) -> RunStatistics:
+        """Run until halted, or until max_instructions have been executed."""
+        memory = self.memory
+        dispatch_table = self.dispatch_table
+        execution_counts = self.execution_counts
+        opcode_counts = self.opcode_counts
+        jump_edges = self.jump_edges
+        write_counts = self.write_counts
+        executed = 0
+        start = perf_counter()
+        while not self.halt and (max_instructions is None or executed < max_instructions):
+            program_counter = self.program_counter = self.program_counter & 0xfff
+            word = memory[program_counter]
+            instruction = word >> 12
+            data = word & 0x0fff
+            dispatch_table[instruction](data)
+            execution_counts[program_counter] += 1
+            opcode_counts[instruction] += 1
+            if instruction in (Instruction.STORE, Instruction.SFULL):
+                write_counts[data] += 1
+            elif instruction in (Instruction.JUMP, Instruction.JUMPZ, Instruction.POP, Instruction.PUSH):
+                edge = (program_counter, self.program_counter)
+                jump_edges[edge] = jump_edges.get(edge, 0) + 1
+                if instruction in (Instruction.POP, Instruction.PUSH):
+                    write_counts[INTERRUPT_RETURN] += 1
+                    write_counts[INTERRUPT_REASON] += 1
+            executed += 1
+        seconds = perf_counter() - start
+        self.instructions += executed
+        return RunStatistics(instructions=executed, seconds=seconds)
+
+    def listing(self,
+                reference_table: Optional[ReferenceTable] = None,
+                region_table: Optional[RegionTable] = None,
+                resolved_items: Optional[Iterable[AddressValue]] = None) -> bytes:
+        """Create a debug listing annotated with execution counts and percentages.
+
+        Without resolved items, every executed address is listed as it is now
+        in memory. Without tables, only the built in constants and regions are
+        used to name addresses.
+        """
+        reference_table = dict(CONSTANTS) if reference_table is None else reference_table
+        region_table = dict(REGIONS) if region_table is None else region_table
+        if resolved_items is None:
+            resolved_items = [
+                AddressValue(address=address, value=self.memory[address])
+                for address, executions in enumerate(self.execution_counts) if executions
+            ]
+        resolved_items = list(resolved_items)
+        symbol_index = SymbolIndex(reference_table, region_table)
+
+        total = max(sum(self.execution_counts), 1)
+        annotations = {
+            item.address: " | {:10d} {:6.2f}%".format(self.execution_counts[item.address],
+                                                     100 * self.execution_counts[item.address] / total)
+            for item in resolved_items
+        }
+        listing = serialise_to_debug_file(reference_table, region_table, resolved_items, annotations)
+
+        def _describe(address: int) -> str:
+            # Labels are only used to name addresses in the same region
+            label = symbol_index.nearest_label(address)
+            if label is None or symbol_index.region(address - label[1]) != symbol_index.region(address):
+                return "0x{:03x}".format(address)
+            name, offset = label
+            return "0x{:03x} ({}{})".format(address, name, "+{}".format(offset) if offset else "")
+
+        lines = ["", "/* Profile:", " *", " * Opcodes:"]
+        for instruction in Instruction:
+            if self.opcode_counts[instruction]:
+                lines.append(" *   - {:5s} {:10d} {:6.2f}%".format(instruction.name, self.opcode_counts[instruction],
+                                                                    100 * self.opcode_counts[instruction] / total))
+        lines.append(" *")
+        lines.append(" * Jump edges:")
+        for (source, target), count in sorted(self.jump_edges.items(), key=lambda x: (-x[1], x[0])):
+            lines.append(" *   - {:10d} {} -> {}".format(count, _describe(source), _describe(target)))
+        lines.append(" *")
+        lines.append(" * Self-modifying writes: {}".format(self.self_modifying_writes))
+        for address, writes in enumerate(self.write_counts):
+            if writes and self.execution_counts[address]:
+                lines.append(" *   - {:10d} {}".format(writes, _describe(address)))
+        lines.append(" */")
+
+        return listing + "\n".join(lines).encode("ascii")
+
+
+def main() -> int:
+    """Entry point function."""
+    argument_parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+
+    argument_parser.add_argument("INPUT",
+                                 help="memory image (.bin or .seg), machine state (.snap) or assembly file (.a16)")
+    argument_parser.add_argument("-n", "--max-instructions", type=int, default=None)
+    argument_parser.add_argument("-t", "--time", action="store_true", help="display timing information")
+    argument_parser.add_argument("--translate",
+                                 action="store_true",
+                                 help="cache translated basic blocks rather than stepping each instruction")
+    argument_parser.add_argument("-p", "--profile", default=None, help="write an annotated execution profile here")
+    argument_parser.add_argument("-s", "--save-state", default=None, help="write the machine state here after running")
+
+    parsed_arguments = argument_parser.parse_args()
+
+    input_file = path.abspath(parsed_arguments.INPUT)
+
+    if not path.isfile(input_file):
+        print("Input file does not exist.")
+        return 3
+
+    emulator_class = TranslatingEmulator if parsed_arguments.translate else Emulator
+    if parsed_arguments.profile:
+        emulator_class = ProfilingEmulator
+
+    reference_table = None
+    region_table = None
+    resolved_items = None
+
+    if path.splitext(input_file)[1] in (".bin", ".seg"):
+        with open(input_file, "rb") as input_handle:
+            emulator = emulator_class.from_bin(input_handle.read())
+    elif path.splitext(input_file)[1] == ".snap":
+        with open(input_file, "rb") as input_handle:
+            try:
+                state = MachineState.load(input_handle.read())
+            except ValueError as error:
+                print("Loading state failed: {}.".format(error), file=stderr)
+                return 1
+        # A halted machine continues, as it does when C is pressed in sma16vm
+        state.halt = False
+        emulator = emulator_class.from_state(state)
+    else:
+        try:
+            reference_table, region_table, resolved_items = assemble_items(input_file)
+            emulator = emulator_class.from_items(resolved_items)
+        except AssemblyError as error:
+            print("Assembly failed: {}.".format(error), file=stderr)
+            return 1
+
+    statistics = emulator.run(parsed_arguments.max_instructions)
+
+    stdout.buffer.write(emulator.output)
+    stdout.flush()
+
+    if parsed_arguments.save_state:
+        with open(parsed_arguments.save_state, "wb") as state_handle:
+            state_handle.write(emulator.snapshot().serialise())
+
+    if isinstance(emulator, ProfilingEmulator):
+        with open(parsed_arguments.profile, "wb") as profile_handle:
+            profile_handle.write(emulator.listing(reference_table, region_table, resolved_items))
+
+    if parsed_arguments.time:
+        print("{} instructions in {:.6f}s ({:.0f} instructions per second).".format(
+            statistics.instructions, statistics.seconds, statistics.instructions_per_second),
+              file=stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -79,6 +79,10 @@ enum InterruptReason
 
 #define INTER_RETURN 0x009
 
+#define MEMORY_WORDS 4096
+#define SEGMENT_MAGIC "S16S"
+#define SEGMENT_MAGIC_LENGTH 4
+
 #define MEM(A, I, D) \
     {                \
         (A & 0xffff), (((I & 0x000f) << 12) | (D & 0x0fff))},
@@ -229,6 +233,47 @@ void handle_sigint(int sig)
 
 #ifdef MEMORY_FILE
 #include "memory_file.s16"
+#else
+static inline uint16_t swap_bytes(uint16_t x)
+{
+    return ((x & 0xff) << 8) | ((x >> 8) & 0xff);
+}
+
+static inline bool read_big_endian(FILE *input_file, uint16_t *value)
+{
+    uint8_t bytes[2];
+    if (fread(bytes, 1, 2, input_file) != 2)
+        return false;
+    *value = (bytes[0] << 8) | bytes[1];
+    return true;
+}
+
+/**
+ * Load a sparse segment image, as produced by the assembler's segment format,
+ * after its magic. Only the occupied runs of memory are read.
+ */
+static bool load_segments(FILE *input_file, uint16_t *memory)
+{
+    uint16_t segment_count;
+    if (!read_big_endian(input_file, &segment_count))
+        return false;
+
+    for (uint16_t segment = 0; segment < segment_count; segment++)
+    {
+        uint16_t start;
+        uint16_t length;
+        if (!read_big_endian(input_file, &start) || !read_big_endian(input_file, &length))
+            return false;
+        if (start >= MEMORY_WORDS || length > MEMORY_WORDS - start)
+            return false;
+        if (fread((uint8_t *)&memory[start], 2, length, input_file) != length)
+            return false;
+        for (uint16_t word_index = start; word_index < start + length; word_index++)
+            memory[word_index] = swap_bytes(memory[word_index]);
+    }
+
+    return true;
+}
 #endif
 
 int main(int argc, char *argv[])
@@ -303,7 +348,10 @@ int main(int argc, char *argv[])
         return 0;
     }
 
-#ifdef MEMORY_FILE
+#ifdef MEMORY_IMAGE_WORDS
+    /* Load dense program image */
+    memcpy(memory, MEMORY_IMAGE, sizeof(MEMORY_IMAGE));
+#elif defined(MEMORY_FILE)
     /* Load program */
     uint16_t last_address = 0;
     for (uint16_t index = 0; index < (sizeof(PROGRAM) / sizeof(__prog_elem)); index++)
@@ -333,16 +381,32 @@ int main(int argc, char *argv[])
             return 2;
         }
 
-        const size_t read_bytes = fread((uint8_t *)memory, 1, 8192, input_file);
+        char magic[SEGMENT_MAGIC_LENGTH];
+        const size_t magic_bytes = fread(magic, 1, SEGMENT_MAGIC_LENGTH, input_file);
 
-        if (read_bytes % 2 != 0)
+        if (magic_bytes == SEGMENT_MAGIC_LENGTH && memcmp(magic, SEGMENT_MAGIC, SEGMENT_MAGIC_LENGTH) == 0)
         {
-            fputs("Warning, uneven number of bytes read from memory image.", stderr);
+            if (!load_segments(input_file, memory))
+            {
+                fputs("Invalid segment image.", stderr);
+                fclose(input_file);
+                return 4;
+            }
         }
-
-        for (size_t word_index = 0; word_index < read_bytes / 2; word_index++)
+        else
         {
-            memory[word_index] = ((memory[word_index] & 0xff) << 8) | ((memory[word_index] >> 8) & 0xff);
+            memcpy((uint8_t *)memory, magic, magic_bytes);
+            const size_t read_bytes = magic_bytes + fread((uint8_t *)memory + magic_bytes, 1, 8192 - magic_bytes, input_file);
+
+            if (read_bytes % 2 != 0)
+            {
+                fputs("Warning, uneven number of bytes read from memory image.", stderr);
+            }
+
+            for (size_t word_index = 0; word_index < read_bytes / 2; word_index++)
+            {
+                memory[word_index] = swap_bytes(memory[word_index]);
+            }
         }
 
         if (0 != fclose(input_file))
@@ -465,7 +529,8 @@ int main(int argc, char *argv[])
                 const uint16_t inst = UPPER(accumulator);
                 if (shift & 0x1)
                     accumulator = accumulator & 0x0fff;
-                accumulator = accumulator << (shift >> 1);
+                // Shifting the promoted int left by 16 or more can overflow it, and by 32 or more is undefined
+                accumulator = (shift >> 1) < 16 ? accumulator << (shift >> 1) : 0;
                 if (shift & 0x1)
                     accumulator = (accumulator & 0xfff) | inst;
                 program_counter++;
@@ -477,7 +542,8 @@ int main(int argc, char *argv[])
                 const uint16_t inst = UPPER(accumulator);
                 if (shift & 0x1)
                     accumulator = accumulator & 0x0fff;
-                accumulator = accumulator >> (shift >> 1);
+                // Shifting the promoted int right by 32 or more is undefined, and by 16 or more leaves 0
+                accumulator = (shift >> 1) < 16 ? accumulator >> (shift >> 1) : 0;
                 if (shift & 0x1)
                     accumulator = (accumulator & 0xfff) | inst;
                 program_counter++;
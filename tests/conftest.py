@@ -0,0 +1,23 @@
+"""Shared fixtures for the tests."""
+from os import path
+from shutil import which
+from subprocess import run as run_subprocess
+from sys import path as sys_path
+
+import pytest
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+# The modules under test sit in the repository root rather than in an installed package
+sys_path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def sma16vm(tmp_path_factory) -> str:
+    """Build sma16vm from sma16vm.c, skipping the test if there is no C compiler."""
+    compiler = which("gcc") or which("cc")
+    if compiler is None:
+        pytest.skip("no C compiler to build sma16vm with")
+    vm_path = str(tmp_path_factory.mktemp("vm") / "sma16vm")
+    run_subprocess([compiler, "-Wall", "-pedantic", path.join(ROOT, "sma16vm.c"), "-o", vm_path], check=True)
+    return vm_path
@@ -0,0 +1,59 @@
+"""Tests for the in-memory assembler API."""
+import pytest
+
+from sma16asm import CONSTANTS, REGIONS, Assembler, AssemblyError, assemble_file
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: load @value
+    store @SMALL_OUT
+    halt
+.sec data
+value: .const 0x123
+"""
+
+FORMATS = ["bin", "c", "debug", "hex", "image", "map", "segment", "text"]
+
+
+def test_text_lines_and_paths_assemble_the_same(tmp_path):
+    source_path = tmp_path / "program.a16"
+    source_path.write_text(SOURCE)
+    assembler = Assembler()
+    from_text = assembler.assemble_text(SOURCE)
+    assert assembler.assemble_lines(SOURCE.splitlines()) == from_text
+    assert assembler.assemble_lines(iter(SOURCE.splitlines(keepends=True))) == from_text
+    assert assembler.assemble_path(str(source_path)) == from_text
+
+
+def test_images_hold_words_and_tables():
+    image = Assembler().assemble_text(SOURCE)
+    assert image.reference_table["main"] == 0x010
+    assert image.reference_table["value"] == 0x013
+    assert image.region_table["program"].start == 0x010
+    assert {word.address: word.value for word in image.words}[0x010] == 0x4013
+
+
+def test_assemblies_do_not_share_state():
+    assembler = Assembler()
+    assembler.assemble_text(SOURCE)
+    with pytest.raises(AssemblyError, match="value"):
+        assembler.assemble_text(".sec program\nload @value\n")
+    assert assembler.reference_table == CONSTANTS
+    assert set(assembler.region_table) == set(REGIONS)
+    assert assembler.assemble_text(SOURCE) == Assembler().assemble_text(SOURCE)
+
+
+def test_base_tables_can_be_given():
+    assembler = Assembler(constants=dict(CONSTANTS, LIMIT=0x0ff))
+    image = assembler.assemble_text(".sec program\nadd @LIMIT\n")
+    assert image.words[-1].value == 0xb0ff
+
+
+@pytest.mark.parametrize("output_format", FORMATS)
+def test_assemble_file_writes_the_serialised_image(tmp_path, output_format):
+    source_path = tmp_path / "program.a16"
+    source_path.write_text(SOURCE)
+    output_path = tmp_path / "program.out"
+    assemble_file(str(source_path), str(output_path), output_format)
+    assert output_path.read_bytes() == Assembler().assemble_text(SOURCE).serialise(output_format)
@@ -0,0 +1,113 @@
+"""Tests for the NumPy batch emulator."""
+from glob import glob
+from os import path
+
+import pytest
+
+pytest.importorskip("numpy")
+
+# pylint: disable=wrong-import-position
+from sma16asm import Assembler
+from sma16batch import BatchEmulator
+from sma16conform import RunResult, run_model, run_vm
+from sma16emu import Emulator
+
+EXAMPLE_DIRECTORY = path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly")
+
+MAX_INSTRUCTIONS = 20000
+
+HEADER = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+"""
+
+# Counts down from 5, printing as it goes
+COUNTDOWN = HEADER + """
+    load @count
+loop:
+    add 0xfff
+    store @SMALL_OUT
+    jumpz @done
+    jump @loop
+done:
+    halt
+count: .const 5
+"""
+
+SHIFTS_AND_MASKS = HEADER + """
+    load @value
+    lshft 0x004
+    rshft 0x002
+    xor 0x0f0
+    and 0x0ff
+    store @SMALL_OUT
+    halt
+value: .const 0x123
+"""
+
+# Overwrites an instruction it has yet to run
+PATCH_AHEAD = HEADER + """
+    load @replacement
+    sfull @patched
+    and 0x000
+patched: add 0x001
+    store @SMALL_OUT
+    halt
+replacement: add 0x005
+"""
+
+# Never halts
+SPIN = HEADER + "    jump @main\n"
+
+SOURCES = [COUNTDOWN, SHIFTS_AND_MASKS, PATCH_AHEAD, SPIN]
+
+IMAGES = [Assembler().assemble_text(source).serialise("bin") for source in SOURCES]
+IMAGES += [Assembler().assemble_path(example).serialise("bin")
+           for example in sorted(glob(path.join(EXAMPLE_DIRECTORY, "*.a16")))]
+
+
+def test_machines_match_the_emulator():
+    batch = BatchEmulator.from_bins(IMAGES)
+    batch.run(MAX_INSTRUCTIONS)
+
+    for index, image in enumerate(IMAGES):
+        emulator = Emulator.from_bin(image)
+        emulator.run(MAX_INSTRUCTIONS)
+        assert bool(batch.halt[index]) == emulator.halt
+        assert bytes(batch.outputs[index]) == bytes(emulator.output)
+        assert int(batch.accumulator[index]) == emulator.accumulator
+        assert int(batch.program_counter[index]) == emulator.program_counter
+        assert batch.memory[index].tobytes() == emulator.memory.tobytes()
+
+
+def test_machines_match_sma16vm(sma16vm, tmp_path):
+    batch = BatchEmulator.from_bins(IMAGES)
+    batch.run(MAX_INSTRUCTIONS)
+
+    for index, image in enumerate(IMAGES):
+        if not run_model(image, MAX_INSTRUCTIONS).halted:
+            continue
+        expected = RunResult(halted=bool(batch.halt[index]), output=bytes(batch.outputs[index]))
+        assert run_vm(sma16vm, image, str(tmp_path), 5.0) == expected
+
+
+def test_identical_machines_stay_identical():
+    batch = BatchEmulator.from_bin(IMAGES[0], 8)
+    batch.run(MAX_INSTRUCTIONS)
+    assert len({bytes(output) for output in batch.outputs}) == 1
+    assert len({row.tobytes() for row in batch.memory}) == 1
+
+
+def test_machines_forked_from_a_state_match_the_emulator():
+    emulator = Emulator.from_bin(IMAGES[0])
+    emulator.run(7)
+    batch = BatchEmulator.from_state(emulator.snapshot(), 4)
+    batch.run(MAX_INSTRUCTIONS)
+    emulator.output.clear()
+    emulator.run(MAX_INSTRUCTIONS)
+
+    for index in range(4):
+        assert bool(batch.halt[index]) == emulator.halt
+        assert bytes(batch.outputs[index]) == bytes(emulator.output)
+        assert batch.memory[index].tobytes() == emulator.memory.tobytes()
@@ -0,0 +1,72 @@
+"""Tests for the on-disk assembly cache."""
+from os import listdir, path, utime
+
+import sma16asm
+from sma16asm import AssemblyCache, assemble_job, link_files
+
+
+def test_put_then_get(tmp_path):
+    cache = AssemblyCache(str(tmp_path))
+    key = cache.key(b"halt\n", "bin")
+    assert cache.get(key) is None
+    cache.put(key, b"output")
+    assert cache.get(key) == b"output"
+    assert listdir(str(tmp_path)) == [key + ".out"]
+
+
+def test_key_depends_on_format_and_options():
+    keys = {AssemblyCache.key(b"halt\n", "bin"), AssemblyCache.key(b"halt\n", "hex"),
+            AssemblyCache.key(b"halt\n", "bin", ["optimise"]), AssemblyCache.key(b"halt \n", "bin")}
+    assert len(keys) == 4
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = AssemblyCache(str(tmp_path), max_size=10)
+    cache.put("first", b"12345678")
+    utime(path.join(str(tmp_path), "first.out"), (0, 0))
+    cache.put("second", b"12345678")
+    assert cache.get("first") is None
+    assert cache.get("second") == b"12345678"
+
+
+def test_jobs_report_cache_hits_and_misses(tmp_path):
+    source_path = tmp_path / "program.a16"
+    source_path.write_text(".vec.reset @main\n.vec.fault @RESET_VECTOR\n.sec program\nmain: halt\n")
+    job = (str(source_path), str(tmp_path / "program.bin"), "auto", str(tmp_path / "cache"), 2**20)
+
+    assert assemble_job(*job)[3] == (0, 1)
+    assert assemble_job(*job)[3] == (1, 0)
+
+
+def test_cache_hits_say_why_savings_are_missing(tmp_path):
+    source_path = tmp_path / "program.a16"
+    source_path.write_text(".vec.reset @main\n.vec.fault @RESET_VECTOR\n.sec program\nmain: noop\nhalt\n")
+    job = (str(source_path), str(tmp_path / "program.bin"), "auto", str(tmp_path / "cache"), 2**20, False, True)
+
+    assert assemble_job(*job)[1].startswith("Peephole pass saved 1 words")
+    assert assemble_job(*job)[1] == "Output was taken from the cache, so its savings are not reported."
+
+
+def test_failed_writes_leave_no_temporary_file(tmp_path, monkeypatch):
+    def fail_replace(source, destination):
+        raise OSError("replace failed")
+
+    monkeypatch.setattr(sma16asm, "replace", fail_replace)
+    cache = AssemblyCache(str(tmp_path))
+    cache.put(cache.key(b"halt\n", "bin"), b"output")
+    assert listdir(str(tmp_path)) == []
+
+
+def test_linked_modules_with_the_same_source_keep_their_names(tmp_path):
+    source = ".global f\n.sec program\nf: halt\n"
+    input_files = []
+    for name in ("a", "b"):
+        source_path = tmp_path / "{}.a16".format(name)
+        source_path.write_text(source)
+        input_files.append(str(source_path))
+
+    for _ in range(2):
+        code, message, _, _ = link_files(input_files, str(tmp_path / "program.bin"), "auto", str(tmp_path / "cache"),
+                                         2**20)
+        assert code == 1
+        assert "exported by both a and b" in message
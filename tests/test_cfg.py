@@ -0,0 +1,132 @@
+"""Tests for the control flow analysis."""
+from glob import glob
+from os import path
+
+import pytest
+
+from sma16asm import Assembler, SymbolIndex
+from sma16cfg import BasicBlock, ControlFlowAnalysis, Loop
+from sma16emu import Emulator
+
+EXAMPLE_DIRECTORY = path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly")
+
+EXAMPLES = sorted(glob(path.join(EXAMPLE_DIRECTORY, "*.a16")))
+
+HEADER = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+"""
+
+
+def analyse(source: str) -> ControlFlowAnalysis:
+    return Assembler().assemble_text(source).analyse()
+
+
+def cycles_run(source: str) -> int:
+    emulator = Emulator.from_items(Assembler().assemble_text(source).words)
+    emulator.run(100000)
+    assert emulator.halt
+    return emulator.instructions
+
+
+def test_straight_line_code_is_one_block():
+    source = HEADER + "    add 0x001\n    store @SMALL_OUT\n    halt\n"
+    analysis = analyse(source)
+    program = analysis.program
+    assert program.shortest_cycles == program.longest_cycles == program.worst_case_cycles == cycles_run(source)
+    assert analysis.blocks[analysis.program.blocks[-1]].exit == "halt"
+    assert not program.loops and not program.notes
+
+
+def test_branches_give_shortest_and_longest_paths():
+    source = HEADER + "    add 0x000\n    jumpz @done\n    add 0x001\n    add 0x001\ndone:\n    halt\n"
+    program = analyse(source).program
+    assert program.shortest_cycles == cycles_run(source)
+    assert program.longest_cycles == program.worst_case_cycles == program.shortest_cycles + 2
+
+
+def test_loops_are_found_and_have_no_worst_case():
+    source = HEADER + ("    load @count\nouter:\n    add 0xfff\n    jumpz @done\n"
+                       "inner:\n    add 0x000\n    jumpz @outer\n    jump @inner\n"
+                       "done:\n    halt\ncount: .const 3\n")
+    program = analyse(source).program
+    assert sorted(loop.depth for loop in program.loops) == [1, 2]
+    inner = next(loop for loop in program.loops if loop.depth == 2)
+    assert inner.parent == next(loop.header for loop in program.loops if loop.depth == 1)
+    assert program.worst_case_cycles is None
+    assert program.notes
+
+
+def test_rewritten_jump_targets_are_unknown():
+    source = HEADER + "    load @target\n    store @patched\npatched:\n    jump 0x000\ntarget:\n    halt\n"
+    analysis = analyse(source)
+    assert analysis.program.worst_case_cycles is None
+    assert any(block.exit == "unknown" for block in analysis.blocks.values())
+    assert analysis.writers
+
+
+def test_fault_handler_is_added_to_push_and_pop():
+    analysis = Assembler().assemble_path(path.join(EXAMPLE_DIRECTORY, "stack.a16")).analyse()
+    assert analysis.handler is not None
+    assert analysis.handler.shortest_cycles == 22
+    assert analysis.handler.worst_case_cycles == 25
+    assert analysis.program.assumptions
+
+
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_examples_run_within_their_bounds(example):
+    with open(example, "r") as source_handle:
+        source = source_handle.read()
+    analysis = analyse(source)
+    assert analysis.program.shortest_cycles <= cycles_run(source)
+    if analysis.program.worst_case_cycles is not None:
+        assert cycles_run(source) <= analysis.program.worst_case_cycles
+
+
+def test_branches_split_into_blocks_which_join_again():
+    source = HEADER + ("    add 0x000\n    jumpz @else\n    add 0x001\n    jump @done\n"
+                       "else:\n    add 0x002\n    add 0x003\n    add 0x004\ndone:\n    halt\n")
+    analysis = analyse(source)
+    assert list(analysis.blocks.values()) == [
+        BasicBlock(start=0x000, end=0x000, successors=[0x010]),
+        BasicBlock(start=0x010, end=0x011, successors=[0x014, 0x012]),
+        BasicBlock(start=0x012, end=0x013, successors=[0x017]),
+        BasicBlock(start=0x014, end=0x016, successors=[0x017]),
+        BasicBlock(start=0x017, end=0x017, successors=[], exit="halt"),
+    ]
+    assert analysis.program.shortest_cycles == 6
+    assert analysis.program.longest_cycles == analysis.program.worst_case_cycles == 7
+    assert cycles_run(source) == 7
+
+
+def test_nested_loops_have_their_headers_blocks_and_iteration_cycles():
+    source = HEADER + ("    load @count\nouter:\n    add 0xfff\n    jumpz @done\n"
+                       "inner:\n    add 0x000\n    jumpz @outer\n    jump @inner\n"
+                       "done:\n    halt\ncount: .const 3\n")
+    program = analyse(source).program
+    assert program.loops == [
+        Loop(header=0x012, blocks=[0x012, 0x014, 0x016], depth=1, parent=None, iteration_cycles=4),
+        Loop(header=0x014, blocks=[0x014, 0x016], depth=2, parent=0x012, iteration_cycles=3),
+    ]
+    assert program.shortest_cycles == program.longest_cycles == 5
+    assert program.notes == ["the loop at 0x012 has no static iteration bound",
+                             "the loop at 0x014 has no static iteration bound"]
+
+
+def test_a_loop_entered_other_than_through_its_header_is_not_a_natural_loop():
+    # Neither block of the cycle dominates the other, as each is reached straight from main
+    source = HEADER + ("    add 0x000\n    jumpz @second\nfirst:\n    add 0x001\n"
+                       "second:\n    add 0x000\n    jumpz @first\n    halt\n")
+    program = analyse(source).program
+    assert program.blocks == [0x000, 0x010, 0x013, 0x015, 0x012]
+    assert program.loops == []
+    assert program.worst_case_cycles is None
+    assert program.notes == ["the edge from 0x012 to 0x013 is in a loop with more than one entry"]
+
+
+def test_report_names_labels():
+    image = Assembler().assemble_text(HEADER + "    halt\n")
+    report = image.analyse().format(SymbolIndex(image.reference_table, image.region_table))
+    assert "(main)" in report
+    assert "worst case" in report
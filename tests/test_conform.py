@@ -0,0 +1,114 @@
+"""Tests for the conformance harness."""
+import sys
+from random import Random
+
+import pytest
+
+import sma16conform
+from sma16asm import Assembler, Instruction
+from sma16conform import RunResult, check_source, generate_program, run_model, shrink
+from sma16emu import Emulator, ProfilingEmulator, TranslatingEmulator
+
+# Generated programs are checked against each other rather than against hand-written expectations
+GENERATED = [generate_program(Random(seed)) for seed in range(100)]
+
+
+@pytest.fixture
+def jump_bug(monkeypatch):
+    """Stand in for a VM which prints an extra byte for any program holding a JUMP."""
+
+    def run_vm(vm_path: str, image: bytes, directory: str, timeout: float) -> RunResult:
+        expected = run_model(image, 100000)
+        words = [int.from_bytes(image[index:index + 2], "big") for index in range(0, len(image), 2)]
+        if any(word >> 12 == Instruction.JUMP for word in words[16:]):
+            return RunResult(halted=expected.halted, output=expected.output + b"?")
+        return expected
+
+    monkeypatch.setattr(sma16conform, "run_vm", run_vm)
+
+
+def check(source: str) -> str:
+    return check_source(source, "sma16vm", "", 5.0, 100000).status
+
+
+def test_shrink_removes_lines_which_do_not_matter(jump_bug):
+    source = "noop\njump @target\ntarget: noop\nxor 0x001\nhalt\n"
+    assert check(source) == "diverged"
+    assert shrink(source, "sma16vm", "", 5.0, 100000) == "jump @target\ntarget:\nhalt\n"
+
+
+def test_shrink_keeps_generated_programs_diverging(jump_bug):
+    source = next(source for source in map(generate_program, map(Random, range(100)))
+                  if check(source) == "diverged" and "jump @" in source)
+    shrunk = shrink(source, "sma16vm", "", 5.0, 100000)
+    assert check(shrunk) == "diverged"
+    assert len(shrunk.splitlines()) < len(source.splitlines()) // 4
+
+
+def test_shrink_leaves_passing_programs_alone(jump_bug):
+    assert check("add 0x001\nhalt\n") == "passed"
+    assert shrink("add 0x001\nhalt\n", "sma16vm", "", 5.0, 100000) == "add 0x001\nhalt\n"
+
+
+def test_programs_which_assemble_to_nothing_are_skipped():
+    assert check("# nothing here\n") == "skipped"
+
+
+def test_generated_programs_match_sma16vm(sma16vm, tmp_path):
+    statuses = [check_source(source, sma16vm, str(tmp_path), 5.0, 100000).status for source in GENERATED]
+    assert "diverged" not in statuses
+    assert statuses.count("passed") > len(GENERATED) // 2
+
+
+def emulator_state(emulator: Emulator) -> tuple:
+    return (emulator.halt, emulator.accumulator, emulator.program_counter, emulator.test, emulator.instructions,
+            bytes(emulator.output), emulator.memory.tobytes())
+
+
+def test_generated_programs_match_across_emulators():
+    for seed, source in enumerate(GENERATED):
+        words = Assembler().assemble_text(source).words
+        emulator, translating, profiling = (Emulator.from_items(words), TranslatingEmulator.from_items(words),
+                                            ProfilingEmulator.from_items(words))
+        # Stepping in short runs ends some of them in the middle of a translated block
+        random = Random(seed)
+        for budget in [random.randint(1, 13) for _ in range(30)] + [20000]:
+            for machine in (emulator, translating, profiling):
+                machine.run(budget)
+            assert emulator_state(translating) == emulator_state(profiling) == emulator_state(emulator), source
+
+
+def run_output(assembler: Assembler, source: str) -> tuple:
+    emulator = Emulator.from_items(assembler.assemble_text(source).words)
+    emulator.run(100000)
+    return emulator.halt, bytes(emulator.output)
+
+
+def test_generated_programs_behave_the_same_when_optimised():
+    optimisers = [
+        Assembler(optimise=True), Assembler(pack_constants=True), Assembler(optimise=True, pack_constants=True)
+    ]
+    for source in GENERATED:
+        expected = run_output(Assembler(), source)
+        if expected[0]:
+            assert [run_output(assembler, source) for assembler in optimisers] == [expected] * 3, source
+
+
+def test_generated_programs_run_within_their_bounds():
+    checked = 0
+    for source in GENERATED:
+        program = Assembler().assemble_text(source).analyse().program
+        if program.worst_case_cycles is None or program.assumptions:
+            continue
+        emulator = Emulator.from_items(Assembler().assemble_text(source).words)
+        emulator.run(100000)
+        assert program.shortest_cycles <= emulator.instructions <= program.worst_case_cycles, source
+        checked += 1
+    assert checked > len(GENERATED) // 2
+
+
+def test_jobs_default_to_one_when_the_cpu_count_is_unknown(sma16vm, monkeypatch, capsys):
+    monkeypatch.setattr(sma16conform, "cpu_count", lambda: None)
+    monkeypatch.setattr(sys, "argv", ["sma16conform.py", "--vm", sma16vm, "-c", "4"])
+    assert sma16conform.main() == 0
+    assert capsys.readouterr().out.startswith("4 programs, ")
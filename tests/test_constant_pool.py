@@ -0,0 +1,74 @@
+"""Tests for merging and packing constants."""
+from sma16asm import Assembler, AssembledImage
+from sma16emu import Emulator
+
+HEADER = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+"""
+
+
+def assemble(body: str, pack: bool = True) -> AssembledImage:
+    return Assembler(pack_constants=pack).assemble_text(HEADER + body)
+
+
+def run(image: AssembledImage) -> Emulator:
+    emulator = Emulator.from_items(image.words)
+    emulator.run(100000)
+    return emulator
+
+
+def test_duplicate_constants_are_merged():
+    source = ("load @a\nstore @SMALL_OUT\nload @b\nstore @SMALL_OUT\nhalt\n"
+              ".sec data\na: .const 0x1234\nb: .const 0x1234\n")
+    image = assemble(source)
+    assert image.constant_pool_report.merged_constants == 1
+    assert image.reference_table["a"] == image.reference_table["b"]
+    assert bytes(run(image).output) == bytes(run(assemble(source, pack=False)).output)
+
+
+def test_constants_are_packed_into_unused_operands():
+    source = "load @value\nstore @SMALL_OUT\nhalt\n.sec data\nvalue: .const 0x0123\n"
+    image = assemble(source)
+    assert image.constant_pool_report.packed_constants == 1
+    assert "data" not in image.region_table or image.region_table["data"].count == 0
+    words = {word.address: word.value for word in image.words}
+    assert words[image.reference_table["value"]] == 0x0123
+    assert bytes(run(image).output) == bytes(run(assemble(source, pack=False)).output)
+
+
+def test_variables_are_left_alone():
+    image = assemble("load @a\nload @b\nhalt\n.sec data\na: .var 0x1234\nb: .var 0x1234\n")
+    assert image.constant_pool_report.words_saved == 0
+
+
+def test_constants_which_are_stored_to_are_left_alone():
+    image = assemble("load @a\nstore @b\nload @b\nhalt\n.sec data\na: .const 0x1234\nb: .const 0x1234\n")
+    assert image.constant_pool_report.merged_constants == 0
+    assert image.reference_table["a"] != image.reference_table["b"]
+
+
+def test_tables_indexed_from_their_address_are_left_alone():
+    image = assemble("load @base\nadd @table\nhalt\n"
+                     ".sec data\nbase: .const 0x0001\ntable: .const 0x0001\n.const 0x0002\n")
+    assert image.reference_table["table"] != image.reference_table["base"]
+
+
+def test_sections_with_labels_used_as_data_are_not_compacted():
+    source = ("load @value\nstore @SMALL_OUT\nadd @after\nstore @SMALL_OUT\nhalt\n"
+              ".sec data\nvalue: .const 0x0012\nafter: .const 0x0000\n")
+    image = assemble(source)
+    assert image.constant_pool_report.words_saved == 0
+    assert bytes(run(image).output) == bytes(run(assemble(source, pack=False)).output)
+
+
+def test_merged_and_packed_constants_are_read_the_same():
+    source = ("load @first\nstore @SMALL_OUT\nload @second\nadd 0x001\nstore @SMALL_OUT\n"
+              "load @packed\nstore @SMALL_OUT\njump @done\ndone: halt\n"
+              ".sec data\nfirst: .const 0x0005\nsecond: .const 0x0005\npacked: .const 0x0012\n")
+    image = assemble(source)
+    report = image.constant_pool_report
+    assert (report.merged_constants, report.packed_constants, report.words_saved) == (1, 1, 2)
+    assert image.reference_table["first"] == image.reference_table["second"] == image.reference_table["done"]
+    assert bytes(run(image).output) == bytes(run(assemble(source, pack=False)).output) == b"FGS"
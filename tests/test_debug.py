@@ -0,0 +1,65 @@
+"""Tests for the symbol index and the debug listing built on it."""
+import sma16asm
+from sma16asm import REGIONS, Assembler, Region, SymbolIndex
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: start: load @value
+    halt
+.sec data
+value: other: .const 0x123
+"""
+
+
+def test_every_alias_is_kept():
+    symbol_index = SymbolIndex({"main": 0x10, "start": 0x10, "value": 0x12}, {})
+    assert symbol_index.labels_at(0x10) == ["main", "start"]
+    assert symbol_index.label_text(0x10) == "main, start"
+    assert symbol_index.labels_at(0x11) == []
+    assert symbol_index.label_text(0x11) == ""
+    assert symbol_index.max_label_text_length == len("main, start")
+
+
+def test_regions_are_found_at_their_bounds():
+    region_table = dict(REGIONS, program=Region(type="user", start=0x20, end=0x2f, count=0x10))
+    symbol_index = SymbolIndex({}, region_table)
+    assert symbol_index.region(0x000) == "vectors"
+    assert symbol_index.region(0x00f) == "configuration"
+    assert symbol_index.region(0x020) == "program"
+    assert symbol_index.region(0x02f) == "program"
+    assert symbol_index.region(0x010) == "any"
+    assert symbol_index.region(0x030) == "any"
+
+
+def test_nearest_label_gives_the_offset():
+    symbol_index = SymbolIndex({"main": 0x10, "start": 0x10, "value": 0x14}, {})
+    assert symbol_index.nearest_label(0x0f) is None
+    assert symbol_index.nearest_label(0x10) == ("main", 0)
+    assert symbol_index.nearest_label(0x13) == ("main", 3)
+    assert symbol_index.nearest_label(0x20) == ("value", 0x0c)
+
+
+def test_debug_listing_shows_every_alias():
+    listing = Assembler().assemble_text(SOURCE).serialise("debug").decode("ascii").splitlines()
+    assert "0x010 (main, start     ) -> 0x4 (LOAD ), 0x012 (other, value    )" in listing
+    assert "0x012 (other, value    ) -> 0x0 (HALT ), 0x123 (                )" in listing
+    assert listing.index("--- program ---") < listing.index("--- data ---")
+
+
+def test_full_memory_listing_builds_one_index(monkeypatch):
+    lines = [".vec.reset @l_0", ".vec.fault @RESET_VECTOR"]
+    for index in range(0x1000 - 0x11):
+        if index % 0x100 == 0:
+            lines.append(".sec s_{}".format(index // 0x100))
+        lines.append("l_{}: add @l_{}".format(index, index // 2))
+    image = Assembler().assemble_lines(lines)
+
+    built = []
+    monkeypatch.setattr(sma16asm, "SymbolIndex", lambda *tables: built.append(tables) or SymbolIndex(*tables))
+    listing = image.serialise("debug").decode("ascii").splitlines()
+
+    assert len(built) == 1
+    memory = listing[listing.index("=== START MEMORY ===") + 1:listing.index("===  END MEMORY  ===")]
+    assert sum(not line.startswith("---") for line in memory) == len(image.words)
+    assert sum(line.startswith("--- s_") for line in memory) == 16
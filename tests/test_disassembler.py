@@ -0,0 +1,144 @@
+"""Tests for the disassembler."""
+from glob import glob
+from io import BytesIO, RawIOBase
+from os import fdopen, path, pipe
+from threading import Thread
+from typing import Optional
+
+import pytest
+
+from sma16asm import Assembler
+from sma16dis import USER_MEMORY_START, Symbols, data_forms, disassemble, load_symbols, read_words
+from sma16emu import Emulator, load_bin_image
+
+EXAMPLES = sorted(glob(path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly", "*.a16")))
+
+LINKED_MODULES = {
+    "main": [
+        ".vec.reset @main",
+        ".vec.fault @RESET_VECTOR",
+        ".sec program",
+        "main: load @count",
+        "loop: add 0xfff",
+        "jumpz @done",
+        "jump @loop",
+        "done: jump @print",
+        "count: .const 3",
+    ],
+    "print": [
+        ".global print",
+        ".sec program",
+        "print: load @count",
+        "store @SMALL_OUT",
+        "loop: halt",
+        "jump @loop",
+        "count: .const s\"ok\"",
+    ],
+}
+
+
+def round_trip(image_bytes: bytes, symbols_path: Optional[str] = None, input_format: str = "bin") -> bytes:
+    symbols = load_symbols(symbols_path) if symbols_path else Symbols()
+    lines = list(disassemble(read_words(BytesIO(image_bytes), input_format), symbols))
+    return Assembler().assemble_lines(lines).serialise("bin")
+
+
+@pytest.mark.parametrize("output_format", ["bin", "segment"])
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_examples_round_trip(example, output_format):
+    image_bytes = Assembler().assemble_path(example).serialise(output_format)
+    assert round_trip(image_bytes) == Assembler().assemble_path(example).serialise("bin")
+
+
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_hex_images_round_trip(example):
+    image = Assembler().assemble_path(example)
+    assert round_trip(image.serialise("hex"), input_format="hex") == image.serialise("bin")
+
+
+def test_machine_states_round_trip():
+    image = Assembler().assemble_path(EXAMPLES[0])
+    emulator = Emulator.from_items(image.words)
+    emulator.run()
+    memory = load_bin_image(round_trip(emulator.snapshot().serialise(), input_format="snap"))
+    # The vectors and configuration hold run time state which cannot be assembled
+    assert memory[USER_MEMORY_START:] == emulator.memory[USER_MEMORY_START:]
+
+
+def test_long_zero_runs_are_left_out():
+    image = Assembler().assemble_text(".vec.reset @main\n.vec.fault @RESET_VECTOR\n.sec program\nmain: halt\n"
+                                      ".sec data 0x800\nvalue: .const 1\n")
+    lines = list(disassemble(read_words(BytesIO(image.serialise("bin")), "bin"), Symbols()))
+    assert len(lines) < 20
+    assert ".sec s_800 0x800" in lines
+
+
+@pytest.mark.parametrize("output_format", ["bin", "segment"])
+def test_unbuffered_files_are_read(tmp_path, output_format):
+    image = Assembler().assemble_path(EXAMPLES[0])
+    image_path = tmp_path / "image"
+    image_path.write_bytes(image.serialise(output_format))
+    with open(image_path, "rb", buffering=0) as input_handle:
+        words = list(read_words(input_handle, "bin"))
+    assert words == list(read_words(BytesIO(image.serialise(output_format)), "bin"))
+
+
+@pytest.mark.parametrize("output_format", ["bin", "segment"])
+def test_pipes_are_read(output_format):
+    image = Assembler().assemble_path(EXAMPLES[0])
+    read_fd, write_fd = pipe()
+    with fdopen(read_fd, "rb", buffering=0) as input_handle, fdopen(write_fd, "wb") as output_handle:
+        writer = Thread(target=lambda: (output_handle.write(image.serialise(output_format)), output_handle.close()))
+        writer.start()
+        words = list(read_words(input_handle, "bin"))
+        writer.join()
+    assert words == list(read_words(BytesIO(image.serialise(output_format)), "bin"))
+
+
+class TrickleReader(RawIOBase):
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), 3, len(self.data))
+        buffer[:size], self.data = self.data[:size], self.data[size:]
+        return size
+
+
+@pytest.mark.parametrize("output_format", ["bin", "segment"])
+def test_short_reads_are_completed(output_format):
+    image_bytes = Assembler().assemble_path(EXAMPLES[0]).serialise(output_format)
+    assert list(read_words(TrickleReader(image_bytes), "bin")) == list(read_words(BytesIO(image_bytes), "bin"))
+
+
+def test_images_shorter_than_the_magic_are_read():
+    assert list(read_words(BytesIO(b"\x12\x34"), "bin")) == [(0, 0x1234)]
+
+
+def test_data_forms():
+    assert data_forms(0x0000) == ['s"AA"', "a'\\x00'"]
+    assert data_forms(0x4241) == ['a"AB"']
+    assert data_forms(0xffff) == []
+
+
+@pytest.mark.parametrize("symbols_format", ["map", "debug"])
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_examples_round_trip_with_symbols(example, symbols_format, tmp_path):
+    image = Assembler().assemble_path(example)
+    symbols_path = tmp_path / "symbols"
+    symbols_path.write_bytes(image.serialise(symbols_format))
+    assert round_trip(image.serialise("bin"), str(symbols_path)) == image.serialise("bin")
+
+
+def test_linked_map_round_trips(tmp_path):
+    assembler = Assembler()
+    image = assembler.link(assembler.assemble_object(lines, name) for name, lines in LINKED_MODULES.items())
+    symbols_path = tmp_path / "program.map"
+    symbols_path.write_bytes(image.serialise("map"))
+
+    symbols = load_symbols(str(symbols_path))
+    assert "print_loop" in symbols.addresses and "print_count" in symbols.addresses
+    assert round_trip(image.serialise("bin"), str(symbols_path)) == image.serialise("bin")
@@ -0,0 +1,64 @@
+"""Tests for the in-process emulator."""
+from glob import glob
+from os import path
+
+import pytest
+
+from sma16asm import Assembler
+from sma16conform import run_model, run_vm
+from sma16emu import Emulator
+
+EXAMPLE_DIRECTORY = path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly")
+
+EXAMPLES = sorted(glob(path.join(EXAMPLE_DIRECTORY, "*.a16")))
+
+
+def run_source(source: str, max_instructions: int = 10000) -> Emulator:
+    emulator = Emulator.from_items(Assembler().assemble_text(source).words)
+    emulator.run(max_instructions)
+    return emulator
+
+
+def test_hello_world():
+    emulator = Emulator.from_items(Assembler().assemble_path(path.join(EXAMPLE_DIRECTORY, "hello_world.a16")).words)
+    emulator.run()
+    assert emulator.halt
+    assert bytes(emulator.output) == b"Hello World\x00\n"
+
+
+def test_add_keeps_upper_nibble_and_tests_whole_word():
+    emulator = run_source("""
+.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+    load @value
+    add 0x001
+    jumpz @zero
+    halt
+zero:
+    store @result
+    halt
+result: .var 0
+value: .const 0xffff
+""")
+    assert emulator.halt
+    assert emulator.accumulator == 0xf000
+    assert not emulator.test
+
+
+def test_max_instructions_stops_a_loop():
+    emulator = run_source("""
+.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: jump @main
+""", max_instructions=100)
+    assert not emulator.halt
+    assert emulator.instructions == 100
+
+
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_examples_match_sma16vm(example, sma16vm, tmp_path):
+    image = Assembler().assemble_path(example).serialise("bin")
+    assert run_vm(sma16vm, image, str(tmp_path), 5.0) == run_model(image, 100000)
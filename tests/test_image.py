@@ -0,0 +1,62 @@
+"""Tests for the dense memory image C output."""
+from os import path
+from re import findall, search
+from shutil import copy, which
+from subprocess import DEVNULL, PIPE
+from subprocess import run as run_subprocess
+
+import pytest
+
+from sma16asm import Assembler, get_output_format
+from sma16conform import VM_HALT_OUTPUT, run_model
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: load @text
+    store @ASCII_OUT
+    halt
+.sec data 0x{:03x}
+text: .const a"hi"
+"""
+
+
+def image_words(image_file: bytes) -> list:
+    text = image_file.decode("ascii")
+    words = [int(word, 16) for word in findall(r"0x([0-9a-f]{4}),", text)]
+    match = search(r"#define MEMORY_IMAGE_WORDS 0x([0-9a-f]+)", text)
+    assert match is not None
+    assert int(match.group(1), 16) == len(words)
+    return words
+
+
+@pytest.mark.parametrize("data_address", [0x020, 0xfff])
+def test_image_holds_memory_up_to_the_highest_word(data_address):
+    image = Assembler().assemble_text(SOURCE.format(data_address))
+    words = image_words(image.serialise("image"))
+    assert len(words) == data_address + 1
+    binary = image.serialise("bin")
+    assert words == [int.from_bytes(binary[index:index + 2], "big") for index in range(0, len(binary), 2)]
+
+
+def test_image_files_are_recognised_by_extension():
+    assert get_output_format("program.i16") == "image"
+
+
+@pytest.mark.parametrize("output_format", ["image", "text"])
+def test_built_in_programs_run_on_sma16vm(tmp_path, output_format):
+    compiler = which("gcc") or which("cc")
+    if compiler is None:
+        pytest.skip("no C compiler to build sma16vm with")
+    image = Assembler().assemble_text(SOURCE.format(0x100))
+    (tmp_path / "memory_file.s16").write_bytes(image.serialise(output_format))
+    copy(path.join(ROOT, "sma16vm.c"), str(tmp_path))
+    vm_path = str(tmp_path / "sma16vm")
+    run_subprocess([compiler, "-Wall", "-pedantic", "-D", "MEMORY_FILE", str(tmp_path / "sma16vm.c"), "-o", vm_path],
+                   check=True)
+
+    completed = run_subprocess([vm_path], stdin=DEVNULL, stdout=PIPE, check=True)
+
+    assert completed.stdout == run_model(image.serialise("bin"), 1000).output + VM_HALT_OUTPUT
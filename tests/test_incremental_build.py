@@ -0,0 +1,84 @@
+"""Tests for incremental rebuilds."""
+import pytest
+
+import sma16asm
+from sma16asm import Assembler, IncrementalBuild, watch_file
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec a
+main:
+    load @x
+    halt
+.sec b
+{}
+"""
+
+
+def test_swapping_constant_and_instruction_matches_full_build():
+    build = IncrementalBuild(Assembler())
+    build.build(SOURCE.format("x: .const 5\ny: halt").splitlines())
+
+    edited = SOURCE.format("x: halt\ny: .const 5").splitlines()
+    image, _ = build.build(edited)
+
+    assert image.serialise("bin") == Assembler().assemble_lines(edited).serialise("bin")
+
+
+def full_build(lines: list) -> bytes:
+    return Assembler().assemble_lines(lines).serialise("bin")
+
+
+def test_changing_an_operand_rebuilds_only_its_section():
+    build = IncrementalBuild(Assembler())
+    build.build(SOURCE.format("x: .const 5\ny: halt").splitlines())
+
+    edited = SOURCE.format("x: .const 6\ny: jump @main").splitlines()
+    image, rebuilt = build.build(edited)
+
+    assert rebuilt == ["b"]
+    assert image.serialise("bin") == full_build(edited)
+
+
+def test_growing_a_section_falls_back_to_a_full_build():
+    build = IncrementalBuild(Assembler())
+    build.build(SOURCE.format("x: .const 5\ny: halt").splitlines())
+
+    edited = SOURCE.format("x: .const 5\nnoop\nnoop\ny: halt\n.sec c\nz: jump @y").splitlines()
+    image, rebuilt = build.build(edited)
+
+    assert rebuilt is None
+    assert image.serialise("bin") == full_build(edited)
+
+
+def test_partial_rebuilds_after_a_size_change_use_the_new_layout():
+    build = IncrementalBuild(Assembler())
+    build.build(SOURCE.format("x: .const 5\nnoop\ny: halt\n.sec c\nz: jump @y").splitlines())
+
+    shrunk = SOURCE.format("x: .const 5\ny: halt\n.sec c\nz: jump @y").splitlines()
+    image, rebuilt = build.build(shrunk)
+    assert rebuilt is None
+    assert image.serialise("bin") == full_build(shrunk)
+
+    edited = SOURCE.format("x: .const 7\ny: halt\n.sec c\nz: jump @x").splitlines()
+    image, rebuilt = build.build(edited)
+    assert rebuilt == ["b", "c"]
+    assert image.serialise("bin") == full_build(edited)
+    assert image.reference_table == Assembler().assemble_lines(edited).reference_table
+
+
+def test_watch_builds_with_the_given_assembler(tmp_path, monkeypatch):
+    source = SOURCE.format("x: .const 5\nnoop\nxor 0x000\nhalt")
+    (tmp_path / "watched.a16").write_text(source)
+
+    def interrupt(seconds: float):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(sma16asm, "sleep", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        watch_file(str(tmp_path / "watched.a16"), str(tmp_path / "watched.bin"), "bin",
+                   assembler=Assembler(optimise=True))
+
+    optimised = Assembler(optimise=True).assemble_text(source).serialise("bin")
+    assert optimised != full_build(source.splitlines())
+    assert (tmp_path / "watched.bin").read_bytes() == optimised
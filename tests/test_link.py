@@ -0,0 +1,37 @@
+"""Tests for object files and linking."""
+from glob import glob
+from os import path
+
+import pytest
+
+from sma16asm import FORMAT_EXTENSIONS, Assembler, ObjectModule, get_file_lines
+
+EXAMPLES = sorted(glob(path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly", "*.a16")))
+
+FORMATS = [output_format for output_format in FORMAT_EXTENSIONS if output_format != "object"]
+
+
+@pytest.mark.parametrize("output_format", FORMATS)
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_linking_one_module_matches_direct_assembly(example, output_format):
+    assembler = Assembler()
+    module = ObjectModule.load(assembler.assemble_object(get_file_lines(example), "main").serialise())
+
+    direct = assembler.assemble_path(example).serialise(output_format)
+    assert assembler.link([module]).serialise(output_format) == direct
+
+
+def test_modules_resolve_exported_labels():
+    assembler = Assembler()
+    main = assembler.assemble_object([
+        ".vec.reset @main",
+        ".vec.fault @RESET_VECTOR",
+        ".sec program",
+        "main: load @value",
+        "halt",
+    ], "main")
+    library = assembler.assemble_object([".global value", ".sec constant", "value: .const 0x123"], "library")
+
+    image = assembler.link([main, library])
+    words = {word.address: word.value for word in image.words}
+    assert words[words[image.reference_table["main"]] & 0x0fff] == 0x123
@@ -0,0 +1,101 @@
+"""Tests for assembling several files from the command line."""
+import sys
+from os import path
+from subprocess import PIPE
+from subprocess import run as run_subprocess
+from sys import executable
+
+import pytest
+
+import sma16asm
+from sma16asm import Assembler
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+GOOD_SOURCE = ".vec.reset @main\n.vec.fault @RESET_VECTOR\n.sec program\nmain: add 0x{:03x}\nhalt\n"
+BAD_SOURCE = ".sec program\njump @nowhere\n"
+
+
+def run_main(tmp_path, *arguments: str):
+    return run_subprocess([executable, path.join(ROOT, "sma16asm.py"), "--no-cache", *arguments],
+                          cwd=str(tmp_path),
+                          stdout=PIPE,
+                          stderr=PIPE,
+                          universal_newlines=True)
+
+
+def write_sources(tmp_path, sources: dict) -> list:
+    for name, source in sources.items():
+        (tmp_path / name).write_text(source)
+    return list(sources)
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_every_file_is_assembled(tmp_path, jobs):
+    names = write_sources(tmp_path, {"{}.a16".format(index): GOOD_SOURCE.format(index) for index in range(6)})
+    (tmp_path / "build").mkdir()
+
+    completed = run_main(tmp_path, *names, "-o", "build/{stem}.bin", "-j", jobs)
+
+    assert completed.returncode == 0
+    for index, name in enumerate(names):
+        expected = Assembler().assemble_text(GOOD_SOURCE.format(index)).serialise("bin")
+        assert (tmp_path / "build" / "{}.bin".format(index)).read_bytes() == expected
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_a_failing_file_does_not_stop_the_others(tmp_path, jobs):
+    names = write_sources(tmp_path, {"good.a16": GOOD_SOURCE.format(1), "bad.a16": BAD_SOURCE})
+
+    completed = run_main(tmp_path, *names, "-o", "{stem}.bin", "-j", jobs)
+
+    assert completed.returncode == 1
+    assert (tmp_path / "good.bin").is_file()
+    assert not (tmp_path / "bad.bin").exists()
+    assert completed.stderr.startswith("bad.a16: Assembly failed: ")
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_the_exit_code_is_the_highest_of_the_files(tmp_path, jobs):
+    names = write_sources(tmp_path, {"good.a16": GOOD_SOURCE.format(1), "bad.a16": BAD_SOURCE})
+
+    completed = run_main(tmp_path, *names, "missing.a16", "-o", "{stem}.bin", "-j", jobs)
+
+    assert completed.returncode == 3
+    assert "missing.a16: Input file does not exist." in completed.stdout
+    assert "bad.a16: Assembly failed: " in completed.stderr
+    assert (tmp_path / "good.bin").is_file()
+
+
+def test_several_files_need_an_output_directory_or_pattern(tmp_path):
+    names = write_sources(tmp_path, {"a.a16": GOOD_SOURCE.format(1), "b.a16": GOOD_SOURCE.format(2)})
+
+    completed = run_main(tmp_path, *names, "-o", "out.bin")
+
+    assert completed.returncode == 2
+    assert not (tmp_path / "out.bin").exists()
+
+
+def test_the_exit_code_is_described_in_the_help(tmp_path):
+    assert "highest" in run_main(tmp_path, "--help").stdout
+
+
+@pytest.mark.parametrize("pattern", ["{0}.bin", "{stem}{extension}", "{stem[9]}.bin", "{stem", "{stem!z}"])
+def test_invalid_output_patterns_are_reported(tmp_path, pattern):
+    names = write_sources(tmp_path, {"a.a16": GOOD_SOURCE.format(1)})
+
+    completed = run_main(tmp_path, *names, "-o", pattern)
+
+    assert completed.returncode == 2
+    assert completed.stdout == "Output pattern {} can only use {{stem}} and {{name}}.\n".format(pattern)
+    assert completed.stderr == ""
+
+
+def test_jobs_default_to_one_when_the_cpu_count_is_unknown(tmp_path, monkeypatch):
+    names = write_sources(tmp_path, {"a.a16": GOOD_SOURCE.format(1), "b.a16": GOOD_SOURCE.format(2)})
+    monkeypatch.setattr(sma16asm, "cpu_count", lambda: None)
+    monkeypatch.setattr(sys, "argv", ["sma16asm.py", "--no-cache", *names, "-o", "{stem}.bin"])
+    monkeypatch.chdir(tmp_path)
+
+    assert sma16asm.main() == 0
+    assert (tmp_path / "a.bin").is_file() and (tmp_path / "b.bin").is_file()
@@ -0,0 +1,52 @@
+"""Tests for the JSON symbol and source map."""
+from json import loads as json_loads
+
+from sma16asm import Assembler, get_output_format
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: start: load @value
+    store @SMALL_OUT
+    halt
+.sec data
+value: other: .const 0x123
+"""
+
+
+def load_map(source: str = SOURCE) -> dict:
+    return json_loads(Assembler().assemble_text(source).serialise("map"))
+
+
+def test_every_word_is_mapped_to_its_source():
+    source_map = load_map()
+    image = Assembler().assemble_text(SOURCE)
+    assert sorted(source_map["addresses"]) == sorted("0x{:03x}".format(word.address) for word in image.words)
+    for word in image.words:
+        entry = source_map["addresses"]["0x{:03x}".format(word.address)]
+        assert entry["value"] == word.value
+        assert entry["line"] == word.line
+
+
+def test_addresses_give_lines_sections_labels_and_references():
+    addresses = load_map()["addresses"]
+    assert addresses["0x010"] == {"value": 0x4013, "line": 4, "section": "program", "labels": ["main", "start"],
+                                  "reference": "value"}
+    assert addresses["0x011"] == {"value": 0x500b, "line": 5, "section": "program", "labels": [],
+                                  "reference": "SMALL_OUT"}
+    assert addresses["0x013"] == {"value": 0x0123, "line": 8, "section": "data", "labels": ["other", "value"],
+                                  "reference": None}
+    assert addresses["0x000"]["section"] == "vectors"
+    assert addresses["0x000"]["reference"] == "main"
+
+
+def test_regions_and_symbols_are_included():
+    source_map = load_map()
+    assert source_map["regions"]["program"] == {"type": "user", "start": 0x010, "end": 0x012}
+    assert source_map["regions"]["vectors"]["type"] == "reserved"
+    assert source_map["symbols"]["main"] == source_map["symbols"]["start"] == 0x010
+    assert source_map["symbols"]["SMALL_OUT"] == 0x00b
+
+
+def test_map_files_are_recognised_by_extension():
+    assert get_output_format("program.map") == "map"
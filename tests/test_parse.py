@@ -0,0 +1,18 @@
+"""Tests for parsing values."""
+
+import pytest
+
+from sma16asm import AssemblyError, parse_value
+
+
+@pytest.mark.parametrize("literal", ['a"\\x"', "a'\\x'", "s'\\u'", 'a"\\x4"', "a'\\u004'", 'a"\\U00110000"'])
+def test_malformed_escape_is_an_assembly_error(literal):
+    with pytest.raises(AssemblyError, match="on line 7"):
+        parse_value(literal, 7)
+
+
+def test_escapes_are_decoded():
+    assert parse_value('a"\\x41B"', 1).value == "AB"
+    assert parse_value("a'\\u0041'", 1).value == "A"
+    assert parse_value("a'\\101'", 1).value == "A"
+    assert parse_value('a"\\n\\t"', 1).value == "\n\t"
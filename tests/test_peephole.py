@@ -0,0 +1,86 @@
+"""Tests for the peephole pass."""
+from sma16asm import Assembler, AssembledImage, Instruction
+from sma16emu import Emulator
+
+HEADER = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+"""
+
+
+def assemble(body: str, optimise: bool = True) -> AssembledImage:
+    return Assembler(optimise=optimise).assemble_text(HEADER + body)
+
+
+def program_words(image: AssembledImage) -> list:
+    region = image.region_table["program"]
+    return [word.value for word in sorted(image.words, key=lambda word: word.address)
+            if region.start <= word.address <= region.end]
+
+
+def run(image: AssembledImage) -> Emulator:
+    emulator = Emulator.from_items(image.words)
+    emulator.run(100000)
+    return emulator
+
+
+def test_redundant_instructions_are_removed():
+    image = assemble("noop\nxor 0x000\nand 0xfff\nadd 0x001\nstore @SMALL_OUT\nhalt\n")
+    assert program_words(image) == [0xb001, 0x500b, 0x0000]
+    assert image.peephole_report.removed_noops == 3
+    assert image.peephole_report.words_saved == 3
+
+
+def test_immediates_are_folded():
+    image = assemble("add 0x001\nadd 0x002\nxor 0x00f\nxor 0x0f0\nand 0x0ff\nand 0x0f0\nhalt\n")
+    assert program_words(image) == [0xb003, 0x80ff, 0x90f0, 0x0000]
+    assert image.peephole_report.folded_immediates == 3
+
+
+def test_jumps_to_jumps_are_retargeted():
+    image = assemble("jump @first\nfirst: jump @second\nsecond: halt\n")
+    words = program_words(image)
+    assert words[0] == (Instruction.JUMP << 12) | image.reference_table["second"]
+    assert image.peephole_report.threaded_jumps == 1
+
+
+def test_load_after_sfull_is_removed():
+    image = assemble("add 0x005\nsfull @value\nload @value\nhalt\n.sec data\nvalue: .var 0\n")
+    assert image.peephole_report.removed_loads == 1
+    assert program_words(image) == [0xb005, (Instruction.SFULL << 12) | image.reference_table["value"], 0x0000]
+
+
+def test_words_which_are_stored_to_are_kept():
+    image = assemble("load @patch\nstore @target\ntarget: noop\nhalt\n.sec data\npatch: .const 0x000\n")
+    assert image.peephole_report.removed_noops == 0
+    assert len(program_words(image)) == 4
+
+
+def test_nothing_is_removed_after_a_label_used_as_a_value():
+    image = assemble("load @table\nhalt\ntable: noop\nnoop\n")
+    assert image.peephole_report.words_saved == 0
+
+
+def test_sections_with_labels_used_as_data_are_not_compacted():
+    body = "noop\nadd @here\nstore @SMALL_OUT\nhere: halt\n"
+    image = assemble(body)
+    assert image.peephole_report.words_saved == 0
+    assert bytes(run(image).output) == bytes(run(assemble(body, optimise=False)).output)
+
+
+def test_sections_which_fall_through_are_not_compacted():
+    body = "noop\nadd 0x001\n.sec next\nstore @SMALL_OUT\nhalt\n"
+    image = assemble(body)
+    assert image.peephole_report.words_saved == 0
+    assert bytes(run(image).output) == bytes(run(assemble(body, optimise=False)).output)
+
+
+def test_a_loop_behaves_the_same_in_fewer_cycles():
+    body = ("load @count\nloop:\n    noop\n    add 0xfff\n    xor 0x000\n    store @SMALL_OUT\n"
+            "    jumpz @exit\n    jump @loop\nexit: jump @done\ndone:\n    halt\ncount: .const 3\n")
+    plain, optimised = run(assemble(body, optimise=False)), run(assemble(body))
+    assert optimised.halt and bytes(optimised.output) == bytes(plain.output) == b"CB"
+    assert (plain.instructions, optimised.instructions) == (21, 14)
+    report = assemble(body).peephole_report
+    assert (report.removed_noops, report.threaded_jumps, report.words_saved) == (2, 1, 2)
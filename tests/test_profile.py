@@ -0,0 +1,95 @@
+"""Tests for the profiling emulator."""
+import pytest
+
+from sma16asm import Assembler, Instruction
+from sma16emu import Emulator, ProfilingEmulator
+
+COUNTDOWN = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: load @count
+loop: add 0xfff
+    jumpz @done
+    jump @loop
+done: halt
+.sec data
+count: .const 3
+"""
+
+SELF_MODIFYING = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main: load @value
+    store @patch
+    store @SMALL_OUT
+patch: noop
+    halt
+.sec data
+value: .const 0x041
+"""
+
+
+def profile(source: str):
+    image = Assembler().assemble_text(source)
+    emulator = ProfilingEmulator.from_items(image.words)
+    emulator.run(100000)
+    return image, emulator
+
+
+def test_addresses_and_opcodes_are_counted():
+    image, emulator = profile(COUNTDOWN)
+    loop = image.reference_table["loop"]
+    assert emulator.execution_counts[image.reference_table["main"]:loop + 4] == [1, 3, 3, 2, 1]
+    assert emulator.opcode_counts[Instruction.ADD] == 3
+    assert emulator.opcode_counts[Instruction.JUMP] == 3
+    assert emulator.opcode_counts[Instruction.JUMPZ] == 3
+    assert sum(emulator.opcode_counts) == sum(emulator.execution_counts) == emulator.instructions == 11
+
+
+def test_jump_edges_are_counted_whether_taken_or_not():
+    image, emulator = profile(COUNTDOWN)
+    loop, done = image.reference_table["loop"], image.reference_table["done"]
+    assert emulator.jump_edges == {
+        (0x000, image.reference_table["main"]): 1,
+        (loop + 1, loop + 2): 2,
+        (loop + 1, done): 1,
+        (loop + 2, loop): 2,
+    }
+
+
+def test_only_writes_to_executed_words_are_self_modifying():
+    image, emulator = profile(SELF_MODIFYING)
+    assert emulator.self_modifying_writes == 1
+    assert emulator.write_counts[image.reference_table["patch"]] == 1
+    assert emulator.write_counts[image.reference_table["SMALL_OUT"]] == 1
+    _, emulator = profile(COUNTDOWN)
+    assert emulator.self_modifying_writes == 0
+
+
+@pytest.mark.parametrize("source", [COUNTDOWN, SELF_MODIFYING], ids=["countdown", "self_modifying"])
+def test_runs_match_the_emulator(source):
+    image = Assembler().assemble_text(source)
+    expected = Emulator.from_items(image.words)
+    expected.run(10000)
+    emulator = ProfilingEmulator.from_items(image.words)
+    emulator.run(10000)
+    assert (emulator.halt, bytes(emulator.output), emulator.memory) == (expected.halt, bytes(expected.output),
+                                                                       expected.memory)
+    assert sum(emulator.execution_counts) == expected.instructions
+
+
+def test_listing_is_annotated_with_counts_and_labels():
+    image, emulator = profile(COUNTDOWN)
+    listing = emulator.listing(image.reference_table, image.region_table, image.words).decode("ascii").splitlines()
+    assert "0x011 (loop            ) -> 0xb (ADD  ), 0xfff (                ) |          3  27.27%" in listing
+    assert " *   - ADD            3  27.27%" in listing
+    assert " *   -          2 0x013 (loop+2) -> 0x011 (loop)" in listing
+    assert " * Self-modifying writes: 0" in listing
+
+
+def test_listing_without_an_image_shows_executed_words():
+    _, emulator = profile(SELF_MODIFYING)
+    listing = emulator.listing().decode("ascii").splitlines()
+    memory = listing[listing.index("=== START MEMORY ===") + 1:listing.index("===  END MEMORY  ===")]
+    assert sum(line.startswith("0x") for line in memory) == sum(map(bool, emulator.execution_counts))
+    assert " * Self-modifying writes: 1" in listing
@@ -0,0 +1,117 @@
+"""Tests for placing sections in memory."""
+from dataclasses import replace
+from random import Random
+
+import pytest
+
+from sma16asm import REGIONS, AddressSpace, AssemblyError, assign_sections
+
+
+def region_table():
+    return {name: replace(region) for name, region in REGIONS.items()}
+
+
+def test_address_space_finds_overlaps_and_free_blocks():
+    address_space = AddressSpace(0x100)
+    address_space.add(0x10, 0x1f)
+    address_space.add(0x40, 0x4f)
+
+    assert address_space.overlaps(0x1f, 0x20)
+    assert address_space.overlaps(0x00, 0x10)
+    assert not address_space.overlaps(0x20, 0x3f)
+    assert address_space.overlaps(0xf0, 0x100)
+    assert list(address_space.free_blocks()) == [(0x00, 0x0f), (0x20, 0x3f), (0x50, 0xff)]
+    assert address_space.free_space == 0x100 - 0x20
+    assert address_space.largest_free_block == 0xb0
+
+
+def test_best_fit_takes_the_smallest_block_that_fits():
+    address_space = AddressSpace(0x100)
+    address_space.add(0x10, 0x1f)
+    address_space.add(0x28, 0x2f)
+
+    assert address_space.best_fit(0x08) == 0x20
+    assert address_space.best_fit(0x10) == 0x00
+    assert address_space.best_fit(0x11) == 0x30
+    assert address_space.best_fit(0x101) is None
+
+
+def test_best_fit_takes_the_lowest_of_equal_blocks():
+    address_space = AddressSpace(0x100)
+    address_space.add(0x08, 0x0f)
+    address_space.add(0x18, 0x1f)
+    address_space.add(0x28, 0xff)
+
+    assert address_space.best_fit(0x08) == 0x00
+    address_space.add(0x00, 0x07)
+    assert address_space.best_fit(0x08) == 0x10
+
+
+def test_fragmentation_is_the_free_space_outside_the_largest_block():
+    address_space = AddressSpace(0x100)
+    assert address_space.fragmentation == 0.0
+    address_space.add(0x40, 0xbf)
+    assert address_space.fragmentation == 0.5
+    address_space.add(0x00, 0xff)
+    assert address_space.fragmentation == 0.0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_free_blocks_match_the_used_intervals(seed):
+    random = Random(seed)
+    address_space = AddressSpace(0x100)
+    used = set()
+    for _ in range(30):
+        start = random.randrange(0x100)
+        end = min(0xff, start + random.randrange(-1, 0x10))
+        assert address_space.overlaps(start, end) == (end < start or bool(used & set(range(start, end + 1))))
+        address_space.add(start, end)
+        used.update(range(start, end + 1))
+
+    free = [address for address in range(0x100) if address not in used]
+    blocks = [(start, end) for start, end in address_space.free_blocks()]
+    assert [address for start, end in blocks for address in range(start, end + 1)] == free
+    assert all(first[1] + 1 < second[0] for first, second in zip(blocks, blocks[1:]))
+    for size in range(1, 0x20):
+        fits = [(end - start + 1, start) for start, end in blocks if end - start + 1 >= size]
+        assert address_space.best_fit(size) == (min(fits)[1] if fits else None)
+
+
+def test_sections_are_placed_after_reserved_regions():
+    regions = region_table()
+    assign_sections(regions, {"program": 4, "constant": 2})
+    assert (regions["program"].start, regions["program"].end) == (0x010, 0x013)
+    assert (regions["constant"].start, regions["constant"].end) == (0x014, 0x015)
+
+
+def test_pinned_sections_are_placed_first_and_others_fill_the_gaps():
+    regions = region_table()
+    assign_sections(regions, {"small": 4, "pinned": 4, "large": 0x20}, {"pinned": 0x014})
+    assert regions["pinned"].start == 0x014
+    assert regions["small"].start == 0x010
+    assert regions["large"].start == 0x018
+
+
+def test_sections_are_placed_largest_first_when_declaration_order_does_not_fit():
+    regions = region_table()
+    # Free memory is a 0x10 word gap below the pin and 0xfd0 words above it, so "a" must not take the gap
+    assign_sections(regions, {"a": 0x8, "large": 0xfc8, "b": 0x10, "pinned": 0x10}, {"pinned": 0x020})
+    assert regions["b"].start == 0x010
+    assert regions["large"].start == 0x030
+    assert regions["a"].start == 0xff8
+
+
+def test_overlapping_pins_are_rejected():
+    with pytest.raises(AssemblyError, match="overlaps"):
+        assign_sections(region_table(), {"a": 4, "b": 4}, {"a": 0x020, "b": 0x022})
+
+
+def test_full_memory_is_rejected():
+    with pytest.raises(AssemblyError, match="ran out of free space"):
+        assign_sections(region_table(), {"a": 0x800, "b": 0x800})
+
+
+def test_fragmentation_is_reported_when_sections_do_not_fit():
+    # A pin at 0x100 leaves 240 free words below it and 3824 above
+    with pytest.raises(AssemblyError, match="4064 words free in blocks of at most 3824 words, 6% fragmented"):
+        assign_sections(region_table(), {"a": 3825, "pinned": 0x10}, {"pinned": 0x100})
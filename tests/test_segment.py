@@ -0,0 +1,56 @@
+"""Tests for the sparse segment image format."""
+from glob import glob
+from os import path
+
+import pytest
+
+from sma16asm import SEGMENT_IMAGE_MAGIC, AddressValue, Assembler, get_segments
+from sma16conform import run_vm
+from sma16emu import load_bin_image, load_segment_image
+
+EXAMPLES = sorted(glob(path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly", "*.a16")))
+
+PINNED_HIGH = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program 0xf00
+main:
+    load @value
+    store @SMALL_OUT
+    halt
+value: .const s"hi"
+"""
+
+
+def words(*pairs):
+    return [AddressValue(address=address, value=value, line=0) for address, value in pairs]
+
+
+def test_short_gaps_are_filled_and_long_gaps_split_segments():
+    segments = get_segments(words((0x10, 1), (0x11, 2), (0x14, 3), (0x20, 4)))
+    assert segments == [(0x10, [1, 2, 0, 0, 3]), (0x20, [4])]
+
+
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_segment_image_loads_as_the_bin_image(example):
+    image = Assembler().assemble_path(example)
+    segment_image = image.serialise("segment")
+    assert segment_image.startswith(SEGMENT_IMAGE_MAGIC)
+    assert load_segment_image(segment_image) == load_bin_image(image.serialise("bin"))
+
+
+def test_unused_memory_is_not_stored():
+    image = Assembler().assemble_text(PINNED_HIGH)
+    assert len(image.serialise("segment")) < 32
+    assert len(image.serialise("bin")) > 2 * 0xf00
+
+
+def test_truncated_segment_image_is_rejected():
+    with pytest.raises(ValueError):
+        load_segment_image(Assembler().assemble_text(PINNED_HIGH).serialise("segment")[:-2])
+
+
+def test_sma16vm_runs_segment_images(sma16vm, tmp_path):
+    image = Assembler().assemble_text(PINNED_HIGH)
+    assert run_vm(sma16vm, image.serialise("segment"), str(tmp_path), 5.0) == run_vm(
+        sma16vm, image.serialise("bin"), str(tmp_path), 5.0)
+    assert run_vm(sma16vm, image.serialise("segment"), str(tmp_path), 5.0).output == b"hi"
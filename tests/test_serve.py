@@ -0,0 +1,66 @@
+"""Tests for the --serve request handler."""
+from json import dumps as json_dumps, loads as json_loads
+from os import path
+from subprocess import PIPE, CompletedProcess
+from subprocess import run as run_subprocess
+from sys import executable
+
+from sma16asm import Assembler, handle_request
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+    halt
+"""
+
+
+def request(**fields) -> dict:
+    return json_loads(handle_request(Assembler(), json_dumps(fields)))
+
+
+def test_source_is_assembled():
+    response = request(id=1, source=SOURCE, format="bin")
+    assert response["ok"] and response["id"] == 1 and response["output"]
+
+
+def test_non_string_source_is_a_bad_request():
+    response = request(source=5)
+    assert not response["ok"]
+    assert response["diagnostics"][0].startswith("Bad request")
+
+
+def test_non_string_path_is_a_bad_request():
+    response = request(path=0)
+    assert not response["ok"]
+    assert response["diagnostics"][0].startswith("Bad request")
+
+
+def test_unexpected_errors_are_reported():
+    response = request(source=".vec.bogus @x\n")
+    assert not response["ok"] and response["diagnostics"]
+
+
+def serve(socket_path) -> CompletedProcess:
+    return run_subprocess([executable, path.join(ROOT, "sma16asm.py"), "--serve", "--socket", str(socket_path)],
+                          stdout=PIPE,
+                          stderr=PIPE,
+                          universal_newlines=True,
+                          timeout=30)
+
+
+def test_a_file_in_the_way_of_the_socket_is_left_alone(tmp_path):
+    socket_path = tmp_path / "sma16.sock"
+    socket_path.write_text("keep me")
+    completed = serve(socket_path)
+    assert completed.returncode == 2
+    assert completed.stderr == "{} exists and is not a socket.\n".format(socket_path)
+    assert socket_path.read_text() == "keep me"
+
+
+def test_a_socket_which_cannot_be_bound_is_reported(tmp_path):
+    completed = serve(tmp_path / "missing" / "sma16.sock")
+    assert completed.returncode == 2
+    assert completed.stderr.startswith("Cannot serve on ")
@@ -0,0 +1,115 @@
+"""Tests for the generated .stack handler."""
+
+import pytest
+
+from sma16asm import Assembler, AssemblyError
+from sma16conform import run_model, run_vm
+from sma16emu import Emulator
+
+HEADER = """.vec.reset @main
+.stack 0xfe0 4
+.sec program
+main:
+"""
+
+FOOTER = """
+yes:
+    load @letter_y
+    sfull @ASCII_OUT
+    halt
+letter_y: .const a'Y'
+"""
+
+
+def run(body: str, header: str = HEADER) -> Emulator:
+    emulator = Emulator.from_items(Assembler().assemble_text(header + body + FOOTER).words)
+    emulator.run(100000)
+    assert emulator.halt
+    return emulator
+
+
+def test_pop_returns_pushed_values_in_reverse():
+    emulator = run("""
+    and 0x000
+    add 0x041
+    push
+    add 0x001
+    push
+    add 0x001
+    push
+    pop
+    sfull @ASCII_OUT
+    pop
+    sfull @ASCII_OUT
+    pop
+    sfull @ASCII_OUT
+    halt
+""")
+    assert bytes(emulator.output) == b"CBA"
+
+
+def test_pushing_more_than_depth_loses_the_oldest_and_pops_are_zeroed():
+    pushes = "    add 0x001\n    push\n" * 5
+    pops = "    pop\n    sfull @ASCII_OUT\n" * 5
+    emulator = run("    and 0x000\n    add 0x040\n" + pushes + pops + "    halt\n")
+    assert bytes(emulator.output) == b"EDCB\x00"
+    assert all(word == 0 for word in emulator.memory[0xfe0:0xfe4])
+
+
+@pytest.mark.parametrize("instruction", ["push", "pop"])
+def test_zero_flag_set_is_preserved(instruction):
+    emulator = run("    and 0x000\n    add 0x000\n    {}\n    jumpz @yes\n    halt\n".format(instruction))
+    assert bytes(emulator.output) == b"Y"
+
+
+@pytest.mark.parametrize("instruction", ["push", "pop"])
+def test_zero_flag_clear_is_preserved(instruction):
+    emulator = run("    and 0x000\n    add 0x001\n    {}\n    jumpz @yes\n    halt\n".format(instruction))
+    assert bytes(emulator.output) == b""
+
+
+@pytest.mark.parametrize("instruction, zero, cycles", [("push", False, 24), ("push", True, 23), ("pop", False, 26),
+                                                       ("pop", True, 25)])
+def test_cycle_counts(instruction, zero, cycles):
+    setup = "    and 0x000\n    add 0x{:03x}\n".format(0 if zero else 1)
+    baseline = run(setup + "    halt\n").instructions
+    assert run(setup + "    {}\n    halt\n".format(instruction)).instructions - baseline == cycles
+
+
+@pytest.mark.parametrize("instruction, cycles", [("push", 18), ("pop", 20)])
+def test_fast_stacks_leave_out_the_zero_flag(instruction, cycles):
+    header = HEADER.replace(".stack 0xfe0 4", ".stack 0xfe0 4 fast")
+    setup = "    and 0x000\n    add 0x001\n"
+    baseline = run(setup + "    halt\n", header).instructions
+    assert run(setup + "    {}\n    halt\n".format(instruction), header).instructions - baseline == cycles
+
+
+def test_fast_pop_returns_pushed_values_in_reverse():
+    header = HEADER.replace(".stack 0xfe0 4", ".stack 0xfe0 4 fast")
+    emulator = run("    and 0x000\n    add 0x041\n    push\n    add 0x001\n    push\n"
+                   "    pop\n    sfull @ASCII_OUT\n    pop\n    sfull @ASCII_OUT\n    halt\n", header)
+    assert bytes(emulator.output) == b"BA"
+
+
+def test_stack_size_is_set_before_the_program_starts():
+    emulator = run("    load @STACK_SIZE\n    sfull @ASCII_OUT\n    halt\n")
+    assert bytes(emulator.output) == b"\x04"
+
+
+@pytest.mark.parametrize("directive",
+                         [".stack 0xfe0 3", ".stack 0xfe1 4", ".stack 0xffe 4", ".stack 0xfe0", ".stack 0xfe0 4 slow"])
+def test_invalid_stacks_are_rejected(directive):
+    with pytest.raises(AssemblyError, match="stack on line 2"):
+        Assembler().assemble_text(HEADER.replace(".stack 0xfe0 4", directive) + "    halt\n")
+
+
+def test_fault_vector_cannot_also_be_set():
+    with pytest.raises(AssemblyError, match="replaces the fault vector"):
+        Assembler().assemble_text(".vec.fault @main\n" + HEADER + "    halt\n")
+
+
+def test_matches_sma16vm(sma16vm, tmp_path):
+    body = ("    and 0x000\n    add 0x041\n    push\n    add 0x000\n    pop\n"
+            "    sfull @ASCII_OUT\n    pop\n    jumpz @yes\n")
+    image = Assembler().assemble_text(HEADER + body + "    halt\n" + FOOTER).serialise("bin")
+    assert run_vm(sma16vm, image, str(tmp_path), 5.0) == run_model(image, 100000)
@@ -0,0 +1,84 @@
+"""Tests for machine state snapshots."""
+from zlib import compress
+
+import pytest
+
+from sma16asm import Assembler
+from sma16emu import MACHINE_STATE_MAGIC, Emulator, MachineState
+
+# Counts down from 5, printing as it goes and keeping the count in memory
+COUNTDOWN = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+    load @count
+loop:
+    add 0xfff
+    sfull @count
+    store @SMALL_OUT
+    jumpz @done
+    jump @loop
+done:
+    halt
+.sec data
+count: .var 5
+"""
+
+
+def countdown() -> Emulator:
+    return Emulator.from_items(Assembler().assemble_text(COUNTDOWN).words)
+
+
+@pytest.mark.parametrize("halt, test", [(False, False), (True, False), (False, True), (True, True)])
+def test_states_round_trip(halt, test):
+    emulator = countdown()
+    emulator.run(10)
+    state = emulator.snapshot()
+    state.halt, state.test = halt, test
+    assert MachineState.load(state.serialise()) == state
+
+
+@pytest.mark.parametrize("state_bytes", [b"", b"S16", b"XXXX" + bytes(20), MACHINE_STATE_MAGIC + bytes(5)],
+                         ids=["empty", "short magic", "bad magic", "no memory"])
+def test_bad_states_are_rejected(state_bytes):
+    with pytest.raises(ValueError):
+        MachineState.load(state_bytes)
+
+
+def test_truncated_memory_is_rejected():
+    state_bytes = countdown().snapshot().serialise()
+    with pytest.raises(ValueError, match="corrupt"):
+        MachineState.load(state_bytes[:-4])
+
+
+def test_memory_of_the_wrong_size_is_rejected():
+    state_bytes = countdown().snapshot().serialise()
+    with pytest.raises(ValueError, match="corrupt"):
+        MachineState.load(state_bytes[:len(MACHINE_STATE_MAGIC) + 5] + compress(bytes(16)))
+
+
+@pytest.mark.parametrize("steps", [1, 4, 9, 30])
+def test_resumed_runs_match_uninterrupted_runs(steps):
+    uninterrupted = countdown()
+    uninterrupted.run(20000)
+
+    first = countdown()
+    first.run(steps)
+    resumed = Emulator.from_state(MachineState.load(first.snapshot().serialise()))
+    resumed.run(20000 - first.instructions)
+
+    assert resumed.snapshot() == uninterrupted.snapshot()
+    assert bytes(first.output + resumed.output) == bytes(uninterrupted.output)
+
+
+def test_snapshots_are_not_changed_by_running():
+    emulator = countdown()
+    state = emulator.snapshot()
+    memory = state.memory.tobytes()
+
+    Emulator.from_state(state).run(20000)
+    emulator.run(20000)
+    assert state.memory.tobytes() == memory
+
+    emulator.restore(state)
+    assert emulator.snapshot() == state
@@ -0,0 +1,78 @@
+"""Tests for per-stage measurements."""
+from json import loads as json_loads
+from os import path
+from subprocess import PIPE
+from subprocess import run as run_subprocess
+from sys import executable
+
+from sma16asm import Assembler, StageStatistics, format_stage_table
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+SOURCE = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+    load @value
+    store @SMALL_OUT
+    halt
+value: .const 0x123
+"""
+
+
+def stages(trace_memory: bool = False) -> list:
+    statistics: list = []
+    assembler = Assembler(stage_hook=statistics.append, trace_memory=trace_memory)
+    assembler.serialise(assembler.assemble_text(SOURCE), "bin")
+    return statistics
+
+
+def run_main(tmp_path, *arguments: str):
+    source_path = tmp_path / "program.a16"
+    source_path.write_text(SOURCE)
+    return run_subprocess([executable, path.join(ROOT, "sma16asm.py"), str(source_path), "-o",
+                           str(tmp_path / "program.bin"), *arguments],
+                          stdout=PIPE,
+                          check=True).stdout.decode("utf-8")
+
+
+def test_hook_receives_every_stage_in_order():
+    statistics = stages()
+    assert [stage.stage for stage in statistics] == [
+        "parse_lines", "glue_labels_and_sections", "expand_stack_directives", "assign_vectors", "get_section_sizes",
+        "assign_sections", "assign_constants", "assign_instructions", "resolve_references", "serialise_to_bin_file"
+    ]
+    assert statistics[0].items_in == len(SOURCE.splitlines())
+    assert statistics[-2].items_out == 6
+    assert all(stage.seconds >= 0 for stage in statistics)
+
+
+def test_memory_is_only_traced_when_asked_for():
+    assert all(stage.peak_memory is None for stage in stages())
+    assert all(isinstance(stage.peak_memory, int) for stage in stages(trace_memory=True))
+
+
+def test_table_marks_untraced_memory():
+    table = format_stage_table([StageStatistics("parse_lines", 0.002, None, 8, 6),
+                                StageStatistics("assign_vectors", 0.001, 512, 6, 6)])
+    lines = table.splitlines()
+    assert lines[0].split()[0] == "stage"
+    assert lines[1].split() == ["parse_lines", "2.000", "-", "8", "6"]
+    assert lines[2].split() == ["assign_vectors", "1.000", "512", "6", "6"]
+    assert lines[3].split() == ["total", "3.000"]
+
+
+def test_stats_table_is_printed(tmp_path):
+    output = run_main(tmp_path, "--stats")
+    assert "parse_lines" in output
+    assert "serialise_to_bin_file" in output
+    assert output.splitlines()[-1].startswith("total")
+
+
+def test_stats_json_is_printed(tmp_path):
+    statistics = json_loads(run_main(tmp_path, "--stats", "json"))["stages"]
+    assert statistics[-1]["stage"] == "serialise_to_bin_file"
+    assert all(stage["peak_memory"] is None for stage in statistics)
+
+    statistics = json_loads(run_main(tmp_path, "--stats", "json", "--stats-memory"))["stages"]
+    assert all(stage["peak_memory"] >= 0 for stage in statistics)
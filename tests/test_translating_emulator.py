@@ -0,0 +1,143 @@
+"""Tests for the block translating emulator."""
+from glob import glob
+from os import path
+
+import pytest
+
+from sma16asm import Assembler
+from sma16emu import Emulator, TranslatingEmulator
+
+EXAMPLE_DIRECTORY = path.join(path.dirname(path.dirname(path.abspath(__file__))), "example", "assembly")
+
+EXAMPLES = sorted(glob(path.join(EXAMPLE_DIRECTORY, "*.a16")))
+
+HEADER = """.vec.reset @main
+.vec.fault @RESET_VECTOR
+.sec program
+main:
+"""
+
+# Counts from 1 to 3 by rewriting the operand of an ADD inside the looping block
+SELF_INCREMENTING = HEADER + """
+loop:
+    and 0x000
+step: add 0x001
+    store @SMALL_OUT
+    load @step
+    add 0x001
+    store @step
+    xor 0x004
+    lshft 0x018
+    add 0x000
+    jumpz @done
+    jump @loop
+done:
+    halt
+"""
+
+# Replaces a later instruction of the block it is running
+PATCH_AHEAD = HEADER + """
+    load @replacement
+    sfull @patched
+    and 0x000
+patched: add 0x001
+    store @SMALL_OUT
+    halt
+replacement: add 0x005
+"""
+
+
+# Each of 300 call sites is its own block, reached through a JUMPZ whose operand the program steps on
+SHARED_ROUTINE = HEADER + """
+    load @zero
+    add 0x000
+dispatch: jumpz @site_0
+    halt
+next:
+    load @dispatch
+    add 0x001
+    sfull @dispatch
+    load @zero
+    add 0x000
+    jump @dispatch
+shared: jumpz @next
+    jump @shared
+""" + "".join("site_{}: jump @shared\n".format(index) for index in range(300)) + """    halt
+zero: .const 0
+"""
+
+
+def machines(source: str):
+    words = Assembler().assemble_text(source).words
+    return Emulator.from_items(words), TranslatingEmulator.from_items(words)
+
+
+def machine_state(emulator: Emulator) -> tuple:
+    return (emulator.halt, emulator.accumulator, emulator.program_counter, emulator.test, emulator.instructions,
+            bytes(emulator.output), emulator.memory.tobytes())
+
+
+@pytest.mark.parametrize("example", EXAMPLES, ids=path.basename)
+def test_examples_match_the_emulator(example):
+    words = Assembler().assemble_path(example).words
+    emulator, translating = Emulator.from_items(words), TranslatingEmulator.from_items(words)
+    emulator.run(20000)
+    translating.run(20000)
+    assert translating.halt
+    assert machine_state(translating) == machine_state(emulator)
+
+
+@pytest.mark.parametrize("source", [SELF_INCREMENTING, PATCH_AHEAD], ids=["self_incrementing", "patch_ahead"])
+def test_budgets_ending_mid_block_match_the_emulator(source):
+    emulator, translating = machines(source)
+    for budget in list(range(1, 14)) * 4:
+        assert translating.run(budget).instructions == emulator.run(budget).instructions
+        assert machine_state(translating) == machine_state(emulator)
+    assert translating.halt
+
+
+@pytest.mark.parametrize("source, output", [(SELF_INCREMENTING, b"BCD"), (PATCH_AHEAD, b"F")],
+                         ids=["self_incrementing", "patch_ahead"])
+def test_writes_into_the_running_block_match_the_emulator(source, output):
+    emulator, translating = machines(source)
+    emulator.run(1000)
+    translating.run(1000)
+    assert translating.halt
+    assert translating.invalidations
+    assert bytes(translating.output) == output
+    assert machine_state(translating) == machine_state(emulator)
+
+
+def test_more_than_255_blocks_can_share_an_address():
+    emulator, translating = machines(SHARED_ROUTINE)
+    emulator.run(10000)
+    translating.run(10000)
+    assert translating.halt
+    assert translating.translations > 300
+    assert machine_state(translating) == machine_state(emulator)
+
+
+def test_restore_drops_translated_blocks():
+    _, translating = machines(SELF_INCREMENTING)
+    translating.run(1000)
+    emulator, _ = machines(PATCH_AHEAD)
+    state = emulator.snapshot()
+
+    translating.restore(state)
+    assert not any(translating.covered)
+    translating.run(1000)
+    emulator.run(1000)
+    assert translating.snapshot() == emulator.snapshot()
+
+
+@pytest.mark.parametrize("steps", [1, 5, 12])
+def test_restored_runs_repeat_themselves(steps):
+    _, translating = machines(SELF_INCREMENTING)
+    translating.run(steps)
+    state = translating.snapshot()
+    translating.run(1000)
+    first = translating.snapshot()
+
+    translating.restore(state)
+    translating.run(1000)
+    assert translating.snapshot() == first